@@ -14,7 +14,7 @@ import sys
 import argparse
 import ravencoin
 import ravencoin.core
-from ravencoin.rpc import RavenProxy
+from ravencoin.rpc import RavenProxy, iter_blocks
 from ravencoin.core import COIN
 from ravencoin.core.assets import RvnAssetData
 from ravencoin.core.script import OP_RVN_ASSET,CScriptOp
@@ -34,7 +34,7 @@ else:
         start = ravencoin.core.coreparams.nAssetActivationHeight
     ravencoin.SelectParams("mainnet")
 
-r = RavenProxy() # ravencoin daemon must be running locally with rpc server enabled
+r = RavenProxy(pool_size=2) # ravencoin daemon must be running locally with rpc server enabled
 
 try:
     end = r.getblockcount()
@@ -42,9 +42,7 @@ except Exception as e:
     print("Error: ".format(e))
     sys.exit(1)
 
-for c in range(start,end):
-   blockhash = r.getblockhash(c)
-   block = r.getblock(blockhash)
+for c, block in iter_blocks(r, start, end):
    for tx in block.vtx:
       for v in tx.vout:
           try:
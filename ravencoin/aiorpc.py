@@ -0,0 +1,364 @@
+# Copyright (C) 2018-2020 The python-ravencoinlib developers
+#
+# This file is part of python-ravencoinlib.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-ravencoinlib, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Ravencoin Core RPC support for asyncio
+
+The proxies here mirror those of ``ravencoin.rpc``, with every RPC method a
+coroutine:
+
+>>> async with AsyncRavenProxy() as proxy:
+...     block = await proxy.getblock(await proxy.getblockhash(0))
+
+Concurrent calls share a pool of keep-alive connections; beyond its size they
+wait for a connection to become idle. A proxy must only be used from one
+event loop.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import base64
+import functools
+import itertools
+import json
+import time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+try:
+    import urllib.parse as urlparse
+except ImportError:
+    import urlparse
+
+from ravencoin.rpc import (DEFAULT_HTTP_TIMEOUT, DEFAULT_USER_AGENT, JSONRPCError,
+                           Proxy, RavenProxy, _STALE_CONNECTION_ERRORS, _Replay,
+                           _ReplayingProxy, _batch_name, _count_errors, _get_service_url_and_authpair,
+                           _parse_response, _parse_result, get_rvn_conf)
+
+DEFAULT_POOL_SIZE = 4
+
+
+class AsyncBaseProxy(object):
+    """Base asyncio JSON-RPC proxy class. Contains only private methods; do
+    not use directly."""
+
+    def __init__(self,
+                 service_url=None,
+                 service_port=None,
+                 btc_conf_file=None,
+                 timeout=DEFAULT_HTTP_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 stats=None):
+
+        service_url, authpair = _get_service_url_and_authpair(service_url, service_port,
+                                                              btc_conf_file)
+
+        self.__service_url = service_url
+        self.__url = urlparse.urlparse(service_url)
+
+        if self.__url.scheme not in ('http',):
+            raise ValueError('Unsupported URL scheme %r' % self.__url.scheme)
+
+        if self.__url.port is None:
+            self.__port = httplib.HTTP_PORT
+        else:
+            self.__port = self.__url.port
+        self.__timeout = timeout
+        self.__id_count = itertools.count(1)
+
+        headers = [('Host', '%s:%d' % (self.__url.hostname, self.__port)),
+                   ('User-Agent', DEFAULT_USER_AGENT),
+                   ('Content-type', 'application/json')]
+        if authpair is not None:
+            authpair = authpair.encode('utf8')
+            headers.append(('Authorization', 'Basic ' + base64.b64encode(authpair).decode('ascii')))
+        self.__request_head = ('POST %s HTTP/1.1\r\n%s' %
+                               (self.__url.path or '/',
+                                ''.join('%s: %s\r\n' % h for h in headers))).encode('latin-1')
+
+        # Created on first use, so the proxy itself can be made outside of the
+        # event loop
+        self.__pool_size = pool_size
+        self.__slots = None
+        self.__idle = []
+        self.stats = stats
+
+    async def _request(self, postdata, timeout=None, parse=None, method=None):
+        """POST postdata on a pooled connection, returning the decoded JSON
+        response
+
+        timeout overrides the timeout of the proxy for this request.
+
+        parse, if given, decodes the response body instead of
+        _parse_response(). method names the request in the stats.
+        """
+        if self.__slots is None:
+            self.__slots = asyncio.Semaphore(self.__pool_size)
+        postdata = postdata.encode('utf8')
+        request = (self.__request_head +
+                   b'Content-Length: %d\r\n\r\n' % len(postdata) + postdata)
+
+        async with self.__slots:
+            # Most recently used first, like BaseProxy
+            conn = self.__idle.pop() if self.__idle else None
+            start = time.perf_counter()
+            try:
+                status, reason, data = await asyncio.wait_for(
+                    self.__exchange(conn, request),
+                    self.__timeout if timeout is None else timeout)
+            except BaseException:
+                # Also on timeouts and cancellation, as a half read response
+                # can't be reused
+                if conn is not None:
+                    conn[1].close()
+                if self.stats is not None:
+                    self.stats.record(method, start, None, time.perf_counter(),
+                                      len(postdata), 0, 1)
+                raise
+
+        parse = parse or _parse_response
+        if self.stats is None:
+            return parse(data, status, reason)
+        received = time.perf_counter()
+        errors = 1
+        try:
+            r = parse(data, status, reason)
+            errors = 0
+            return r
+        finally:
+            self.stats.record(method, start, received, time.perf_counter(),
+                              len(postdata), len(data), errors)
+
+    async def __exchange(self, conn, request):
+        # As in BaseProxy, a request is only resent on a new connection if
+        # the server closed the idle one, or if sending it failed; once sent
+        # the server may have run the call.
+        if conn is not None and (conn[0].at_eof() or conn[1].is_closing()):
+            conn[1].close()
+            conn = None
+        if conn is not None:
+            try:
+                await self.__send(conn, request)
+            except _STALE_CONNECTION_ERRORS:
+                conn[1].close()
+                conn = None
+        if conn is None:
+            conn = await asyncio.open_connection(self.__url.hostname, self.__port)
+            try:
+                await self.__send(conn, request)
+            except BaseException:
+                conn[1].close()
+                raise
+        try:
+            return await self.__receive(conn)
+        except BaseException:
+            conn[1].close()
+            raise
+
+    async def __send(self, conn, request):
+        reader, writer = conn
+        writer.write(request)
+        await writer.drain()
+
+    async def __receive(self, conn):
+        reader, writer = conn
+        line = await reader.readline()
+        if not line:
+            raise httplib.RemoteDisconnected('Remote end closed connection without response')
+        version, status, reason = (line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+
+        keep_alive = (version == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        if 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            data = b''.join(chunks)
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        if keep_alive:
+            self.__idle.append(conn)
+        else:
+            writer.close()
+        return int(status), reason, data
+
+    async def _acall(self, service_name, *args, timeout=None):
+        postdata = json.dumps({'version': '1.1',
+                               'method': service_name,
+                               'params': args,
+                               'id': next(self.__id_count)})
+
+        return await self._request(postdata, timeout, _parse_result, service_name)
+
+    async def _batch(self, rpc_call_list, timeout=None):
+        rpc_call_list = list(rpc_call_list)
+        postdata = json.dumps(rpc_call_list)
+        name = _batch_name(rpc_call_list)
+        response = await self._request(postdata, timeout, method=name)
+        if self.stats is not None and isinstance(response, list):
+            self.stats.record_errors(name, _count_errors(response))
+        return response
+
+    async def close(self):
+        """Close the idle connections of the pool"""
+        idle, self.__idle = self.__idle, []
+        for reader, writer in idle:
+            writer.close()
+        for reader, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncRawProxy(AsyncBaseProxy):
+    """Low-level asyncio proxy to a ravencoin JSON-RPC service
+
+    Like ``RawProxy``, no conversion is done besides parsing JSON; any method
+    can be called, and returns a coroutine.
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Prevent RPC calls for non-existing python internal attribute
+            # access, as in RawProxy.
+            raise AttributeError
+
+        f = lambda *args, **kwargs: self._acall(name, *args, **kwargs)
+        f.__name__ = name
+        return f
+
+
+def _async_method(method):
+    """Make an async version of a synchronous Proxy method
+
+    See _Replay; running the method body never awaits, so concurrent calls
+    can't see each others results.
+    """
+    @functools.wraps(method)
+    async def f(self, *args, **kwargs):
+        replay = _Replay(method, args, kwargs)
+        while True:
+            request = replay.step(self)
+            if request is None:
+                return replay.value
+            service_name, args = request
+            try:
+                replay.results.append(await self._acall(service_name, *args))
+            except JSONRPCError as err:
+                replay.results.append(err)
+    return f
+
+
+def _async_methods(sync_cls):
+    """Class decorator adding async versions of the methods of sync_cls
+
+    Methods the class defines itself are kept; private helpers are copied
+    as-is, for use by the method bodies.
+    """
+    def decorator(cls):
+        for name, value in vars(sync_cls).items():
+            if name.startswith('__') or name in vars(cls) or not callable(value):
+                continue
+            if name.startswith('_'):
+                setattr(cls, name, value)
+            else:
+                setattr(cls, name, _async_method(value))
+        return cls
+    return decorator
+
+
+@_async_methods(Proxy)
+class AsyncProxy(_ReplayingProxy, AsyncBaseProxy):
+    """asyncio proxy to a ravencoin RPC service
+
+    Has the methods of ``Proxy`` as coroutines, taking and returning the same
+    ``ravencoin.core`` objects.
+    """
+
+    def __init__(self,
+                 service_url=None,
+                 service_port=None,
+                 btc_conf_file=None,
+                 timeout=DEFAULT_HTTP_TIMEOUT,
+                 **kwargs):
+        """Create a proxy object
+
+        The arguments are those of ``Proxy``, except that ``pool_size``
+        defaults to DEFAULT_POOL_SIZE connections.
+        """
+        super(AsyncProxy, self).__init__(service_url=service_url,
+                                         service_port=service_port,
+                                         btc_conf_file=btc_conf_file,
+                                         timeout=timeout,
+                                         **kwargs)
+
+    async def call(self, service_name, *args, timeout=None):
+        """Call an RPC method by name and raw (JSON encodable) arguments
+
+        timeout - timeout in seconds for this call, instead of the one of
+                  the proxy
+        """
+        return await self._acall(service_name, *args, timeout=timeout)
+
+
+@_async_methods(RavenProxy)
+class AsyncRavenProxy(AsyncProxy):
+    """asyncio proxy with the Ravencoin specific methods of ``RavenProxy``"""
+
+    def __init__(self,
+                 service_url=None,
+                 service_port=None,
+                 rvn_conf_file=None,
+                 timeout=DEFAULT_HTTP_TIMEOUT,
+                 datadir=None,
+                 **kwargs):
+        """Create a proxy object
+
+        The arguments are those of ``RavenProxy``, except that ``pool_size``
+        defaults to DEFAULT_POOL_SIZE connections.
+        """
+        if service_url is None:
+            if rvn_conf_file is None:
+                rvn_conf_file = get_rvn_conf(datadir)
+
+        super(AsyncRavenProxy, self).__init__(service_url=service_url,
+                                              service_port=service_port,
+                                              btc_conf_file=rvn_conf_file,
+                                              timeout=timeout,
+                                              **kwargs)
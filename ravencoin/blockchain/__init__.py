@@ -13,19 +13,32 @@
 import os
 import mmap
 import struct
-import pickle
 import stat
 import plyvel
-import io
+import multiprocessing
+import queue
+from collections import deque, namedtuple
+from itertools import islice
 
-from ravencoin.core import CBlock
-from .index import DBBlockIndex
-from .utils import format_hash
+from ravencoin.core import CBlock, CBlockHeader, CLazyBlock, b2lx, lx
+from ravencoin.core.serialize import VarIntSerializer
+from .index import DBBlockIndex, iter_block_indexes, resolve_best_chain
+from .locations import BlockLocation, BlockLocationIndex
+from .undo import get_block_undo
 
 
 # Constant separating blocks in the .blk files
 RAVENCOIN_CONSTANT = b"\x52\x41\x56\x4e" # RAVN
 
+_BLOCK_SIZE = struct.Struct("<I")
+
+# How far below the cached tip get_block_locations() looks for reorgs
+CACHE_REFRESH_DEPTH = 100
+
+# Number of blocks each worker of a parallel scan decodes and sends back at
+# a time
+DEFAULT_SCAN_BATCH_SIZE = 500
+
 
 def get_files(path):
     """
@@ -40,31 +53,72 @@ def get_files(path):
     return sorted(files)
 
 
-def get_blocks(blockfile):
+class BlockFrame(namedtuple('BlockFrame', ['file', 'offset', 'size', 'data'])):
+    """A block located in a .blk file
+
+    offset is the position of the block data in file, i.e. just after the
+    magic bytes and size field, which is what the leveldb index stores as
+    data_pos. data is a memoryview of the mapped file and is only valid as
+    long as it is referenced; copy it with bytes() to keep the block.
+    """
+    __slots__ = ()
+
+
+def _map_file(f):
+    if os.name == 'nt':
+        size = os.path.getsize(f.name)
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    else:
+        # Unix-only call, will not work on Windows, see python doc.
+        return mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+
+
+def get_block_frames(blockfile, start=0):
     """
     Given the name of a .blk file, for every block contained in the file,
-    yields its raw hexadecimal value
+    yields a BlockFrame with its location and a zero-copy view of its data
+
+    Padding and corrupt regions are skipped by searching for the next
+    RAVENCOIN_CONSTANT rather than stepping over them byte by byte. start is
+    the position in the file from which to search for blocks.
     """
     with open(blockfile, "rb") as f:
-        if os.name == 'nt':
-            size = os.path.getsize(f.name)
-            raw_data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
-        else:
-            # Unix-only call, will not work on Windows, see python doc.
-            raw_data = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        raw_data = _map_file(f)
+        view = memoryview(raw_data)
         length = len(raw_data)
-        offset = 0
-        block_count = 0
-        while offset < (length - 4):
-            if raw_data[offset:offset+4] == RAVENCOIN_CONSTANT:
-                offset += 4
-                size = struct.unpack("<I", raw_data[offset:offset+4])[0]
-                offset += 4 + size
-                block_count += 1
-                yield raw_data[offset-size:offset]
-            else:
-                offset += 1
-        raw_data.close()
+        find = raw_data.find
+        offset = find(RAVENCOIN_CONSTANT, start)
+        try:
+            while 0 <= offset <= length - 8:
+                size, = _BLOCK_SIZE.unpack_from(raw_data, offset + 4)
+                start = offset + 8
+                end = start + size
+                if size == 0 or end > length:
+                    # Zeroed or truncated size field: not a real block,
+                    # resynchronize on the next magic
+                    offset = find(RAVENCOIN_CONSTANT, offset + 1)
+                    continue
+                yield BlockFrame(blockfile, start, size, view[start:end])
+                offset = find(RAVENCOIN_CONSTANT, end)
+        finally:
+            view.release()
+            try:
+                raw_data.close()
+            except BufferError:
+                # The caller still holds frames; the mapping is closed once
+                # the last of them is garbage collected.
+                pass
+
+
+def get_blocks(blockfile):
+    """
+    Given the name of a .blk file, for every block contained in the file,
+    yields its raw hexadecimal value
+    """
+    for frame in get_block_frames(blockfile):
+        yield frame.data.tobytes()
 
 
 def get_block(blockfile, offset):
@@ -75,6 +129,68 @@ def get_block(blockfile, offset):
         return f.read(size)
 
 
+def _decode_frame(frame, map_func, lazy):
+    """Deserializes the block of a BlockFrame, optionally passing it through
+    map_func
+    """
+    if lazy:
+        block = CLazyBlock.deserialize(frame.data)
+    else:
+        block = CBlock.buf_deserialize(frame.data)[0]
+    if map_func is not None:
+        block = map_func(block)
+    return block
+
+
+def _iter_file(blk_file, map_func=None, lazy=False):
+    """Deserializes every block of a single .blk file, optionally passing
+    it through map_func
+    """
+    for frame in get_block_frames(blk_file):
+        yield _decode_frame(frame, map_func, lazy)
+
+
+def _frame_batches(blk_files, batch_size):
+    """Yields (blk_file, offset, count) for consecutive runs of up to
+    batch_size blocks of the .blk files, offset being that of the first
+    block's data
+
+    Only the size fields of the blocks are read.
+    """
+    for blk_file in blk_files:
+        offset = count = 0
+        for frame in get_block_frames(blk_file):
+            if count == 0:
+                offset = frame.offset
+            count += 1
+            if count == batch_size:
+                yield blk_file, offset, count
+                count = 0
+        if count:
+            yield blk_file, offset, count
+
+
+def _scan_frames(args):
+    """Worker for the parallel scan of get_unordered_blocks(), decoding a
+    batch of _frame_batches()
+    """
+    blk_file, offset, count, map_func, lazy = args
+    # Searching from the magic bytes before the first block finds it first
+    frames = get_block_frames(blk_file, offset - 8)
+    try:
+        return [_decode_frame(frame, map_func, lazy) for frame in islice(frames, count)]
+    finally:
+        frames.close()
+
+
+def _batch_result(result):
+    """Return the blocks of a batch decoded by _scan_frames(), raising the
+    exception of the worker if it failed"""
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
 class Blockchain(object):
     """Represent the blockchain contained in the series of .blk files
     maintained by ravend.
@@ -82,142 +198,272 @@ class Blockchain(object):
 
     def __init__(self, path):
         self.path = path
-        self.blockIndexes = None
+        self.db = None
         self.indexPath = None
 
-    def get_unordered_blocks(self):
+    def get_unordered_blocks(self, processes=1, map_func=None, ordered=True, lazy=False,
+                             batch_size=DEFAULT_SCAN_BATCH_SIZE):
         """Yields the blocks contained in the .blk files as is,
         without ordering them according to height.
-        """
-        for blk_file in get_files(self.path):
-            for raw_block in get_blocks(blk_file):
-                yield CBlock.stream_deserialize(io.BytesIO(raw_block))
 
-    def __getBlockIndexes(self, index):
-        """There is no method of leveldb to close the db (and release the lock).
-        This creates problem during concurrent operations.
-        This function also provides caching of indexes.
+        processes - Number of worker processes the .blk files are spread
+                    across. 1 (the default) scans in the calling process,
+                    None uses os.cpu_count() workers.
+
+        map_func  - Optional function applied to every CBlock; its result is
+                    yielded instead of the block. With processes != 1 it runs
+                    in the workers, so it must be picklable (e.g. a module
+                    level function) and should return something smaller
+                    than the block to keep inter-process traffic down.
+
+        ordered   - When scanning in parallel, yield results in .blk file
+                    order (default) or as soon as each batch completes.
+                    Blocks within a batch are always in file order.
+
+        lazy      - Yield CLazyBlock instead of CBlock; transactions are
+                    only decoded when accessed. In the calling process the
+                    blocks reference the mapped .blk file without copying.
+
+        batch_size - When scanning in parallel, number of blocks a worker
+                    decodes and sends back at a time. At most two batches
+                    per worker are in flight, which bounds the memory used
+                    however slowly the blocks are consumed.
+        """
+        if processes == 1:
+            for blk_file in get_files(self.path):
+                for block in _iter_file(blk_file, map_func, lazy):
+                    yield block
+            return
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+        max_pending = 2 * processes
+        jobs = ((blk_file, offset, count, map_func, lazy) for blk_file, offset, count
+                in _frame_batches(get_files(self.path), batch_size))
+        with multiprocessing.Pool(processes) as pool:
+            if ordered:
+                pending = deque()
+                for job in jobs:
+                    pending.append(pool.apply_async(_scan_frames, (job,)))
+                    if len(pending) >= max_pending:
+                        for block in pending.popleft().get():
+                            yield block
+                while pending:
+                    for block in pending.popleft().get():
+                        yield block
+            else:
+                # Results, or the exceptions raised by the workers, in the
+                # order they complete
+                done = queue.Queue()
+                n_pending = 0
+                for job in jobs:
+                    pool.apply_async(_scan_frames, (job,),
+                                     callback=done.put, error_callback=done.put)
+                    n_pending += 1
+                    if n_pending >= max_pending:
+                        n_pending -= 1
+                        for block in _batch_result(done.get()):
+                            yield block
+                while n_pending:
+                    n_pending -= 1
+                    for block in _batch_result(done.get()):
+                        yield block
+
+    def _get_db(self, index):
+        """Returns the leveldb handle for the index at path index, opening
+        it on first use. The handle is kept open and shared between calls
+        until close() is called: leveldb has no read-only mode, so opening
+        it takes the database lock and reopening it for every call is slow.
         """
         if self.indexPath != index:
-            db = plyvel.DB(index, compression=None)
-            self.blockIndexes = [DBBlockIndex(format_hash(k[1:]), v)
-                                 for k, v in db.iterator() if k[0] == ord('b')]
-            db.close()
-            self.blockIndexes.sort(key=lambda x: x.height)
+            self.close()
+            self.db = plyvel.DB(index, create_if_missing=False, compression=None)
             self.indexPath = index
-        return self.blockIndexes
+        return self.db
 
-    def _index_confirmed(self, chain_indexes, num_confirmations=60):
-        """Check if the first block index in "chain_indexes" has at least
-        "num_confirmation" (60) blocks built on top of it.
-        If it doesn't it is not confirmed and is an orphan.
-        """
+    def close(self):
+        """Closes the leveldb index, releasing its lock"""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            self.indexPath = None
 
-        # chains holds a 2D list of sequential block hash chains
-        # as soon as there an element of length num_confirmations,
-        # we can make a decision about whether or not the block in question
-        # is confirmed by checking if it's hash is in that list
-        chains = []
-        # this is the block in question
-        first_block = None
-
-        # loop through all future blocks
-        for i, index in enumerate(chain_indexes):
-            # if this block doesn't have data don't confirm it
-            if index.file == -1 or index.data_pos == -1:
-                return False
-
-            # parse the block
-            blkFile = os.path.join(self.path, "blk%05d.dat" % index.file)
-            block = CBlock.stream_deserialize(io.BytesIO(get_block(blkFile, index.data_pos)))
-
-            if i == 0:
-                first_block = block
-
-            chains.append([block.GetHash()])
-
-            for chain in chains:
-                # if this block can be appended to an existing block in one
-                # of the chains, do it
-                if chain[-1] == block.hashPrevBlock:
-                    chain.append(block.GetHash())
-
-                # if we've found a chain length == num_dependencies (usually 60)
-                # we are ready to make a decesion on whether or not the block
-                # belongs to a fork or the main chain
-                if len(chain) == num_confirmations:
-                    if first_block.GetHash() in chain:
-                        return True
-                    else:
-                        return False
-
-    def get_ordered_blocks(self, index, start=0, end=None, cache=None):
-        """Yields the blocks contained in the .blk files as per
-        the heigt extract from the leveldb index present at path
-        index maintained by ravend.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def iter_block_indexes(self, index, min_height=0):
+        """Yields the DBBlockIndex of every block at or above min_height in
+        the leveldb index at path index, in key (not height) order.
+
+        Entries are read from a snapshot and decoded lazily; those below
+        min_height are skipped after decoding only their height.
         """
+        snapshot = self._get_db(index).snapshot()
+        try:
+            for blkIdx in iter_block_indexes(snapshot, min_height):
+                yield blkIdx
+        finally:
+            snapshot.close()
+
+    def _best_chain(self, blockIndexes):
+        # Nodes keep the blocks of stale branches in the leveldb index, e.g.
+        # when two solutions to a block were received at the same time, until
+        # they are "-reindex"ed. Only follow the chain leading to the tip.
+        return resolve_best_chain(blockIndexes)[0]
+
+    def get_stale_blocks(self, index):
+        """Returns the block indexes of blocks that are not part of the best
+        chain, i.e. the stale branches left by reorgs, sorted by height.
+        """
+        return resolve_best_chain(list(self.iter_block_indexes(index)))[1]
 
-        blockIndexes = None
-
-        if cache and os.path.exists(cache):
-            # load the block index cache from a previous index
-            with open(cache, 'rb') as f:
-                blockIndexes = pickle.load(f)
-
-        if blockIndexes is None:
-            # build the block index
-            blockIndexes = self.__getBlockIndexes(index)
-            if cache and not os.path.exists(cache):
-                # cache the block index for re-use next time
-                with open(cache, 'wb') as f:
-                    pickle.dump(blockIndexes, f, pickle.HIGHEST_PROTOCOL)
-
-        # remove small forks that may have occured while the node was live.
-        # Occassionally a node will receive two different solutions to a block
-        # at the same time. The Leveldb index saves both, not pruning the
-        # block that leads to a shorter chain once the fork is settled without
-        # "-reindex"ing the ravend block data. This leads to at least two
-        # blocks with the same height in the database.
-        # We throw out blocks that don't have at least 60 other blocks on top of
-        # it (60 confirmations).
-        orphans = []  # hold blocks that are orphans with < 60 blocks on top
-        last_height = -1
-        for i, blockIdx in enumerate(blockIndexes):
-            if last_height > -1:
-                # if this block is the same height as the last block an orphan
-                # occurred, now we have to figure out which of the two to keep
-                if blockIdx.height == last_height:
-
-                    # loop through future blocks until we find a chain 60 blocks
-                    # long that includes this block. If we can't find one
-                    # remove this block as it is invalid
-                    if self._index_confirmed(blockIndexes[i:]):
-
-                        # if this block is confirmed, the unconfirmed block is
-                        # the previous one. Remove it.
-                        orphans.append(blockIndexes[i - 1].hash)
-                    else:
-
-                        # if this block isn't confirmed, remove it.
-                        orphans.append(blockIndexes[i].hash)
-
-            last_height = blockIdx.height
-
-        # filter out the orphan blocks, so we are left only with block indexes
-        # that have been confirmed
-        # (or are new enough that they haven't yet been confirmed)
-        blockIndexes = list(filter(lambda block: block.hash not in orphans, blockIndexes))
+    def get_block_locations(self, index, cache):
+        """Returns a BlockLocationIndex of the best chain stored at path
+        cache, brought up to date with the leveldb index at path index.
 
+        Only the index entries near the cached tip are decoded; the cache is
+        rebuilt from scratch if it is missing, invalid, or the chain
+        reorganized deeper than CACHE_REFRESH_DEPTH blocks.
+        """
+        def with_data(chain):
+            # Blocks whose data hasn't been downloaded yet are left out so
+            # they get picked up by a later refresh.
+            for i, blkIdx in enumerate(chain):
+                if blkIdx.file == -1 or blkIdx.data_pos == -1:
+                    return chain[:i]
+            return chain
+
+        locations = BlockLocationIndex(cache)
+        if len(locations):
+            min_height = max(0, len(locations) - CACHE_REFRESH_DEPTH)
+            chain = self._best_chain(list(self.iter_block_indexes(index, min_height)))
+            try:
+                locations.update(with_data(chain))
+                return locations
+            except ValueError:
+                pass
+        locations.update(with_data(self._best_chain(list(self.iter_block_indexes(index)))))
+        return locations
+
+    def _ordered_indexes(self, index, start, end, cache):
+        """Yields the block indexes of the best chain for heights start to
+        end, see get_ordered_blocks()
+        """
+        if cache:
+            blockIndexes = self.get_block_locations(index, cache)
+            first = 0
+        else:
+            # Only the part of the chain that is iterated needs to be
+            # resolved, unless counting from the tip.
+            min_height = 0
+            if start >= 0 and (end is None or end >= 0):
+                min_height = start if end is None else min(start, end)
+            blockIndexes = self._best_chain(list(self.iter_block_indexes(index, min_height)))
+            first = blockIndexes[0].height if blockIndexes else 0
+
+        length = first + len(blockIndexes)
         if end is None:
-            end = len(blockIndexes)
+            end = length
 
+        heights = range(length)
         if end < start:
-            blockIndexes = list(reversed(blockIndexes))
-            start = len(blockIndexes) - start
-            end = len(blockIndexes) - end
+            heights = heights[::-1]
+            start = length - start
+            end = length - end
+
+        for height in heights[start:end]:
+            yield blockIndexes[height - first]
+
+    def get_ordered_blocks(self, index, start=0, end=None, cache=None, lazy=False,
+                           verify=False, with_index=False):
+        """Yields the blocks contained in the .blk files as per
+        the heigt extract from the leveldb index present at path index
+        maintained by ravend.
+
+        If cache is given, it is the path of a BlockLocationIndex that
+        persists the block locations between runs. It is refreshed from the
+        leveldb index on every call, appending new tip blocks.
+
+        If lazy is True CLazyBlock objects are yielded, whose transactions
+        are only decoded when accessed.
 
-        for blkIdx in blockIndexes[start:end]:
+        The block hashes are taken from the index, so GetHash() doesn't
+        compute the PoW hash of blocks ravend already validated. If verify
+        is True they are recomputed instead, raising ValueError if one
+        doesn't match the index.
+
+        If with_index is True (block index, block) pairs are yielded, giving
+        access to the height and transaction count of each block; the index
+        is a DBBlockIndex, or a BlockLocation if cache is given.
+        """
+        for blkIdx in self._ordered_indexes(index, start, end, cache):
             if blkIdx.file == -1 or blkIdx.data_pos == -1:
                 break
             blkFile = os.path.join(self.path, "blk%05d.dat" % blkIdx.file)
-            yield CBlock.stream_deserialize(io.BytesIO(get_block(blkFile, blkIdx.data_pos)))
+            raw_block = get_block(blkFile, blkIdx.data_pos)
+            if lazy:
+                block = CLazyBlock.deserialize(raw_block)
+            else:
+                block = CBlock.buf_deserialize(raw_block)[0]
+            if verify:
+                if b2lx(block.GetHash()) != blkIdx.hash:
+                    raise ValueError('block at height %d hashes to %s, index has %s' %
+                                     (blkIdx.height, b2lx(block.GetHash()), blkIdx.hash))
+            else:
+                # The cached hash slot of immutable blocks, see GetHash()
+                object.__setattr__(block, '_cached_GetHash', lx(blkIdx.hash))
+            if with_index:
+                yield blkIdx, block
+            else:
+                yield block
+
+    def get_ordered_blocks_undo(self, index, start=0, end=None, cache=None, lazy=False,
+                                verify=False):
+        """Yields (block, undo) for the blocks of the best chain, like
+        get_ordered_blocks(), with the outputs the block spends read from the
+        .rev files.
+
+        undo holds, for every transaction but the coinbase, the list of Coin
+        spent by its inputs; see undo.iter_prevouts(). If verify is True the
+        checksums of the undo data are checked as well.
+
+        Iteration stops at the first block without undo data, i.e. one that
+        ravend has stored but not connected yet.
+        """
+        for blkIdx, block in self.get_ordered_blocks(index, start, end, cache, lazy, verify,
+                                                     with_index=True):
+            if blkIdx.undo_pos == -1:
+                if blkIdx.height == 0:
+                    # ravend writes no undo data for the genesis block
+                    yield block, []
+                    continue
+                break
+            revFile = os.path.join(self.path, "rev%05d.dat" % blkIdx.file)
+            prev_hash = block.hashPrevBlock if verify else None
+            yield block, get_block_undo(revFile, blkIdx.undo_pos, prev_hash)
+
+    def get_ordered_headers(self, index, start=0, end=None):
+        """Yields (CBlockHeader, n_tx) for the blocks of the best chain, like
+        get_ordered_blocks() does for blocks.
+
+        The headers are the copies stored in the leveldb index, so no .blk
+        file is read; headers of blocks whose data isn't available are
+        included too.
+        """
+        for blkIdx in self._ordered_indexes(index, start, end, None):
+            yield blkIdx.get_header(), blkIdx.n_tx
+
+    def get_unordered_headers(self):
+        """Yields (CBlockHeader, n_tx) for the blocks contained in the .blk
+        files as is, without ordering them according to height.
+
+        Only the header and the transaction count are decoded; the
+        transactions are skipped.
+        """
+        for blk_file in get_files(self.path):
+            for frame in get_block_frames(blk_file):
+                header, pos = CBlockHeader.buf_deserialize(frame.data)
+                yield header, VarIntSerializer.buf_deserialize(frame.data, pos)[0]
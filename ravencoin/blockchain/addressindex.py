@@ -0,0 +1,296 @@
+# Copyright (C) 2020 The ravencoin-blockchain-parser developers
+#
+# This file is part of ravencoin-blockchain-parser.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of ravencoin-blockchain-parser, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import struct
+from collections import Counter, namedtuple
+
+import plyvel
+
+from ravencoin.core.assets import get_script_asset
+from ravencoin.core.script import CScript
+from ravencoin.wallet import (CRavencoinAddress, CRavencoinAddressError,
+                              P2PKHRavencoinAddress, P2SHRavencoinAddress)
+from .undo import iter_prevouts
+
+# Address types, as in ravend's address index
+ADDRESS_P2PKH = 1
+ADDRESS_P2SH = 2
+
+# How many of the last blocks keep the records needed to roll them back
+ROLLBACK_DEPTH = 100
+
+# Layout of the leveldb database, all integers big-endian so keys sort by
+# height:
+#   b'a' + address type + hash160 + height + tx index + index + spending flag
+#       -> txid, value, then asset name length, name and amount if any
+#   b'u' + height -> block hash, previous block hash, keys of the block's
+#       entries; kept for the blocks that can be rolled back
+#   b't' -> height and hash of the last indexed block
+_ENTRY_KEY = struct.Struct(">c21sIII?")
+_ENTRY_VALUE = struct.Struct("<32sqB")
+_ASSET_AMOUNT = struct.Struct("<q")
+_HEIGHT = struct.Struct(">I")
+_TIP = struct.Struct("<i32s")
+
+
+class AddressIndexEntry(namedtuple('AddressIndexEntry',
+                                   ['height', 'tx_index', 'index', 'spending', 'txid',
+                                    'value', 'asset'])):
+    """An output paying to an address, or an input spending one
+
+    index is the position of the output in the transaction, or of the input
+    if spending is True. value is the amount in satoshis, negative for
+    inputs; asset is (asset name, amount) or None, the amount also negative
+    for inputs.
+    """
+    __slots__ = ()
+
+
+def script_address_key(scriptPubKey):
+    """Returns the address type and hash160 a scriptPubKey pays to, or None
+
+    The P2PKH and P2SH scripts, with or without asset data, are matched
+    directly; other scripts go through CRavencoinAddress.from_scriptPubKey().
+    """
+    size = len(scriptPubKey)
+    if size >= 25 and scriptPubKey[:3] == b'\x76\xa9\x14' and scriptPubKey[23:25] == b'\x88\xac' \
+            and (size == 25 or scriptPubKey[25] == 0xc0):
+        return ADDRESS_P2PKH, bytes(scriptPubKey[3:23])
+    if size >= 23 and scriptPubKey[:2] == b'\xa9\x14' and scriptPubKey[22] == 0x87 \
+            and (size == 23 or scriptPubKey[23] == 0xc0):
+        return ADDRESS_P2SH, bytes(scriptPubKey[2:22])
+    try:
+        address = CRavencoinAddress.from_scriptPubKey(CScript(scriptPubKey))
+    except (CRavencoinAddressError, ValueError):
+        return None
+    return address_key(address)
+
+
+def address_key(address):
+    """Returns the address type and hash160 of an address, given as a string,
+    CRavencoinAddress or scriptPubKey
+    """
+    if isinstance(address, P2PKHRavencoinAddress):
+        return ADDRESS_P2PKH, bytes(address)
+    if isinstance(address, P2SHRavencoinAddress):
+        return ADDRESS_P2SH, bytes(address)
+    if isinstance(address, str):
+        return address_key(CRavencoinAddress(address))
+    key = script_address_key(address)
+    if key is None:
+        raise CRavencoinAddressError('scriptPubKey is not in a recognized address format')
+    return key
+
+
+class AddressIndex(object):
+    """Index of the outputs and inputs of every address, stored in a
+    leveldb database at path
+
+    Build and extend it with update(); entries are sorted by address and
+    height, so looking up an address reads only its own entries.
+
+    spends    - Also index the inputs spending the outputs of addresses.
+                Their scripts come from the undo data in the .rev files, see
+                Blockchain.get_ordered_blocks_undo(). Must be the same every
+                time an index is updated.
+
+    Only the last ROLLBACK_DEPTH blocks can be rolled back in a reorg.
+    """
+
+    def __init__(self, path, spends=True):
+        self.path = path
+        self.spends = spends
+        self.db = plyvel.DB(path, create_if_missing=True)
+
+    def close(self):
+        """Closes the database, releasing its lock"""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def tip(self):
+        """(height, hash) of the last indexed block, (-1, None) if empty"""
+        tip = self.db.get(b't')
+        if tip is None:
+            return -1, None
+        return _TIP.unpack(tip)
+
+    def _block_entries(self, height, block, undo):
+        """Yields (key, value) for every entry of the block"""
+        for tx_index, tx in enumerate(block.vtx):
+            txid = tx.GetTxid()
+            for n, txout in enumerate(tx.vout):
+                key = script_address_key(txout.scriptPubKey)
+                if key is not None:
+                    yield self._entry(key, height, tx_index, n, False, txid, txout.nValue,
+                                      txout.scriptPubKey)
+        if undo is None:
+            return
+        tx_index = 0
+        last_tx = None
+        for tx, txin, coin in iter_prevouts(block, undo):
+            if tx is not last_tx:
+                tx_index += 1
+                n = 0
+                last_tx = tx
+                txid = tx.GetTxid()
+            key = script_address_key(coin.scriptPubKey)
+            if key is not None:
+                yield self._entry(key, height, tx_index, n, True, txid, -coin.nValue,
+                                  coin.scriptPubKey)
+            n += 1
+
+    def _entry(self, address, height, tx_index, n, spending, txid, value, scriptPubKey):
+        addr_type, hash160 = address
+        key = _ENTRY_KEY.pack(b'a', bytes([addr_type]) + hash160, height, tx_index, n, spending)
+        asset = get_script_asset(scriptPubKey)
+        if asset is None:
+            return key, _ENTRY_VALUE.pack(txid, value, 0)
+        name = asset[0].encode('ascii')
+        amount = -asset[1] if spending else asset[1]
+        return key, _ENTRY_VALUE.pack(txid, value, len(name)) + name + _ASSET_AMOUNT.pack(amount)
+
+    def connect_block(self, block, undo=None):
+        """Adds the entries of the block after the tip
+
+        undo is the block's undo data, needed if spends are indexed.
+
+        Raises ValueError if the block doesn't build on the tip.
+        """
+        height, tip_hash = self.tip
+        if tip_hash is not None and block.hashPrevBlock != tip_hash:
+            raise ValueError('block does not build on the tip of the index')
+        if self.spends and undo is None:
+            raise ValueError('undo data is needed to index spends')
+        height += 1
+        block_hash = block.GetHash()
+
+        keys = []
+        with self.db.write_batch(transaction=True) as wb:
+            for key, value in self._block_entries(height, block, undo if self.spends else None):
+                wb.put(key, value)
+                keys.append(key)
+            wb.put(b'u' + _HEIGHT.pack(height), block_hash + block.hashPrevBlock + b''.join(keys))
+            if height >= ROLLBACK_DEPTH:
+                wb.delete(b'u' + _HEIGHT.pack(height - ROLLBACK_DEPTH))
+            wb.put(b't', _TIP.pack(height, block_hash))
+
+    def rollback(self, height):
+        """Removes the blocks from height up, making the block below it the
+        tip
+
+        Raises ValueError if a block to remove is too deep to roll back.
+        """
+        tip_height, tip_hash = self.tip
+        records = []
+        for h in range(tip_height, height - 1, -1):
+            record = self.db.get(b'u' + _HEIGHT.pack(h))
+            if record is None:
+                raise ValueError('block at height %d is too deep to roll back' % h)
+            records.append((h, record))
+        with self.db.write_batch(transaction=True) as wb:
+            for h, record in records:
+                for pos in range(64, len(record), _ENTRY_KEY.size):
+                    wb.delete(record[pos:pos + _ENTRY_KEY.size])
+                wb.delete(b'u' + _HEIGHT.pack(h))
+            if records:
+                if height == 0:
+                    wb.delete(b't')
+                else:
+                    wb.put(b't', _TIP.pack(height - 1, records[-1][1][32:64]))
+
+    def _fork_height(self, blockchain, index):
+        """Returns the height from which the index differs from the best
+        chain of the leveldb block index at path index
+
+        Raises ValueError if they differ below the blocks that can be rolled
+        back.
+        """
+        tip_height, tip_hash = self.tip
+        low = max(0, tip_height - ROLLBACK_DEPTH + 1)
+        fork = low
+        for height, (header, n_tx) in enumerate(
+                blockchain.get_ordered_headers(index, start=low, end=tip_height + 1), low):
+            record = self.db.get(b'u' + _HEIGHT.pack(height))
+            if record[:32] != header.GetHash():
+                if height == low and low > 0 and record[32:64] != header.hashPrevBlock:
+                    raise ValueError('index diverges from the chain below height %d, '
+                                     'it needs to be rebuilt' % low)
+                return height
+            fork = height + 1
+        return fork
+
+    def update(self, blockchain, index, cache=None):
+        """Brings the index up to date with the best chain of blockchain, a
+        Blockchain, given the path of its leveldb block index
+
+        Blocks of the index that left the best chain are rolled back first.
+        cache is passed to Blockchain.get_ordered_blocks().
+
+        Returns the number of blocks added.
+        """
+        tip_height, tip_hash = self.tip
+        fork = self._fork_height(blockchain, index)
+        if fork <= tip_height:
+            self.rollback(fork)
+
+        if self.spends:
+            blocks = blockchain.get_ordered_blocks_undo(index, start=fork, cache=cache)
+        else:
+            blocks = ((block, None) for block in
+                      blockchain.get_ordered_blocks(index, start=fork, cache=cache))
+        n = 0
+        for block, undo in blocks:
+            self.connect_block(block, undo)
+            n += 1
+        return n
+
+    def get(self, address, start=0, end=None):
+        """Returns the AddressIndexEntry list of an address, in chain order
+
+        address is a string, CRavencoinAddress or scriptPubKey. start and end
+        limit the heights of the entries returned, end being exclusive.
+        """
+        addr_type, hash160 = address_key(address)
+        prefix = b'a' + bytes([addr_type]) + hash160
+        stop = prefix + (_HEIGHT.pack(end) if end is not None else b'\xff' * 4)
+        entries = []
+        for key, value in self.db.iterator(start=prefix + _HEIGHT.pack(start), stop=stop):
+            _, _, height, tx_index, n, spending = _ENTRY_KEY.unpack(key)
+            txid, amount, name_length = _ENTRY_VALUE.unpack_from(value)
+            asset = None
+            if name_length:
+                end_name = _ENTRY_VALUE.size + name_length
+                asset = (value[_ENTRY_VALUE.size:end_name].decode('ascii'),
+                         _ASSET_AMOUNT.unpack_from(value, end_name)[0])
+            entries.append(AddressIndexEntry(height, tx_index, n, spending, txid, amount, asset))
+        return entries
+
+    def balance(self, address):
+        """Returns the RVN balance of an address, which needs spends to be
+        indexed"""
+        return sum(entry.value for entry in self.get(address))
+
+    def asset_balances(self, address):
+        """Returns a Counter of the asset balances of an address, which
+        needs spends to be indexed"""
+        totals = Counter()
+        for entry in self.get(address):
+            if entry.asset is not None:
+                totals[entry.asset[0]] += entry.asset[1]
+        return +totals
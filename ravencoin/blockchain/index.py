@@ -1,20 +1,28 @@
+from binascii import unhexlify
 from struct import unpack
 
+from ravencoin.core import CBlockHeader
+from ravencoin.core.serialize import uint256_from_compact
 from .utils import format_hash
 
 BLOCK_HAVE_DATA = 8
 BLOCK_HAVE_UNDO = 16
+BLOCK_FAILED_VALID = 32
+BLOCK_FAILED_CHILD = 64
+BLOCK_FAILED_MASK = BLOCK_FAILED_VALID | BLOCK_FAILED_CHILD
 
 
-def _read_varint(raw_hex):
+def _read_varint(raw_hex, pos=0):
     """
     Reads the weird format of VarInt present in src/serialize.h of raven core
     and being used for storing data in the leveldb.
     This is not the VARINT format described for general ravencoin serialization
     use.
+
+    Returns the value and the position after it, i.e. its length when
+    reading from the start.
     """
     n = 0
-    pos = 0
     while True:
         data = raw_hex[pos]
         pos += 1
@@ -24,6 +32,14 @@ def _read_varint(raw_hex):
         n += 1
 
 
+def _read_height(raw_hex):
+    """Reads only the height of a serialized block index, which is much
+    cheaper than building a DBBlockIndex when most entries get discarded.
+    """
+    _, pos = _read_varint(raw_hex)
+    return _read_varint(raw_hex[pos:])[0]
+
+
 class DBBlockIndex(object):
     def __init__(self, blk_hash, raw_hex):
         self.hash = blk_hash
@@ -50,15 +66,112 @@ class DBBlockIndex(object):
         if self.status & BLOCK_HAVE_UNDO:
             self.undo_pos, i = _read_varint(raw_hex[pos:])
             pos += i
+        else:
+            self.undo_pos = -1
 
-        assert(pos + 80 == len(raw_hex))
-        self.version, p, m, time, bits, self.nonce = unpack(
-            "<I32s32sIII",
-            raw_hex[-80:]
+        # KAWPOW era entries store nNonce64 and mix_hash in place of nNonce
+        assert(len(raw_hex) - pos in (80, 116))
+        self.version, p, m, self.time, self.bits = unpack(
+            "<I32s32sII",
+            raw_hex[pos:pos+76]
         )
+        if len(raw_hex) - pos == 80:
+            self.nonce, = unpack("<I", raw_hex[pos+76:])
+            self.nonce64 = 0
+            self.mix_hash = b''
+        else:
+            self.nonce = 0
+            self.nonce64, self.mix_hash = unpack("<Q32s", raw_hex[pos+76:])
         self.prev_hash = format_hash(p)
         self.merkle_root = format_hash(m)
 
+    def get_header(self):
+        """Returns the block header stored in the index as a CBlockHeader
+
+        Its hash is set from the index, so GetHash() is free.
+        """
+        header = CBlockHeader(nVersion=self.version,
+                              hashPrevBlock=unhexlify(self.prev_hash)[::-1],
+                              hashMerkleRoot=unhexlify(self.merkle_root)[::-1],
+                              nTime=self.time,
+                              nBits=self.bits,
+                              nNonce=self.nonce,
+                              nHeight=self.height if self.mix_hash else 0,
+                              nonce64=self.nonce64,
+                              mix_hash=self.mix_hash)
+        object.__setattr__(header, '_cached_GetHash', unhexlify(self.hash)[::-1])
+        return header
+
     def __repr__(self):
         return "DBBlockIndex(%s, height=%d, file_no=%d, file_pos=%d)" \
                % (self.hash, self.height, self.file, self.data_pos)
+
+
+def iter_block_indexes(db, min_height=0):
+    """
+    Yields a DBBlockIndex for every block index entry in db (a plyvel DB,
+    snapshot or prefixed DB) at or above min_height.
+
+    Entries are stored by hash, so all keys are visited, but entries below
+    min_height are skipped after decoding just their height.
+    """
+    for k, v in db.iterator(prefix=b'b'):
+        if min_height and _read_height(v) < min_height:
+            continue
+        yield DBBlockIndex(format_hash(k[1:]), v)
+
+
+def block_proof(bits):
+    """Returns the work of a block with target nBits, as raven core's
+    GetBlockProof(): 2**256 / (target + 1), 0 for invalid targets
+    """
+    if bits & 0x00800000:
+        # negative
+        return 0
+    target = uint256_from_compact(bits)
+    if target == 0 or target >= 2**256:
+        return 0
+    return 2**256 // (target + 1)
+
+
+def resolve_best_chain(block_indexes):
+    """
+    Splits block indexes into the best chain and the blocks of stale
+    branches, returning (chain, stale), both sorted by height.
+
+    The tip is the block with data that isn't marked as failed with the most
+    chain work, summed from the nBits of the blocks; the chain is found by
+    following prev_hash links back from it. If the indexes only cover the
+    top of the block tree, work is counted from the lowest blocks present
+    and the chain stops at the lowest block.
+
+    Tips with equal work are decided by height, then by the lowest hash.
+    ravend keeps the tip it received first, which the index doesn't record,
+    so the result may differ from the node's during such a race; it doesn't
+    depend on the order of block_indexes though.
+    """
+    block_indexes = sorted(block_indexes, key=lambda x: x.height)
+    by_hash = {}
+    chain_work = {}
+    tip = None
+    tip_key = None
+    for blkIdx in block_indexes:
+        by_hash[blkIdx.hash] = blkIdx
+        work = chain_work.get(blkIdx.prev_hash, 0) + block_proof(blkIdx.bits)
+        chain_work[blkIdx.hash] = work
+        if blkIdx.status & BLOCK_FAILED_MASK or not blkIdx.status & BLOCK_HAVE_DATA:
+            continue
+        key = (work, blkIdx.height)
+        if tip is None or key > tip_key or (key == tip_key and blkIdx.hash < tip.hash):
+            tip = blkIdx
+            tip_key = key
+
+    chain = []
+    while tip is not None:
+        chain.append(tip)
+        tip = by_hash.pop(tip.prev_hash, None)
+    chain.reverse()
+
+    in_chain = set(blkIdx.hash for blkIdx in chain)
+    stale = [blkIdx for blkIdx in block_indexes if blkIdx.hash not in in_chain]
+    return chain, stale
@@ -0,0 +1,220 @@
+# Copyright (C) 2020 The ravencoin-blockchain-parser developers
+#
+# This file is part of ravencoin-blockchain-parser.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of ravencoin-blockchain-parser, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import os
+import mmap
+import struct
+from binascii import unhexlify
+from collections import namedtuple
+
+from .utils import format_hash
+
+# File layout: a fixed header followed by one fixed-width record per block of
+# the best chain, in height order starting at the genesis block. Hashes are
+# stored in internal (little-endian) byte order, as in the leveldb keys.
+_MAGIC = b"RVNBLKLX"
+_VERSION = 1
+_HEADER = struct.Struct("<8sII")
+# height, hash, file, data_pos, undo_pos, n_tx
+_RECORD = struct.Struct("<I32siiiI")
+
+
+class BlockLocation(namedtuple('BlockLocation',
+                               ['height', 'hash', 'file', 'data_pos', 'undo_pos', 'n_tx'])):
+    """Location of a block of the best chain in the .blk/.rev files
+
+    hash is the hex string shown by ravend, like DBBlockIndex.hash
+    """
+    __slots__ = ()
+
+
+def _hash_to_bytes(blk_hash):
+    if isinstance(blk_hash, str):
+        return unhexlify(blk_hash)[::-1]
+    return bytes(blk_hash)
+
+
+class BlockLocationIndex(object):
+    """Compact on-disk table of block locations, indexed by height
+
+    The table is memory mapped; records are only unpacked when accessed, so
+    opening it takes constant time regardless of chain length. It behaves as
+    a sequence of BlockLocation where position equals height.
+
+    Use update() to bring it in line with the leveldb block index: only the
+    records past the fork point with the cached chain are rewritten.
+
+    Lookups by hash use a dict of the heights by hash, built on the first
+    one and kept up to date by update().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._count = 0
+        self._heights = None
+        self._open()
+
+    def _open(self):
+        self.close()
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                return
+            if os.name == 'nt':
+                raw_data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            else:
+                raw_data = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        magic, version, record_size = _HEADER.unpack_from(raw_data, 0)
+        if magic != _MAGIC or version != _VERSION or record_size != _RECORD.size:
+            # Not ours (e.g. an old pickle cache) or an older format; it will
+            # be rebuilt by the next update()
+            raw_data.close()
+            return
+        self._map = raw_data
+        # A trailing partial record can only come from an interrupted write
+        self._count = (size - _HEADER.size) // _RECORD.size
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._count = 0
+        self._heights = None
+
+    def __len__(self):
+        return self._count
+
+    def _unpack(self, height):
+        if not 0 <= height < self._count:
+            raise IndexError('height %d not in block location index' % height)
+        return _RECORD.unpack_from(self._map, _HEADER.size + height * _RECORD.size)
+
+    def __getitem__(self, height):
+        if height < 0:
+            height += self._count
+        height_, blk_hash, blk_file, data_pos, undo_pos, n_tx = self._unpack(height)
+        return BlockLocation(height_, format_hash(blk_hash), blk_file, data_pos,
+                             undo_pos, n_tx)
+
+    def __iter__(self):
+        for height in range(self._count):
+            yield self[height]
+
+    def hash_at(self, height):
+        """Return the hash of the block at height, as raw bytes"""
+        return self._unpack(height)[1]
+
+    def height_of(self, blk_hash):
+        """Return the height of the block with the given hash
+
+        blk_hash may be a hex string or bytes in internal byte order.
+
+        Raises KeyError if the block is not part of the indexed chain.
+        """
+        if self._heights is None:
+            self._heights = self._read_heights()
+        try:
+            return self._heights[_hash_to_bytes(blk_hash)]
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(blk_hash)
+
+    def _read_heights(self):
+        """Return a dict of the heights of the indexed blocks by hash"""
+        if self._map is None:
+            return {}
+        end = _HEADER.size + self._count * _RECORD.size
+        with memoryview(self._map) as view:
+            return {record[1]: record[0]
+                    for record in _RECORD.iter_unpack(view[_HEADER.size:end])}
+
+    def get_by_hash(self, blk_hash):
+        """Return the BlockLocation of the block with the given hash"""
+        return self[self.height_of(blk_hash)]
+
+    def __contains__(self, blk_hash):
+        try:
+            self.height_of(blk_hash)
+        except KeyError:
+            return False
+        return True
+
+    def fork_height(self, chain):
+        """Return the first height at which chain differs from the index
+
+        chain is a height ordered sequence of block indexes (anything with
+        height and hash attributes, hash as a hex string), which may start
+        above height 0.
+        """
+        if not chain:
+            return self._count
+        first = chain[0].height
+        height = min(self._count, first + len(chain))
+        while height > first and \
+                self.hash_at(height - 1) != _hash_to_bytes(chain[height - 1 - first].hash):
+            height -= 1
+        return height
+
+    def update(self, chain):
+        """Make the index match chain, appending and rewriting as needed
+
+        chain is a height ordered sequence of block indexes of the best chain,
+        starting at or below the current tip. Records past the fork point
+        between the index and chain are replaced, so a reorg only rewrites the
+        blocks that changed.
+
+        Returns the height from which records were rewritten.
+
+        Raises ValueError if chain starts above the current tip or if the
+        index diverges from chain below its first block; a full chain starting
+        at height 0 is needed in that case.
+        """
+        first = chain[0].height if chain else 0
+        if first > self._count:
+            raise ValueError('chain starts at height %d, above index tip %d' %
+                             (first, self._count))
+        fork = self.fork_height(chain)
+        if fork == first and 0 < first < self._count:
+            # chain[0] differs from the index: the fork is exactly there only
+            # if chain[0] builds on our block below it.
+            prev_hash = getattr(chain[0], 'prev_hash', None)
+            if prev_hash is None or \
+                    _hash_to_bytes(prev_hash) != self.hash_at(first - 1):
+                raise ValueError('chain diverges from index below height %d' % first)
+
+        records = []
+        for blkIdx in chain[fork - first:]:
+            records.append(_RECORD.pack(blkIdx.height, _hash_to_bytes(blkIdx.hash),
+                                        blkIdx.file, blkIdx.data_pos, blkIdx.undo_pos,
+                                        blkIdx.n_tx))
+
+        heights = self._heights
+        if heights is not None:
+            for height in range(fork, self._count):
+                heights.pop(self.hash_at(height), None)
+            for height, record in enumerate(records, fork):
+                heights[_RECORD.unpack(record)[1]] = height
+
+        valid = self._map is not None
+        self.close()
+        with open(self.path, "r+b" if valid else "wb") as f:
+            if not valid:
+                f.write(_HEADER.pack(_MAGIC, _VERSION, _RECORD.size))
+            f.truncate(_HEADER.size + fork * _RECORD.size)
+            f.seek(0, os.SEEK_END)
+            f.write(b"".join(records))
+        self._open()
+        self._heights = heights
+        return fork
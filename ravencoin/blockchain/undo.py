@@ -0,0 +1,139 @@
+# Copyright (C) 2020 The ravencoin-blockchain-parser developers
+#
+# This file is part of ravencoin-blockchain-parser.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of ravencoin-blockchain-parser, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import struct
+
+from ravencoin.core import Hash, b2lx
+from ravencoin.core.script import CScript
+from ravencoin.core.serialize import VarIntSerializer
+from ravencoin.utxo import Coin
+from .index import _read_varint
+
+_UNDO_SIZE = struct.Struct("<I")
+
+# Field prime of secp256k1, for decompressing public keys
+_SECP256K1_P = 2**256 - 2**32 - 977
+
+
+def decompress_amount(x):
+    """Reverses the amount compression of raven core's CTxOutCompressor"""
+    if x == 0:
+        return 0
+    x -= 1
+    e = x % 10
+    x //= 10
+    if e < 9:
+        d = x % 9 + 1
+        x //= 9
+        n = x * 10 + d
+    else:
+        n = x + 1
+    return n * 10**e
+
+
+def _decompress_pubkey(prefix, x):
+    n = int.from_bytes(x, 'big')
+    y = pow((pow(n, 3, _SECP256K1_P) + 7) % _SECP256K1_P, (_SECP256K1_P + 1) // 4, _SECP256K1_P)
+    if y & 1 != prefix & 1:
+        y = _SECP256K1_P - y
+    return b'\x04' + x + y.to_bytes(32, 'big')
+
+
+def _read_script(buf, pos):
+    """Reads a script compressed by raven core's CScriptCompressor, which
+    stores the common script types without their opcodes
+    """
+    n_size, pos = _read_varint(buf, pos)
+    if n_size == 0:
+        # P2PKH
+        script = b'\x76\xa9\x14' + bytes(buf[pos:pos+20]) + b'\x88\xac'
+        return CScript(script), pos + 20
+    elif n_size == 1:
+        # P2SH
+        return CScript(b'\xa9\x14' + bytes(buf[pos:pos+20]) + b'\x87'), pos + 20
+    elif n_size in (2, 3):
+        # P2PK, compressed key
+        return CScript(b'\x21' + bytes([n_size]) + bytes(buf[pos:pos+32]) + b'\xac'), pos + 32
+    elif n_size in (4, 5):
+        # P2PK, uncompressed key stored compressed
+        pubkey = _decompress_pubkey(n_size, bytes(buf[pos:pos+32]))
+        return CScript(b'\x41' + pubkey + b'\xac'), pos + 32
+    n_size -= 6
+    return CScript(bytes(buf[pos:pos+n_size])), pos + n_size
+
+
+def read_coin(buf, pos=0):
+    """Reads a spent output as serialized in the undo data, returning
+    (Coin, position after it)
+    """
+    code, pos = _read_varint(buf, pos)
+    if code >> 1:
+        # Dummy transaction version kept for compatibility
+        _, pos = _read_varint(buf, pos)
+    amount, pos = _read_varint(buf, pos)
+    script, pos = _read_script(buf, pos)
+    return Coin(decompress_amount(amount), script, code >> 1, bool(code & 1)), pos
+
+
+def deserialize_block_undo(buf):
+    """Deserializes the undo data of a block
+
+    Returns, for every transaction of the block but the coinbase, the list
+    of Coin spent by its inputs, in input order. This is the format
+    ravencoin.utxo.UtxoSet.connect_block() returns. The asset undo data that
+    ravend appends is ignored.
+    """
+    buf = memoryview(buf)
+    n_tx, pos = VarIntSerializer.buf_deserialize(buf, 0)
+    undo = []
+    for i in range(n_tx):
+        n_coins, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        coins = []
+        for j in range(n_coins):
+            coin, pos = read_coin(buf, pos)
+            coins.append(coin)
+        undo.append(coins)
+    return undo
+
+
+def get_block_undo(revfile, offset, prev_hash=None):
+    """Extracts the undo data of a block from the revfile at the given
+    offset, the undo_pos of the leveldb index, and deserializes it
+
+    If prev_hash, the hash of the block before it, is given the checksum
+    ravend stores after the data is verified, raising ValueError if it
+    doesn't match.
+    """
+    with open(revfile, "rb") as f:
+        f.seek(offset - 4)  # Size is present 4 bytes before the db offset
+        size, = _UNDO_SIZE.unpack(f.read(4))
+        data = f.read(size + 32)
+    if len(data) != size + 32:
+        raise ValueError('undo data at %s:%d is truncated' % (revfile, offset))
+    if prev_hash is not None and Hash(prev_hash + data[:size]) != data[size:]:
+        raise ValueError('undo data at %s:%d does not match the checksum of block after %s' %
+                         (revfile, offset, b2lx(prev_hash)))
+    return deserialize_block_undo(data[:size])
+
+
+def iter_prevouts(block, undo):
+    """Yields (tx, txin, Coin) for every input of the block but the
+    coinbase's, pairing them with the outputs they spend from undo
+    """
+    if len(undo) != len(block.vtx) - 1:
+        raise ValueError('undo data has %d transactions, block %d non-coinbase' %
+                         (len(undo), len(block.vtx) - 1))
+    for tx, coins in zip(block.vtx[1:], undo):
+        if len(coins) != len(tx.vin):
+            raise ValueError('undo data of %s has %d coins for %d inputs' %
+                             (b2lx(tx.GetTxid()), len(coins), len(tx.vin)))
+        for txin, coin in zip(tx.vin, coins):
+            yield tx, txin, coin
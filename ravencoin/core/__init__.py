@@ -13,6 +13,8 @@
 from __future__ import absolute_import, division, print_function
 
 import binascii
+import functools
+import multiprocessing
 import struct
 import sys
 import time
@@ -33,6 +35,20 @@ MAX_BLOCK_WEIGHT = 4000000
 MAX_BLOCK_SIGOPS = MAX_BLOCK_SIZE/50
 WITNESS_COINBASE_SCRIPTPUBKEY_MAGIC = _bytes([OP_RETURN, 0x24, 0xaa, 0x21, 0xa9, 0xed])
 
+# Precompiled structs for the fixed-width parts of the core classes
+_INT32 = struct.Struct(b'<i')
+_UINT32 = struct.Struct(b'<I')
+_INT64 = struct.Struct(b'<q')
+_OUTPOINT = struct.Struct(b'<32sI')
+# prevout and nValue followed by the first byte of the script length
+_TXIN_PREFIX = struct.Struct(b'<32sIB')
+_TXOUT_PREFIX = struct.Struct(b'<qB')
+# nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits
+_HEADER_PREFIX = struct.Struct(b'<i32s32sII')
+# nHeight, nonce64, mix_hash of KAWPOW era headers, in place of nNonce
+_KAWPOW_SUFFIX = struct.Struct(b'<IQ32s')
+_KAWPOW_NONCE = struct.Struct(b'<IQ')
+
 def MoneyRange(nValue, params=None):
     global coreparams
     if not params:
@@ -118,12 +134,15 @@ class ValidationError(Exception):
 
 def __make_mutable(cls):
     # For speed we use a class decorator that removes the immutable
-    # restrictions directly. In addition the modified behavior of GetHash() and
-    # hash() is undone.
+    # restrictions directly. In addition the caching of serialize(), GetHash()
+    # and hash() is undone; hashes not derived from the serialization don't
+    # need caching and are kept.
     cls.__setattr__ = object.__setattr__
     cls.__delattr__ = object.__delattr__
+    cls.serialize = Serializable.serialize
     cls.GetHash = Serializable.GetHash
-    cls.__hash__ = Serializable.__hash__
+    if cls.__hash__ is ImmutableSerializable.__hash__:
+        cls.__hash__ = Serializable.__hash__
     return cls
 
 
@@ -139,16 +158,42 @@ class COutPoint(ImmutableSerializable):
             raise ValueError('COutPoint: n must be in range 0x0 to 0xffffffff; got %x' % n)
         object.__setattr__(self, 'n', n)
 
+    @classmethod
+    def _trusted(cls, hash, n):
+        # Create an instance from fields read by the deserializer, which are
+        # valid by construction, without the checks of __init__()
+        self = object.__new__(cls)
+        object.__setattr__(self, 'hash', hash)
+        object.__setattr__(self, 'n', n)
+        return self
+
     @classmethod
     def stream_deserialize(cls, f):
-        hash = ser_read(f,32)
-        n = struct.unpack(b"<I", ser_read(f,4))[0]
-        return cls(hash, n)
+        hash, n = _OUTPOINT.unpack(ser_read(f,36))
+        return cls._trusted(hash, n)
+
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        (hash, n), pos = buf_unpack(_OUTPOINT, buf, pos)
+        return cls._trusted(hash, n), pos
 
     def stream_serialize(self, f):
         assert len(self.hash) == 32
-        f.write(self.hash)
-        f.write(struct.pack(b"<I", self.n))
+        f.write(_OUTPOINT.pack(self.hash, self.n))
+
+    def buf_serialize(self, buf):
+        assert len(self.hash) == 32
+        buf += _OUTPOINT.pack(self.hash, self.n)
+
+    def __eq__(self, other):
+        # Outpoints are used as dict keys by the million, so compare and
+        # hash the fields directly rather than the serialization.
+        if not isinstance(other, COutPoint):
+            return NotImplemented
+        return self.n == other.n and self.hash == other.hash
+
+    def __hash__(self):
+        return hash((self.hash, self.n))
 
     def is_null(self):
         return ((self.hash == b'\x00'*32) and (self.n == 0xffffffff))
@@ -201,17 +246,49 @@ class CTxIn(ImmutableSerializable):
         object.__setattr__(self, 'prevout', prevout)
         object.__setattr__(self, 'scriptSig', scriptSig)
 
+    @classmethod
+    def _trusted(cls, prevout, scriptSig, nSequence):
+        # See COutPoint._trusted()
+        self = object.__new__(cls)
+        object.__setattr__(self, 'prevout', prevout)
+        object.__setattr__(self, 'scriptSig', scriptSig)
+        object.__setattr__(self, 'nSequence', nSequence)
+        return self
+
     @classmethod
     def stream_deserialize(cls, f):
         prevout = COutPoint.stream_deserialize(f)
         scriptSig = script.CScript(BytesSerializer.stream_deserialize(f))
-        nSequence = struct.unpack(b"<I", ser_read(f,4))[0]
-        return cls(prevout, scriptSig, nSequence)
+        nSequence = _UINT32.unpack(ser_read(f,4))[0]
+        return cls._trusted(prevout, scriptSig, nSequence)
+
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        # prevout and the first byte of the scriptSig length varint, which is
+        # nearly always the whole varint
+        (hash, n, l), pos = buf_unpack(_TXIN_PREFIX, buf, pos)
+        if l >= 0xfd:
+            l, pos = VarIntSerializer.buf_deserialize(buf, pos - 1)
+        scriptSig, pos = buf_read(buf, pos, l)
+        (nSequence,), pos = buf_unpack(_UINT32, buf, pos)
+        return cls._trusted(COutPoint._trusted(hash, n), script.CScript(scriptSig), nSequence), pos
 
     def stream_serialize(self, f):
         COutPoint.stream_serialize(self.prevout, f)
         BytesSerializer.stream_serialize(self.scriptSig, f)
-        f.write(struct.pack(b"<I", self.nSequence))
+        f.write(_UINT32.pack(self.nSequence))
+
+    def buf_serialize(self, buf):
+        prevout = self.prevout
+        assert len(prevout.hash) == 32
+        scriptSig = self.scriptSig
+        if len(scriptSig) < 0xfd:
+            buf += _TXIN_PREFIX.pack(prevout.hash, prevout.n, len(scriptSig))
+        else:
+            buf += _OUTPOINT.pack(prevout.hash, prevout.n)
+            VarIntSerializer.buf_serialize(len(scriptSig), buf)
+        buf += scriptSig
+        buf += _UINT32.pack(self.nSequence)
 
     def is_final(self):
         return (self.nSequence == 0xffffffff)
@@ -266,16 +343,41 @@ class CTxOut(ImmutableSerializable):
         object.__setattr__(self, 'nValue', int(nValue))
         object.__setattr__(self, 'scriptPubKey', scriptPubKey)
 
+    @classmethod
+    def _trusted(cls, nValue, scriptPubKey):
+        # See COutPoint._trusted()
+        self = object.__new__(cls)
+        object.__setattr__(self, 'nValue', nValue)
+        object.__setattr__(self, 'scriptPubKey', scriptPubKey)
+        return self
+
     @classmethod
     def stream_deserialize(cls, f):
-        nValue = struct.unpack(b"<q", ser_read(f,8))[0]
+        nValue = _INT64.unpack(ser_read(f,8))[0]
         scriptPubKey = script.CScript(BytesSerializer.stream_deserialize(f))
-        return cls(nValue, scriptPubKey)
+        return cls._trusted(nValue, scriptPubKey)
+
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        (nValue, l), pos = buf_unpack(_TXOUT_PREFIX, buf, pos)
+        if l >= 0xfd:
+            l, pos = VarIntSerializer.buf_deserialize(buf, pos - 1)
+        scriptPubKey, pos = buf_read(buf, pos, l)
+        return cls._trusted(nValue, script.CScript(scriptPubKey)), pos
 
     def stream_serialize(self, f):
-        f.write(struct.pack(b"<q", self.nValue))
+        f.write(_INT64.pack(self.nValue))
         BytesSerializer.stream_serialize(self.scriptPubKey, f)
 
+    def buf_serialize(self, buf):
+        scriptPubKey = self.scriptPubKey
+        if len(scriptPubKey) < 0xfd:
+            buf += _TXOUT_PREFIX.pack(self.nValue, len(scriptPubKey))
+        else:
+            buf += _INT64.pack(self.nValue)
+            VarIntSerializer.buf_serialize(len(scriptPubKey), buf)
+        buf += scriptPubKey
+
     def is_valid(self):
         if not MoneyRange(self.nValue):
             return False
@@ -328,9 +430,17 @@ class CTxInWitness(ImmutableSerializable):
         scriptWitness = CScriptWitness.stream_deserialize(f)
         return cls(scriptWitness)
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        scriptWitness, pos = CScriptWitness.buf_deserialize(buf, pos)
+        return cls(scriptWitness), pos
+
     def stream_serialize(self, f):
         self.scriptWitness.stream_serialize(f)
 
+    def buf_serialize(self, buf):
+        self.scriptWitness.buf_serialize(buf)
+
     def __repr__(self):
         return "CTxInWitness(%s)" % (repr(self.scriptWitness))
 
@@ -366,10 +476,21 @@ class CTxWitness(ImmutableSerializable):
                 range(len(self.vtxinwit)))
         return CTxWitness(vtxinwit)
 
+    def buf_deserialize(self, buf, pos=0):
+        vtxinwit = []
+        for dummy in range(len(self.vtxinwit)):
+            txinwit, pos = CTxInWitness.buf_deserialize(buf, pos)
+            vtxinwit.append(txinwit)
+        return CTxWitness(tuple(vtxinwit)), pos
+
     def stream_serialize(self, f):
         for i in range(len(self.vtxinwit)):
             self.vtxinwit[i].stream_serialize(f)
 
+    def buf_serialize(self, buf):
+        for txinwit in self.vtxinwit:
+            txinwit.buf_serialize(buf)
+
     def __repr__(self):
         return "CTxWitness(%s)" % (','.join(repr(w) for w in self.vtxinwit))
 
@@ -386,9 +507,16 @@ class CTxWitness(ImmutableSerializable):
             return cls(txwitness.vtxinwit)
 
 
+_NULL_WITNESS = CTxWitness()
+
+
 class CTransaction(ImmutableSerializable):
     """A transaction"""
-    __slots__ = ['nVersion', 'vin', 'vout', 'nLockTime', 'wit']
+    __slots__ = ['nVersion', 'vin', 'vout', 'nLockTime', 'wit', '_cached_GetTxid']
+
+    # Not cached, unlike the serialization of small objects: transactions
+    # can be large and are kept around in blocks. Their hashes are cached.
+    serialize = Serializable.serialize
 
     def __init__(self, vin=(), vout=(), nLockTime=0, nVersion=1, witness=CTxWitness()):
         """Create a new transaction
@@ -401,10 +529,22 @@ class CTransaction(ImmutableSerializable):
             raise ValueError('CTransaction: nLockTime must be in range 0x0 to 0xffffffff; got %x' % nLockTime)
         object.__setattr__(self, 'nLockTime', nLockTime)
         object.__setattr__(self, 'nVersion', nVersion)
-        object.__setattr__(self, 'vin', tuple(CTxIn.from_txin(txin) for txin in vin))
-        object.__setattr__(self, 'vout', tuple(CTxOut.from_txout(txout) for txout in vout))
+        object.__setattr__(self, 'vin', tuple(map(CTxIn.from_txin, vin)))
+        object.__setattr__(self, 'vout', tuple(map(CTxOut.from_txout, vout)))
         object.__setattr__(self, 'wit', CTxWitness.from_txwitness(witness))
 
+    @classmethod
+    def _trusted(cls, vin, vout, nLockTime, nVersion, witness=_NULL_WITNESS):
+        # See COutPoint._trusted(); vin and vout must hold CTxIn and CTxOut
+        # instances, which unlike in __init__() aren't copied.
+        self = object.__new__(cls)
+        object.__setattr__(self, 'nLockTime', nLockTime)
+        object.__setattr__(self, 'nVersion', nVersion)
+        object.__setattr__(self, 'vin', tuple(vin))
+        object.__setattr__(self, 'vout', tuple(vout))
+        object.__setattr__(self, 'wit', witness)
+        return self
+
     @classmethod
     def stream_deserialize(cls, f):
         """Deserialize transaction
@@ -419,27 +559,72 @@ class CTransaction(ImmutableSerializable):
         but not here.
         """
         # FIXME can't assume f is seekable
-        nVersion = struct.unpack(b"<i", ser_read(f,4))[0]
+        start = f.tell()
+        nVersion = _INT32.unpack(ser_read(f,4))[0]
         pos = f.tell()
-        markerbyte = struct.unpack(b'B', ser_read(f, 1))[0]
-        flagbyte = struct.unpack(b'B', ser_read(f, 1))[0]
+        markerbyte, flagbyte = ser_read(f, 2)
         if markerbyte == 0 and flagbyte == 1:
             vin = VectorSerializer.stream_deserialize(CTxIn, f)
             vout = VectorSerializer.stream_deserialize(CTxOut, f)
+            witness_start = f.tell()
             wit = CTxWitness(tuple(0 for dummy in range(len(vin))))
             wit = wit.stream_deserialize(f)
-            nLockTime = struct.unpack(b"<I", ser_read(f,4))[0]
-            return cls(vin, vout, nLockTime, nVersion, wit)
+            nLockTime = _UINT32.unpack(ser_read(f,4))[0]
+            tx = cls._trusted(vin, vout, nLockTime, nVersion, wit)
         else:
             f.seek(pos) # put marker byte back, since we don't have peek
             vin = VectorSerializer.stream_deserialize(CTxIn, f)
             vout = VectorSerializer.stream_deserialize(CTxOut, f)
-            nLockTime = struct.unpack(b"<I", ser_read(f,4))[0]
-            return cls(vin, vout, nLockTime, nVersion)
+            nLockTime = _UINT32.unpack(ser_read(f,4))[0]
+            witness_start = None
+            tx = cls._trusted(vin, vout, nLockTime, nVersion)
+        # Streams that expose their buffer, like BytesIO, let us hash the
+        # bytes that were read
+        getbuffer = getattr(f, 'getbuffer', None)
+        if getbuffer is not None:
+            with getbuffer() as buf:
+                tx._cache_hashes(buf, start, f.tell(), witness_start)
+        return tx
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        start = pos
+        (nVersion,), pos = buf_unpack(_INT32, buf, pos)
+        if buf[pos:pos+2] == b'\x00\x01':
+            vin, pos = VectorSerializer.buf_deserialize(CTxIn, buf, pos + 2)
+            vout, pos = VectorSerializer.buf_deserialize(CTxOut, buf, pos)
+            witness_start = pos
+            wit = CTxWitness(tuple(0 for dummy in range(len(vin))))
+            wit, pos = wit.buf_deserialize(buf, pos)
+            (nLockTime,), pos = buf_unpack(_UINT32, buf, pos)
+            tx = cls._trusted(vin, vout, nLockTime, nVersion, wit)
+        else:
+            vin, pos = VectorSerializer.buf_deserialize(CTxIn, buf, pos)
+            vout, pos = VectorSerializer.buf_deserialize(CTxOut, buf, pos)
+            (nLockTime,), pos = buf_unpack(_UINT32, buf, pos)
+            witness_start = None
+            tx = cls._trusted(vin, vout, nLockTime, nVersion)
+        tx._cache_hashes(buf, start, pos, witness_start)
+        return tx, pos
+
+    def _cache_hashes(self, buf, start, end, witness_start):
+        """Cache the txid and hash of a transaction just deserialized from
+        buf[start:end]
+
+        Both are hashed from the bytes that were read, saving the
+        re-serialization GetTxid() and GetHash() would otherwise do.
+        """
+        txid = _txid_from_span(buf, start, end, witness_start)
+        object.__setattr__(self, '_cached_GetTxid', txid)
+        if witness_start is None:
+            object.__setattr__(self, '_cached_GetHash', txid)
+        elif not self.wit.is_null():
+            # A null witness is dropped when re-serializing, so only hash
+            # the raw bytes if they match what serialize() returns.
+            object.__setattr__(self, '_cached_GetHash', Hash(buf[start:end]))
 
     def stream_serialize(self, f, include_witness=True):
-        f.write(struct.pack(b"<i", self.nVersion))
+        f.write(_INT32.pack(self.nVersion))
         if include_witness and not self.wit.is_null():
             assert(len(self.wit.vtxinwit) <= len(self.vin))
             f.write(b'\x00') # Marker
@@ -450,7 +635,23 @@ class CTransaction(ImmutableSerializable):
         else:
             VectorSerializer.stream_serialize(CTxIn, self.vin, f)
             VectorSerializer.stream_serialize(CTxOut, self.vout, f)
-        f.write(struct.pack(b"<I", self.nLockTime))
+        f.write(_UINT32.pack(self.nLockTime))
+
+    def buf_serialize(self, buf, include_witness=True):
+        buf += _INT32.pack(self.nVersion)
+        with_witness = include_witness and not self.wit.is_null()
+        if with_witness:
+            assert(len(self.wit.vtxinwit) <= len(self.vin))
+            buf += b'\x00\x01' # Marker and flag
+        VarIntSerializer.buf_serialize(len(self.vin), buf)
+        for txin in self.vin:
+            CTxIn.buf_serialize(txin, buf)
+        VarIntSerializer.buf_serialize(len(self.vout), buf)
+        for txout in self.vout:
+            CTxOut.buf_serialize(txout, buf)
+        if with_witness:
+            self.wit.buf_serialize(buf)
+        buf += _UINT32.pack(self.nLockTime)
 
     def is_coinbase(self):
         return len(self.vin) == 1 and self.vin[0].prevout.is_null()
@@ -480,12 +681,12 @@ class CTransaction(ImmutableSerializable):
         """Get the transaction ID.  This differs from the transactions hash as
             given by GetHash.  GetTxid excludes witness data, while GetHash
             includes it. """
-        if self.wit != CTxWitness():
-            txid = Hash(CTransaction(self.vin, self.vout, self.nLockTime,
-                self.nVersion).serialize())
-        else:
-            txid = Hash(self.serialize())
-        return txid
+        try:
+            return self._cached_GetTxid
+        except AttributeError:
+            _cached_GetTxid = Hash(self.serialize(dict(include_witness=False)))
+            object.__setattr__(self, '_cached_GetTxid', _cached_GetTxid)
+            return _cached_GetTxid
 
 @__make_mutable
 class CMutableTransaction(CTransaction):
@@ -518,6 +719,18 @@ class CMutableTransaction(CTransaction):
 
         return cls(vin, vout, tx.nLockTime, tx.nVersion, tx.wit)
 
+    @classmethod
+    def _trusted(cls, vin, vout, nLockTime, nVersion, witness=None):
+        return cls(list(vin), list(vout), nLockTime, nVersion, witness)
+
+    def _cache_hashes(self, buf, start, end, witness_start):
+        # can't cache anything about mutable transactions
+        pass
+
+    def GetTxid(self):
+        """Get the transaction ID, see CTransaction.GetTxid()"""
+        return Hash(self.serialize(dict(include_witness=False)))
+
 class CBlockHeader(ImmutableSerializable):
     """A block header"""
     __slots__ = ['nVersion', 'hashPrevBlock', 'hashMerkleRoot', 'nTime', 'nBits', 'nNonce', 'nHeight', 'nonce64', 'mix_hash']
@@ -537,36 +750,45 @@ class CBlockHeader(ImmutableSerializable):
 
     @classmethod
     def stream_deserialize(cls, f):
-        nVersion = struct.unpack(b"<i", ser_read(f,4))[0]
-        hashPrevBlock = ser_read(f,32)
-        hashMerkleRoot = ser_read(f,32)
-        nTime = struct.unpack(b"<I", ser_read(f,4))[0]
-        nBits = struct.unpack(b"<I", ser_read(f,4))[0]
+        nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits = \
+            _HEADER_PREFIX.unpack(ser_read(f,_HEADER_PREFIX.size))
         # FIXME this only works on mainnet, but we have no information on network and nVersion is unchanged...
         if nTime > 1588788000: # new header format
-            nHeight = struct.unpack(b"<I", ser_read(f,4))[0]
-            nonce64 = struct.unpack(b"<Q", ser_read(f,8))[0]
-            mix_hash = ser_read(f,32)
+            nHeight, nonce64, mix_hash = _KAWPOW_SUFFIX.unpack(ser_read(f,_KAWPOW_SUFFIX.size))
             return cls(nVersion=nVersion, hashPrevBlock=hashPrevBlock, hashMerkleRoot=hashMerkleRoot, nTime=nTime, nBits=nBits, nNonce=0, \
                        nHeight=nHeight, nonce64=nonce64, mix_hash=mix_hash)
         else:
-            nNonce = struct.unpack(b"<I", ser_read(f,4))[0]
+            nNonce = _UINT32.unpack(ser_read(f,4))[0]
             return cls(nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce)
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        (nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits), pos = \
+            buf_unpack(_HEADER_PREFIX, buf, pos)
+        # FIXME mainnet only, see stream_deserialize()
+        if nTime > 1588788000: # new header format
+            (nHeight, nonce64, mix_hash), pos = buf_unpack(_KAWPOW_SUFFIX, buf, pos)
+            return cls(nVersion=nVersion, hashPrevBlock=hashPrevBlock, hashMerkleRoot=hashMerkleRoot, nTime=nTime, nBits=nBits, nNonce=0, \
+                       nHeight=nHeight, nonce64=nonce64, mix_hash=mix_hash), pos
+        else:
+            (nNonce,), pos = buf_unpack(_UINT32, buf, pos)
+            return cls(nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce), pos
+
     def stream_serialize(self, f):
-        f.write(struct.pack(b"<i", self.nVersion))
+        buf = bytearray()
+        CBlockHeader.buf_serialize(self, buf)
+        f.write(buf)
+
+    def buf_serialize(self, buf):
         assert len(self.hashPrevBlock) == 32
-        f.write(self.hashPrevBlock)
         assert len(self.hashMerkleRoot) == 32
-        f.write(self.hashMerkleRoot)
-        f.write(struct.pack(b"<I", self.nTime))
-        f.write(struct.pack(b"<I", self.nBits))
+        buf += _HEADER_PREFIX.pack(self.nVersion, self.hashPrevBlock, self.hashMerkleRoot,
+                                   self.nTime, self.nBits)
         if self.nTime > 1588788000: # new header format
-            f.write(struct.pack(b"<I", self.nHeight))
-            f.write(struct.pack(b"<Q", self.nonce64))
-            f.write(self.mix_hash)
+            buf += _KAWPOW_NONCE.pack(self.nHeight, self.nonce64)
+            buf += self.mix_hash
         else:
-            f.write(struct.pack(b"<I", self.nNonce))
+            buf += _UINT32.pack(self.nNonce)
 
     @staticmethod
     def calc_difficulty(nBits):
@@ -587,14 +809,63 @@ class CBlockHeader(ImmutableSerializable):
                 (self.__class__.__name__, self.nVersion, b2lx(self.hashPrevBlock), b2lx(self.hashMerkleRoot),
                  self.nTime, self.nBits, self.nNonce)
 
-    def GetHash(self):
+    def _pow_hash_args(self):
+        # (hash function, serialized header) for _pow_hash()
         global coreparams
         if self.nTime >= coreparams.nKAWPOWActivationTime:
-           return KawpowHash(self.serialize())
+            hash_func = KawpowHash
         elif self.nTime >= coreparams.nX16RV2ActivationTime:
-           return X16RV2Hash(self.serialize())
+            hash_func = X16RV2Hash
         else:
-           return X16RHash(self.serialize())
+            hash_func = X16RHash
+        buf = bytearray()
+        CBlockHeader.buf_serialize(self, buf)
+        return hash_func, bytes(buf)
+
+    def GetHash(self):
+        """Return the block hash
+
+        The hash is computed once and then kept. Recently computed hashes
+        are also shared between equal headers, see HEADER_HASH_CACHE_SIZE.
+        """
+        try:
+            return self._cached_GetHash
+        except AttributeError:
+            _cached_GetHash = _pow_hash(*self._pow_hash_args())
+            object.__setattr__(self, '_cached_GetHash', _cached_GetHash)
+            return _cached_GetHash
+
+# Number of header hashes kept by the LRU cache behind CBlockHeader.GetHash()
+HEADER_HASH_CACHE_SIZE = 0x4000
+
+@functools.lru_cache(maxsize=HEADER_HASH_CACHE_SIZE)
+def _pow_hash(hash_func, header):
+    return hash_func(header)
+
+def _pow_hash_worker(args):
+    hash_func, header = args
+    return hash_func(header)
+
+def hash_headers(headers, workers=1, chunksize=64):
+    """Return the block hashes of headers, a sequence of CBlockHeader
+
+    With workers != 1 the hashes are computed by a pool of that many worker
+    processes (None uses os.cpu_count()), which pays off for large batches
+    as PoW hashes are slow. Hashes are kept in the headers like GetHash()
+    does, and headers that already know their hash are not sent to the pool.
+    """
+    if workers == 1:
+        return [header.GetHash() for header in headers]
+
+    hashes = [getattr(header, '_cached_GetHash', None) for header in headers]
+    todo = [i for i, h in enumerate(hashes) if h is None]
+    jobs = [headers[i]._pow_hash_args() for i in todo]
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(_pow_hash_worker, jobs, chunksize)
+    for i, h in zip(todo, results):
+        object.__setattr__(headers[i], '_cached_GetHash', h)
+        hashes[i] = h
+    return hashes
 
 
 class NoWitnessData(Exception):
@@ -602,7 +873,10 @@ class NoWitnessData(Exception):
 
 class CBlock(CBlockHeader):
     """A block including all transactions in it"""
-    __slots__ = ['vtx', 'vMerkleTree', 'vWitnessMerkleTree']
+    __slots__ = ['vtx', '_cached_vMerkleTree', '_cached_vWitnessMerkleTree']
+
+    # Not cached, as that would keep a copy of the whole block alive
+    serialize = Serializable.serialize
 
     @staticmethod
     def build_merkle_tree_from_txids(txids):
@@ -692,44 +966,70 @@ class CBlock(CBlockHeader):
 
     def __init__(self, nVersion=2, hashPrevBlock=b'\x00'*32, hashMerkleRoot=b'\x00'*32, nTime=0, nBits=0, nNonce=0, vtx=(), nHeight=0, nonce64=0, mix_hash=b''):
         """Create a new block"""
+        vMerkleTree = None
         if vtx:
             vMerkleTree = tuple(CBlock.build_merkle_tree_from_txs(vtx))
             if hashMerkleRoot == b'\x00'*32:
                 hashMerkleRoot = vMerkleTree[-1]
             elif hashMerkleRoot != vMerkleTree[-1]:
                 raise CheckBlockError("CBlock : hashMerkleRoot is not compatible with vtx")
-        else:
-            vMerkleTree = ()
         super(CBlock, self).__init__(nVersion, hashPrevBlock, hashMerkleRoot, nTime, nBits, nNonce, nHeight, nonce64, mix_hash)
 
-        object.__setattr__(self, 'vMerkleTree', vMerkleTree)
-        try:
-            vWitnessMerkleTree = tuple(CBlock.build_witness_merkle_tree_from_txs(vtx))
-        except NoWitnessData:
-            vWitnessMerkleTree = ()
-        object.__setattr__(self, 'vWitnessMerkleTree', vWitnessMerkleTree)
-        object.__setattr__(self, 'vtx', tuple(CTransaction.from_tx(tx) for tx in vtx))
+        if vMerkleTree is not None:
+            # built anyway to check hashMerkleRoot
+            object.__setattr__(self, '_cached_vMerkleTree', vMerkleTree)
+        object.__setattr__(self, 'vtx', tuple(map(CTransaction.from_tx, vtx)))
 
     @classmethod
     def stream_deserialize(cls, f):
         self = super(CBlock, cls).stream_deserialize(f)
-
         vtx = VectorSerializer.stream_deserialize(CTransaction, f)
-        vMerkleTree = tuple(CBlock.build_merkle_tree_from_txs(vtx))
-        object.__setattr__(self, 'vMerkleTree', vMerkleTree)
-        try:
-            vWitnessMerkleTree = tuple(CBlock.build_witness_merkle_tree_from_txs(vtx))
-        except NoWitnessData:
-            vWitnessMerkleTree = ()
-        object.__setattr__(self, 'vWitnessMerkleTree', vWitnessMerkleTree)
+        self._set_vtx(vtx)
+        return self
+
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        self, pos = super(CBlock, cls).buf_deserialize(buf, pos)
+        vtx, pos = VectorSerializer.buf_deserialize(CTransaction, buf, pos)
+        self._set_vtx(vtx)
+        return self, pos
+
+    def _set_vtx(self, vtx):
+        # set the transactions of a freshly deserialized block
         object.__setattr__(self, 'vtx', tuple(vtx))
 
-        return self
+    @property
+    def vMerkleTree(self):
+        """The merkle tree of the transactions, built on first access"""
+        try:
+            return self._cached_vMerkleTree
+        except AttributeError:
+            vMerkleTree = tuple(CBlock.build_merkle_tree_from_txs(self.vtx))
+            object.__setattr__(self, '_cached_vMerkleTree', vMerkleTree)
+            return vMerkleTree
+
+    @property
+    def vWitnessMerkleTree(self):
+        """The witness merkle tree of the transactions, or () if none has
+        witness data, built on first access"""
+        try:
+            return self._cached_vWitnessMerkleTree
+        except AttributeError:
+            try:
+                vWitnessMerkleTree = tuple(CBlock.build_witness_merkle_tree_from_txs(self.vtx))
+            except NoWitnessData:
+                vWitnessMerkleTree = ()
+            object.__setattr__(self, '_cached_vWitnessMerkleTree', vWitnessMerkleTree)
+            return vWitnessMerkleTree
 
     def stream_serialize(self, f, include_witness=True):
         super(CBlock, self).stream_serialize(f)
         VectorSerializer.stream_serialize(CTransaction, self.vtx, f, dict(include_witness=include_witness))
 
+    def buf_serialize(self, buf, include_witness=True):
+        super(CBlock, self).buf_serialize(buf)
+        VectorSerializer.buf_serialize(CTransaction, self.vtx, buf, dict(include_witness=include_witness))
+
     def get_header(self):
         """Return the block header
 
@@ -751,17 +1051,231 @@ class CBlock(CBlockHeader):
         Note that this is the hash of the header, not the entire serialized
         block.
         """
-        try:
-            return self._cached_GetHash
-        except AttributeError:
-            _cached_GetHash = self.get_header().GetHash()
-            object.__setattr__(self, '_cached_GetHash', _cached_GetHash)
-            return _cached_GetHash
+        return CBlockHeader.GetHash(self)
 
     def GetWeight(self):
         """Return the block weight: (stripped_size * 3) + total_size"""
         return len(self.serialize(dict(include_witness=False))) * 3 + len(self.serialize())
 
+def _scan_tx(buf, pos):
+    """Find the boundaries of the serialized transaction at buf[pos:]
+
+    Only lengths are decoded; no objects are created. Returns (end, witness)
+    where end is the position just after the transaction and witness is None
+    for transactions without witness data, otherwise the position at which
+    the witness data starts.
+    """
+    start = pos
+    pos += 4
+    witness = None
+    if buf[pos:pos+2] == b'\x00\x01':
+        witness = pos
+        pos += 2
+    n_vin, pos = VarIntSerializer.buf_deserialize(buf, pos)
+    for i in range(n_vin):
+        l, pos = VarIntSerializer.buf_deserialize(buf, pos + 36)
+        pos += l + 4
+    n_vout, pos = VarIntSerializer.buf_deserialize(buf, pos)
+    for i in range(n_vout):
+        l, pos = VarIntSerializer.buf_deserialize(buf, pos + 8)
+        pos += l
+    if witness is not None:
+        witness = pos
+        for i in range(n_vin):
+            n_items, pos = VarIntSerializer.buf_deserialize(buf, pos)
+            for j in range(n_items):
+                l, pos = VarIntSerializer.buf_deserialize(buf, pos)
+                pos += l
+    pos += 4
+    if pos > len(buf):
+        raise SerializationTruncationError('Transaction at position %i truncated' % start)
+    return pos, witness
+
+def _finish_varint(first, f):
+    """Read the rest of the compact size starting with byte first from f"""
+    n = first[0]
+    if n < 0xfd:
+        return n
+    return int.from_bytes(ser_read(f, {0xfd: 2, 0xfe: 4, 0xff: 8}[n]), 'little')
+
+def _stream_skip_tx(f):
+    """Read the serialized transaction at the position of stream f, like
+    _scan_tx() only decoding lengths, without reading past its end
+    """
+    ser_read(f, 4)
+    n_vin = _finish_varint(ser_read(f, 1), f)
+    n_vout = None
+    witness = False
+    if n_vin == 0:
+        flag = ser_read(f, 1)
+        if flag == b'\x01':
+            witness = True
+            n_vin = VarIntSerializer.stream_deserialize(f)
+        else:
+            # No inputs; the byte starts the count of outputs
+            n_vout = _finish_varint(flag, f)
+    for i in range(n_vin):
+        ser_read(f, 36)
+        ser_read(f, VarIntSerializer.stream_deserialize(f) + 4)
+    if n_vout is None:
+        n_vout = VarIntSerializer.stream_deserialize(f)
+    for i in range(n_vout):
+        ser_read(f, 8)
+        ser_read(f, VarIntSerializer.stream_deserialize(f))
+    if witness:
+        for i in range(n_vin):
+            for j in range(VarIntSerializer.stream_deserialize(f)):
+                ser_read(f, VarIntSerializer.stream_deserialize(f))
+    ser_read(f, 4)
+
+class _TeeReader(object):
+    """Reads from stream f, keeping a copy of the bytes read in data"""
+    __slots__ = ['f', 'data']
+
+    def __init__(self, f):
+        self.f = f
+        self.data = bytearray()
+
+    def read(self, n):
+        r = self.f.read(n)
+        self.data += r
+        return r
+
+def _txid_from_span(buf, start, end, witness_start):
+    """Return the txid of the serialized transaction at buf[start:end]
+
+    witness_start is None for transactions without witness data, otherwise
+    the position of the witness data, which is left out along with the
+    marker and flag bytes.
+    """
+    if witness_start is None:
+        return Hash(buf[start:end])
+    return Hash(b''.join((buf[start:start+4], buf[start+6:witness_start], buf[end-4:end])))
+
+def txids_from_raw_block(buf):
+    """Return the txids of the serialized block in buf
+
+    Transactions are only scanned for their boundaries, not deserialized.
+    """
+    return CLazyBlock.deserialize(buf).get_txids()
+
+class CLazyTxList(object):
+    """Sequence of the transactions of a CLazyBlock
+
+    Transactions are deserialized on first access and then kept.
+    """
+    __slots__ = ['_block', '_txs']
+
+    def __init__(self, block):
+        self._block = block
+        self._txs = [None] * len(block._tx_extents)
+
+    def __len__(self):
+        return len(self._txs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self._txs)))]
+        tx = self._txs[i]
+        if tx is None:
+            tx = CTransaction.deserialize(self._block.get_raw_tx(i))
+            self._txs[i] = tx
+        return tx
+
+    def __iter__(self):
+        for i in range(len(self._txs)):
+            yield self[i]
+
+class CLazyBlock(CBlockHeader):
+    """A block whose transactions are decoded on demand
+
+    Backed by the raw serialized block. Deserializing only decodes the
+    header and locates the transactions; vtx[i] builds the i-th
+    CTransaction when first accessed and txids are computed directly from
+    the raw bytes. Use get_block() to get a regular CBlock.
+    """
+    __slots__ = ['_buf', '_tx_extents', 'vtx']
+
+    @classmethod
+    def stream_deserialize(cls, f):
+        # The block is read up to its end and no further, so reading blocks
+        # one after the other from a stream reads it once, and the stream
+        # needn't be seekable.
+        tee = _TeeReader(f)
+        CBlockHeader.stream_deserialize(tee)
+        for i in range(VarIntSerializer.stream_deserialize(tee)):
+            _stream_skip_tx(tee)
+        return cls.buf_deserialize(bytes(tee.data))[0]
+
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        """Deserialize a block from bytes or any buffer, e.g. a memoryview of
+        a mapped .blk file, which is referenced rather than copied.
+        """
+        start = pos
+        buf = memoryview(buf)[start:]
+        self, pos = super(CLazyBlock, cls).buf_deserialize(buf, 0)
+        n_tx, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        tx_extents = []
+        for i in range(n_tx):
+            end, witness = _scan_tx(buf, pos)
+            tx_extents.append((pos, end, witness))
+            pos = end
+        object.__setattr__(self, '_buf', buf[:pos])
+        object.__setattr__(self, '_tx_extents', tuple(tx_extents))
+        object.__setattr__(self, 'vtx', CLazyTxList(self))
+        return self, start + pos
+
+    def stream_serialize(self, f):
+        f.write(self._buf)
+
+    def buf_serialize(self, buf):
+        buf += self._buf
+
+    def serialize(self, params={}):
+        # Not cached, as _buf already holds the serialization
+        return bytes(self._buf)
+
+    def __reduce__(self):
+        # memoryviews can't be pickled
+        return (self.__class__.deserialize, (self._buf.tobytes(),))
+
+    def get_raw_tx(self, i):
+        """Return a memoryview of the serialization of transaction i"""
+        start, end, witness = self._tx_extents[i]
+        return self._buf[start:end]
+
+    def get_txid(self, i):
+        """Return the txid of transaction i, hashed from the raw bytes"""
+        start, end, witness = self._tx_extents[i]
+        return _txid_from_span(self._buf, start, end, witness)
+
+    def get_txids(self):
+        """Return the txids of all transactions"""
+        return [self.get_txid(i) for i in range(len(self._tx_extents))]
+
+    def calc_merkle_root(self):
+        """Calculate the merkle root from the raw transactions"""
+        if not len(self._tx_extents):
+            raise ValueError('Block contains no transactions')
+        return CBlock.build_merkle_tree_from_txids(self.get_txids())[-1]
+
+    def get_header(self):
+        """Return the block header
+
+        Returned header is a new object.
+        """
+        return CBlock.get_header(self)
+
+    def get_block(self):
+        """Return a fully deserialized CBlock"""
+        return CBlock.deserialize(self._buf)
+
+    def __repr__(self):
+        return "%s(%i, lx(%s), lx(%s), %s, 0x%08x, 0x%08x, %i txs)" % \
+                (self.__class__.__name__, self.nVersion, b2lx(self.hashPrevBlock), b2lx(self.hashMerkleRoot),
+                 self.nTime, self.nBits, self.nNonce, len(self._tx_extents))
+
 class CoreChainParams(object):
     """Define consensus-critical parameters of a given instance of the Ravencoin system"""
     MAX_MONEY = None
@@ -1023,7 +1537,11 @@ __all__ = (
         'CTxWitness',
         'CTxInWitness',
         'CBlockHeader',
+        'HEADER_HASH_CACHE_SIZE',
+        'hash_headers',
         'CBlock',
+        'CLazyBlock',
+        'txids_from_raw_block',
         'CoreChainParams',
         'CoreMainParams',
         'CoreTestNetParams',
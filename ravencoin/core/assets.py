@@ -12,8 +12,8 @@
 import struct
 
 from ravencoin.base58 import encode
-from ravencoin.core import x
-from ravencoin.core.script import OP_RESERVED
+from ravencoin.core import COIN, x
+from ravencoin.core.script import CScript, CScriptInvalidError, OP_RESERVED, OP_RVN_ASSET
 
 
 asset_types = {
@@ -158,3 +158,30 @@ class RvnAssetData(object):
     @property
     def ipfshash(self):
         return self._ipfshash
+
+
+def get_script_asset(script):
+    """Return (asset name, amount) of the asset held by an output script,
+    or None if it holds none
+
+    Ownership (admin) tokens, whose asset data has no amount, count as one
+    unit like in ravend. Null asset data (tags, restrictions) is ignored.
+    """
+    if OP_RVN_ASSET not in script:
+        return None # fast path, most outputs hold RVN only
+    try:
+        ops = list(CScript(script))
+    except CScriptInvalidError:
+        return None
+    for i, op in enumerate(ops[:-1]):
+        if op == OP_RVN_ASSET and isinstance(ops[i + 1], bytes):
+            try:
+                asset_data = RvnAssetData(ops[i + 1])
+            except (ValueError, struct.error, UnicodeDecodeError):
+                return None
+            if not asset_data.asset_name:
+                return None
+            if asset_data.asset_type == 'admin':
+                return asset_data.asset_name, COIN
+            return asset_data.asset_name, asset_data.amount
+    return None
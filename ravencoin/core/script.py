@@ -521,6 +521,8 @@ class CScript(bytes):
 
     iter(script) however does iterate by opcode.
     """
+    __slots__ = []
+
     @classmethod
     def __coerce_instance(cls, other):
         # Coerce other into bytes
@@ -848,11 +850,25 @@ class CScriptWitness(ImmutableSerializable):
         stack = tuple(BytesSerializer.stream_deserialize(f) for i in range(n))
         return cls(stack)
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        n, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        stack = []
+        for i in range(n):
+            item, pos = BytesSerializer.buf_deserialize(buf, pos)
+            stack.append(item)
+        return cls(tuple(stack)), pos
+
     def stream_serialize(self, f):
         VarIntSerializer.stream_serialize(len(self.stack), f)
         for s in self.stack:
             BytesSerializer.stream_serialize(s, f)
 
+    def buf_serialize(self, buf):
+        VarIntSerializer.buf_serialize(len(self.stack), buf)
+        for s in self.stack:
+            BytesSerializer.buf_serialize(s, buf)
+
 
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
@@ -36,6 +36,10 @@ else:
 
 MAX_SIZE = 0x02000000
 
+_UINT16 = struct.Struct(b'<H')
+_UINT32 = struct.Struct(b'<I')
+_UINT64 = struct.Struct(b'<Q')
+
 
 def Hash(msg):
     """SHA256^2)(msg) -> bytes"""
@@ -48,17 +52,10 @@ def X16RV2Hash(msg):
     return x16rv2_hash.getPoWHash(msg)
 
 def KawpowHash(msg):
-
-    def revb(data):
-        b = bytearray(data)
-        b.reverse()
-        return bytes(b)
-
-    header_hash = revb(Hash(msg[:80]))
-    mix_hash = revb(msg[88:120])
-    nNonce64 = struct.unpack("< Q",msg[80:88])[0]
-    result = revb(kawpow.light_verify(header_hash, mix_hash, nNonce64))
-    return result
+    header_hash = Hash(msg[:80])[::-1]
+    mix_hash = bytes(msg[88:120])[::-1]
+    nNonce64 = _UINT64.unpack_from(msg, 80)[0]
+    return kawpow.light_verify(header_hash, mix_hash, nNonce64)[::-1]
 
 def Hash160(msg):
     """RIPEME160(SHA256(msg)) -> bytes"""
@@ -104,6 +101,42 @@ def ser_read(f, n):
     return r
 
 
+def buf_read(buf, pos, n):
+    """Read n bytes from buf at offset pos safely
+
+    Returns (bytes, offset after them). The buffer counterpart of ser_read(),
+    raising the same exceptions; use it in buf_deserialize() methods.
+    """
+    if n > MAX_SIZE:
+        raise SerializationError('Asked to read 0x%x bytes; MAX_SIZE exceeded' % n)
+    end = pos + n
+    if end > len(buf):
+        raise SerializationTruncationError('Asked to read %i bytes, but only got %i' % (n, max(len(buf) - pos, 0)))
+    return bytes(buf[pos:end]), end
+
+
+def buf_unpack(s, buf, pos):
+    """Unpack the struct.Struct s from buf at offset pos safely
+
+    Returns (values tuple, offset after them).
+    """
+    try:
+        return s.unpack_from(buf, pos), pos + s.size
+    except struct.error:
+        raise SerializationTruncationError('Asked to read %i bytes, but only got %i' % (s.size, max(len(buf) - pos, 0)))
+
+
+def _stream_buf_deserialize(stream_deserialize, buf, pos, **kwargs):
+    # Fallback for classes that only implement stream_deserialize()
+    if isinstance(buf, bytes):
+        # BytesIO shares bytes instead of copying them
+        f = _BytesIO(buf)
+        f.seek(pos)
+        return stream_deserialize(f, **kwargs), f.tell()
+    f = _BytesIO(buf[pos:])
+    return stream_deserialize(f, **kwargs), pos + f.tell()
+
+
 class Serializable(object):
     """Base class for serializable objects"""
 
@@ -118,11 +151,35 @@ class Serializable(object):
         """Deserialize from a stream"""
         raise NotImplementedError
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0, **kwargs):
+        """Deserialize from any buffer (bytes, memoryview, mmap...) at
+        offset pos, returning (instance, offset after it)
+
+        Subclasses implement this with struct.unpack_from() and friends to
+        avoid the overhead of reading through a stream; the default falls
+        back to stream_deserialize(). A subclass overriding
+        stream_deserialize() must override this too.
+        """
+        return _stream_buf_deserialize(cls.stream_deserialize, buf, pos, **kwargs)
+
+    def buf_serialize(self, buf, **kwargs):
+        """Serialize by appending to the bytearray buf
+
+        Subclasses implement this with precompiled structs to avoid the
+        overhead of writing through a stream; the default falls back to
+        stream_serialize(). A subclass overriding stream_serialize() must
+        override this too.
+        """
+        f = _BytesIO()
+        self.stream_serialize(f, **kwargs)
+        buf += f.getvalue()
+
     def serialize(self, params={}):
         """Serialize, returning bytes"""
-        f = _BytesIO()
-        self.stream_serialize(f, **params)
-        return f.getvalue()
+        buf = bytearray()
+        self.buf_serialize(buf, **params)
+        return bytes(buf)
 
     @classmethod
     def deserialize(cls, buf, allow_padding=False, params={}):
@@ -133,13 +190,10 @@ class Serializable(object):
         If allow_padding is False and not all bytes are consumed during
         deserialization DeserializationExtraDataError will be raised.
         """
-        fd = _BytesIO(buf)
-        r = cls.stream_deserialize(fd, **params)
-        if not allow_padding:
-            padding = fd.read()
-            if len(padding) != 0:
-                raise DeserializationExtraDataError('Not all bytes consumed during deserialization',
-                                                    r, padding)
+        r, pos = cls.buf_deserialize(buf, 0, **params)
+        if not allow_padding and pos != len(buf):
+            raise DeserializationExtraDataError('Not all bytes consumed during deserialization',
+                                                r, bytes(buf[pos:]))
         return r
 
     def GetHash(self):
@@ -161,7 +215,7 @@ class Serializable(object):
 class ImmutableSerializable(Serializable):
     """Immutable serializable object"""
 
-    __slots__ = ['_cached_GetHash', '_cached__hash__']
+    __slots__ = ['_cached_GetHash', '_cached__hash__', '_cached_serialize']
 
     def __setattr__(self, name, value):
         raise AttributeError('Object is immutable')
@@ -169,6 +223,23 @@ class ImmutableSerializable(Serializable):
     def __delattr__(self, name):
         raise AttributeError('Object is immutable')
 
+    def serialize(self, params={}):
+        """Serialize, returning bytes
+
+        The serialization with the default params is computed once and
+        cached, as comparisons and hashing use it. Classes whose
+        serialization can be large, like transactions and blocks, use
+        Serializable.serialize() instead.
+        """
+        if params:
+            return super(ImmutableSerializable, self).serialize(params)
+        try:
+            return self._cached_serialize
+        except AttributeError:
+            _cached_serialize = super(ImmutableSerializable, self).serialize()
+            object.__setattr__(self, '_cached_serialize', _cached_serialize)
+            return _cached_serialize
+
     def GetHash(self):
         """Return the hash of the serialized object"""
         try:
@@ -186,6 +257,31 @@ class ImmutableSerializable(Serializable):
             object.__setattr__(self, '_cached__hash__', _cached__hash__)
             return _cached__hash__
 
+    def __eq__(self, other):
+        if self is other:
+            return True
+        return super(ImmutableSerializable, self).__eq__(other)
+
+    def __getstate__(self):
+        # Like the default, but leaving out the cached serialization, which
+        # would double the size of the pickle.
+        slots = {}
+        for cls in self.__class__.__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if name != '_cached_serialize' and hasattr(self, name):
+                    slots[name] = getattr(self, name)
+        return (getattr(self, '__dict__', None), slots)
+
+    def __setstate__(self, state):
+        # Default unpickling sets slots with setattr(), which we forbid.
+        # state is either a dict or a (dict, slots dict) tuple.
+        if not isinstance(state, tuple):
+            state = (state, None)
+        for d in state:
+            if d:
+                for name, value in d.items():
+                    object.__setattr__(self, name, value)
+
 class Serializer(object):
     """Base class for object serializers"""
     def __new__(cls):
@@ -200,15 +296,27 @@ class Serializer(object):
         raise NotImplementedError
 
     @classmethod
-    def serialize(cls, obj):
+    def buf_deserialize(cls, buf, pos=0):
+        """Deserialize from buf at offset pos, returning (obj, offset after it)"""
+        return _stream_buf_deserialize(cls.stream_deserialize, buf, pos)
+
+    @classmethod
+    def buf_serialize(cls, obj, buf):
+        """Serialize obj by appending to the bytearray buf"""
         f = _BytesIO()
         cls.stream_serialize(obj, f)
-        return f.getvalue()
+        buf += f.getvalue()
+
+    @classmethod
+    def serialize(cls, obj):
+        buf = bytearray()
+        cls.buf_serialize(obj, buf)
+        return bytes(buf)
 
     @classmethod
     def deserialize(cls, buf):
         if isinstance(buf, str) or isinstance(buf, bytes):
-            buf = _BytesIO(buf)
+            return cls.buf_deserialize(buf)[0]
         return cls.stream_deserialize(buf)
 
 
@@ -222,13 +330,29 @@ class VarIntSerializer(Serializer):
             f.write(_bchr(i))
         elif i <= 0xffff:
             f.write(_bchr(0xfd))
-            f.write(struct.pack(b'<H', i))
+            f.write(_UINT16.pack(i))
         elif i <= 0xffffffff:
             f.write(_bchr(0xfe))
-            f.write(struct.pack(b'<I', i))
+            f.write(_UINT32.pack(i))
         else:
             f.write(_bchr(0xff))
-            f.write(struct.pack(b'<Q', i))
+            f.write(_UINT64.pack(i))
+
+    @classmethod
+    def buf_serialize(cls, i, buf):
+        if i < 0:
+            raise ValueError('varint must be non-negative integer')
+        elif i < 0xfd:
+            buf.append(i)
+        elif i <= 0xffff:
+            buf.append(0xfd)
+            buf += _UINT16.pack(i)
+        elif i <= 0xffffffff:
+            buf.append(0xfe)
+            buf += _UINT32.pack(i)
+        else:
+            buf.append(0xff)
+            buf += _UINT64.pack(i)
 
     @classmethod
     def stream_deserialize(cls, f):
@@ -236,11 +360,28 @@ class VarIntSerializer(Serializer):
         if r < 0xfd:
             return r
         elif r == 0xfd:
-            return struct.unpack(b'<H', ser_read(f, 2))[0]
+            return _UINT16.unpack(ser_read(f, 2))[0]
         elif r == 0xfe:
-            return struct.unpack(b'<I', ser_read(f, 4))[0]
+            return _UINT32.unpack(ser_read(f, 4))[0]
         else:
-            return struct.unpack(b'<Q', ser_read(f, 8))[0]
+            return _UINT64.unpack(ser_read(f, 8))[0]
+
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        try:
+            r = buf[pos]
+        except IndexError:
+            raise SerializationTruncationError('Asked to read 1 bytes, but only got 0')
+        if r < 0xfd:
+            return r, pos + 1
+        elif r == 0xfd:
+            s = _UINT16
+        elif r == 0xfe:
+            s = _UINT32
+        else:
+            s = _UINT64
+        (r,), pos = buf_unpack(s, buf, pos + 1)
+        return r, pos
 
 
 class BytesSerializer(Serializer):
@@ -250,11 +391,21 @@ class BytesSerializer(Serializer):
         VarIntSerializer.stream_serialize(len(b), f)
         f.write(b)
 
+    @classmethod
+    def buf_serialize(cls, b, buf):
+        VarIntSerializer.buf_serialize(len(b), buf)
+        buf += b
+
     @classmethod
     def stream_deserialize(cls, f):
         l = VarIntSerializer.stream_deserialize(f)
         return ser_read(f, l)
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        l, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        return buf_read(buf, pos, l)
+
 
 class VectorSerializer(Serializer):
     """Base class for serializers of object vectors"""
@@ -269,6 +420,13 @@ class VectorSerializer(Serializer):
         for obj in objs:
             inner_cls.stream_serialize(obj, f, **inner_params)
 
+    @classmethod
+    def buf_serialize(cls, inner_cls, objs, buf, inner_params={}):
+        VarIntSerializer.buf_serialize(len(objs), buf)
+        inner_buf_serialize = inner_cls.buf_serialize
+        for obj in objs:
+            inner_buf_serialize(obj, buf, **inner_params)
+
     @classmethod
     def stream_deserialize(cls, inner_cls, f, inner_params={}):
         n = VarIntSerializer.stream_deserialize(f)
@@ -277,6 +435,16 @@ class VectorSerializer(Serializer):
             r.append(inner_cls.stream_deserialize(f, **inner_params))
         return r
 
+    @classmethod
+    def buf_deserialize(cls, inner_cls, buf, pos=0, inner_params={}):
+        n, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        inner_buf_deserialize = inner_cls.buf_deserialize
+        r = []
+        for i in range(n):
+            obj, pos = inner_buf_deserialize(buf, pos, **inner_params)
+            r.append(obj)
+        return r, pos
+
 
 class uint256VectorSerializer(Serializer):
     """Serialize vectors of uint256"""
@@ -287,6 +455,13 @@ class uint256VectorSerializer(Serializer):
             assert len(uint) == 32
             f.write(uint)
 
+    @classmethod
+    def buf_serialize(cls, uints, buf):
+        VarIntSerializer.buf_serialize(len(uints), buf)
+        for uint in uints:
+            assert len(uint) == 32
+            buf += uint
+
     @classmethod
     def stream_deserialize(cls, f):
         n = VarIntSerializer.stream_deserialize(f)
@@ -295,6 +470,12 @@ class uint256VectorSerializer(Serializer):
             r.append(ser_read(f, 32))
         return r
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        n, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        data, end = buf_read(buf, pos, n * 32)
+        return [data[i:i+32] for i in range(0, len(data), 32)], end
+
 
 class intVectorSerializer(Serializer):
 
@@ -305,6 +486,11 @@ class intVectorSerializer(Serializer):
         for i in ints:
             f.write(struct.pack(b"<i", i))
 
+    @classmethod
+    def buf_serialize(cls, ints, buf):
+        VarIntSerializer.buf_serialize(len(ints), buf)
+        buf += struct.pack(b"<%di" % len(ints), *ints)
+
     @classmethod
     def stream_deserialize(cls, f):
         l = VarIntSerializer.stream_deserialize(f)
@@ -313,6 +499,14 @@ class intVectorSerializer(Serializer):
             ints.append(struct.unpack(b"<i", ser_read(f, 4))[0])
         return ints
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        l, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        if l * 4 > MAX_SIZE:
+            raise SerializationError('Asked to read 0x%x bytes; MAX_SIZE exceeded' % (l * 4))
+        ints, pos = buf_unpack(struct.Struct(b"<%di" % l), buf, pos)
+        return list(ints), pos
+
 
 class VarStringSerializer(Serializer):
     """Serialize variable length byte strings"""
@@ -322,11 +516,21 @@ class VarStringSerializer(Serializer):
         VarIntSerializer.stream_serialize(l, f)
         f.write(s)
 
+    @classmethod
+    def buf_serialize(cls, s, buf):
+        VarIntSerializer.buf_serialize(len(s), buf)
+        buf += s
+
     @classmethod
     def stream_deserialize(cls, f):
         l = VarIntSerializer.stream_deserialize(f)
         return ser_read(f, l)
 
+    @classmethod
+    def buf_deserialize(cls, buf, pos=0):
+        l, pos = VarIntSerializer.buf_deserialize(buf, pos)
+        return buf_read(buf, pos, l)
+
 
 def uint256_from_str(s):
     """Convert bytes to uint256"""
@@ -389,6 +593,8 @@ __all__ = (
         'SerializationTruncationError',
         'DeserializationExtraDataError',
         'ser_read',
+        'buf_read',
+        'buf_unpack',
         'Serializable',
         'ImmutableSerializable',
         'Serializer',
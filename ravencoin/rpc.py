@@ -30,14 +30,28 @@ try:
     import http.client as httplib
 except ImportError:
     import httplib
+import array
 import base64
 import binascii
+import collections
 import decimal
+import functools
+import itertools
 import json
+import multiprocessing
 import os
 import platform
 import re
+import select
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 try:
     import urllib.parse as urlparse
@@ -45,7 +59,8 @@ except ImportError:
     import urlparse
 
 import ravencoin
-from ravencoin.core import COIN, x, lx, b2lx, CBlock, CBlockHeader, CTransaction, COutPoint, CTxOut
+from ravencoin.core import COIN, x, lx, b2lx, CBlock, CBlockHeader, CLazyBlock, CTransaction, COutPoint, CTxOut
+from ravencoin.core.assets import get_script_asset
 from ravencoin.core.script import CScript
 from ravencoin.wallet import CRavencoinAddress, CRavencoinSecret
 
@@ -53,6 +68,14 @@ DEFAULT_USER_AGENT = "AuthServiceProxy/0.1"
 
 DEFAULT_HTTP_TIMEOUT = 30
 
+DEFAULT_BATCH_SIZE = 100
+
+# Errors sending a request on a kept-alive connection the server closed,
+# after which the request is retried once on a new connection. Once the
+# request is sent it's never retried, as the server may have run the call
+# before dropping the connection.
+_STALE_CONNECTION_ERRORS = (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
 # (un)hexlify to/from unicode, needed for Python3
 unhexlify = binascii.unhexlify
 hexlify = binascii.hexlify
@@ -82,6 +105,74 @@ def check_numeric(num):
         raise (ValueError("'{}' is not numeric".format(num)))
 
 
+def _get_service_url_and_authpair(service_url=None, service_port=None, btc_conf_file=None):
+    """Return the RPC service URL and user:password auth pair
+
+    Unless service_url is given, they are read from btc_conf_file, or the
+    raven.conf of the default data directory, and the cookie file next to it.
+    """
+    authpair = None
+
+    if service_url is None:
+        # Figure out the path to the raven.conf file
+        if btc_conf_file is None:
+            if platform.system() == 'Darwin':
+                btc_conf_file = os.path.expanduser('~/Library/Application Support/Raven/')
+            elif platform.system() == 'Windows':
+                btc_conf_file = os.path.join(os.environ['APPDATA'], 'Raven')
+            else:
+                btc_conf_file = os.path.expanduser('~/.raven')
+            btc_conf_file = os.path.join(btc_conf_file, 'raven.conf')
+
+        # Ravencoin Core accepts empty rpcuser, not specified in btc_conf_file
+        conf = {'rpcuser': ""}
+
+        # Extract contents of raven.conf to build service_url
+        try:
+            with open(btc_conf_file, 'r') as fd:
+                for line in fd.readlines():
+                    if '#' in line:
+                        line = line[:line.index('#')]
+                    if '=' not in line:
+                        continue
+                    k, v = line.split('=', 1)
+                    conf[k.strip()] = v.strip()
+
+        # Treat a missing raven.conf as though it were empty
+        except FileNotFoundError:
+            pass
+
+        if service_port is None:
+            service_port = ravencoin.params.RPC_PORT
+        conf['rpcport'] = int(conf.get('rpcport', service_port))
+        conf['rpchost'] = conf.get('rpcconnect', 'localhost')
+
+        service_url = ('%s://%s:%d' %
+                       ('http', conf['rpchost'], conf['rpcport']))
+
+        cookie_dir = conf.get('datadir', os.path.dirname(btc_conf_file))
+        if ravencoin.params.NAME != "mainnet":
+            cookie_dir = os.path.join(cookie_dir, ravencoin.params.NAME)
+        cookie_file = os.path.join(cookie_dir, ".cookie")
+        try:
+            with open(cookie_file, 'r') as fd:
+                authpair = fd.read()
+        except IOError as err:
+            if 'rpcpassword' in conf:
+                authpair = "%s:%s" % (conf['rpcuser'], conf['rpcpassword'])
+
+            else:
+                raise ValueError(
+                    'Cookie file unusable (%s) and rpcpassword not specified in the configuration file: %r' % (
+                        err, btc_conf_file))
+
+    else:
+        url = urlparse.urlparse(service_url)
+        authpair = "%s:%s" % (url.username, url.password)
+
+    return service_url, authpair
+
+
 class JSONRPCError(Exception):
     """JSON-RPC protocol error base class
 
@@ -145,79 +236,133 @@ class InWarmupError(JSONRPCError):
     RPC_ERROR_CODE = -28
 
 
-class BaseProxy(object):
-    """Base JSON-RPC proxy class. Contains only private methods; do not use
-    directly."""
+class RPCMethodStats(object):
+    """Statistics of the requests for one RPC method
 
-    def __init__(self,
-                 service_url=None,
-                 service_port=None,
-                 btc_conf_file=None,
-                 timeout=DEFAULT_HTTP_TIMEOUT,
-                 connection=None):
+    calls          - Number of requests
+    errors         - Number of failed requests, or failed calls of batches
+    request_bytes  - Total size of the requests
+    response_bytes - Total size of the response bodies
+    latency        - Total seconds from sending requests to having read the
+                     responses
+    decode_time    - Total seconds spent decoding the responses
+    """
 
-        # Create a dummy connection early on so if __init__() fails prior to
-        # __conn being created __del__() can detect the condition and handle it
-        # correctly.
-        self.__conn = None
-        authpair = None
+    __slots__ = ['calls', 'errors', 'request_bytes', 'response_bytes', 'latency',
+                 'decode_time', 'latencies']
+
+    def __init__(self, samples):
+        self.calls = 0
+        self.errors = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = 0.0
+        self.decode_time = 0.0
+        # The latencies of the most recent requests, for percentiles
+        self.latencies = collections.deque(maxlen=samples)
+
+    def latency_percentile(self, p):
+        """Return the p-th percentile (0-100) of the recent latencies, or None
+        if there were no requests"""
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)]
+
+
+class RPCStats(object):
+    """Instrumentation of the RPC requests of proxies
+
+    Pass it to a proxy as stats to record its requests. Batches are recorded
+    as batch:<method>, or batch if they mix methods. self.methods maps the
+    method names to RPCMethodStats; to_prometheus() dumps them.
+
+    samples - Number of recent latencies per method the percentiles are
+              computed from.
+    """
 
-        if service_url is None:
-            # Figure out the path to the raven.conf file
-            if btc_conf_file is None:
-                if platform.system() == 'Darwin':
-                    btc_conf_file = os.path.expanduser('~/Library/Application Support/Raven/')
-                elif platform.system() == 'Windows':
-                    btc_conf_file = os.path.join(os.environ['APPDATA'], 'Raven')
-                else:
-                    btc_conf_file = os.path.expanduser('~/.raven')
-                btc_conf_file = os.path.join(btc_conf_file, 'raven.conf')
+    QUANTILES = (0.5, 0.9, 0.99)
 
-            # Ravencoin Core accepts empty rpcuser, not specified in btc_conf_file
-            conf = {'rpcuser': ""}
+    def __init__(self, samples=1024):
+        self.samples = samples
+        self.methods = {}
+        self._lock = threading.Lock()
 
-            # Extract contents of raven.conf to build service_url
-            try:
-                with open(btc_conf_file, 'r') as fd:
-                    for line in fd.readlines():
-                        if '#' in line:
-                            line = line[:line.index('#')]
-                        if '=' not in line:
-                            continue
-                        k, v = line.split('=', 1)
-                        conf[k.strip()] = v.strip()
-
-            # Treat a missing raven.conf as though it were empty
-            except FileNotFoundError:
-                pass
+    def _get(self, method):
+        try:
+            return self.methods[method]
+        except KeyError:
+            return self.methods.setdefault(method, RPCMethodStats(self.samples))
 
-            if service_port is None:
-                service_port = ravencoin.params.RPC_PORT
-            conf['rpcport'] = int(conf.get('rpcport', service_port))
-            conf['rpchost'] = conf.get('rpcconnect', 'localhost')
+    def record(self, method, start, received, end, request_bytes, response_bytes, errors):
+        """Record a request, timed by perf_counter() values
 
-            service_url = ('%s://%s:%d' %
-                           ('http', conf['rpchost'], conf['rpcport']))
+        received is when the response was read, or None if it wasn't.
+        """
+        with self._lock:
+            stats = self._get(method)
+            stats.calls += 1
+            stats.errors += errors
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            if received is None:
+                received = end
+            stats.latency += received - start
+            stats.decode_time += end - received
+            stats.latencies.append(received - start)
+
+    def record_errors(self, method, errors):
+        """Record errors of a request that succeeded as a whole"""
+        with self._lock:
+            self._get(method).errors += errors
+
+    def reset(self):
+        with self._lock:
+            self.methods.clear()
+
+    def to_prometheus(self, prefix='ravencoin_rpc'):
+        """Return a snapshot in the Prometheus text exposition format"""
+        with self._lock:
+            methods = sorted(self.methods.items())
+            lines = ['# TYPE %s_latency_seconds summary' % prefix]
+            for method, stats in methods:
+                for q in self.QUANTILES:
+                    lines.append('%s_latency_seconds{method="%s",quantile="%s"} %r' %
+                                 (prefix, method, q, stats.latency_percentile(q * 100)))
+                lines.append('%s_latency_seconds_sum{method="%s"} %r' %
+                             (prefix, method, stats.latency))
+                lines.append('%s_latency_seconds_count{method="%s"} %d' %
+                             (prefix, method, stats.calls))
+            for name, attr, kind in (('decode_seconds_total', 'decode_time', 'counter'),
+                                     ('request_bytes_total', 'request_bytes', 'counter'),
+                                     ('response_bytes_total', 'response_bytes', 'counter'),
+                                     ('errors_total', 'errors', 'counter')):
+                lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+                for method, stats in methods:
+                    lines.append('%s_%s{method="%s"} %r' %
+                                 (prefix, name, method, getattr(stats, attr)))
+        return '\n'.join(lines) + '\n'
 
-            cookie_dir = conf.get('datadir', os.path.dirname(btc_conf_file))
-            if ravencoin.params.NAME != "mainnet":
-                cookie_dir = os.path.join(cookie_dir, ravencoin.params.NAME)
-            cookie_file = os.path.join(cookie_dir, ".cookie")
-            try:
-                with open(cookie_file, 'r') as fd:
-                    authpair = fd.read()
-            except IOError as err:
-                if 'rpcpassword' in conf:
-                    authpair = "%s:%s" % (conf['rpcuser'], conf['rpcpassword'])
 
-                else:
-                    raise ValueError(
-                        'Cookie file unusable (%s) and rpcpassword not specified in the configuration file: %r' % (
-                            err, btc_conf_file))
+class BaseProxy(object):
+    """Base JSON-RPC proxy class. Contains only private methods; do not use
+    directly."""
 
-        else:
-            url = urlparse.urlparse(service_url)
-            authpair = "%s:%s" % (url.username, url.password)
+    def __init__(self,
+                 service_url=None,
+                 service_port=None,
+                 btc_conf_file=None,
+                 timeout=DEFAULT_HTTP_TIMEOUT,
+                 connection=None,
+                 pool_size=1,
+                 stats=None):
+
+        # Create a dummy connection pool early on so if __init__() fails prior
+        # to __idle being created __del__() can detect the condition and
+        # handle it correctly.
+        self.__idle = None
+        service_url, authpair = _get_service_url_and_authpair(service_url, service_port,
+                                                              btc_conf_file)
 
         self.__service_url = service_url
         self.__url = urlparse.urlparse(service_url)
@@ -226,10 +371,12 @@ class BaseProxy(object):
             raise ValueError('Unsupported URL scheme %r' % self.__url.scheme)
 
         if self.__url.port is None:
-            port = httplib.HTTP_PORT
+            self.__port = httplib.HTTP_PORT
         else:
-            port = self.__url.port
-        self.__id_count = 0
+            self.__port = self.__url.port
+        self.__timeout = timeout
+        # next() on a count is atomic, so ids are unique across threads
+        self.__id_count = itertools.count(1)
 
         if authpair is None:
             self.__auth_header = None
@@ -237,20 +384,28 @@ class BaseProxy(object):
             authpair = authpair.encode('utf8')
             self.__auth_header = b"Basic " + base64.b64encode(authpair)
 
+        # Up to pool_size keep-alive connections are opened on demand, one
+        # per request in flight. Idle ones are reused most recent first.
         if connection:
-            self.__conn = connection
-        else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port=port,
-                                                 timeout=timeout)
+            pool_size = 1
+        self.pool_size = pool_size
+        self.__slots = threading.BoundedSemaphore(pool_size)
+        self.__idle = queue.LifoQueue()
+        if connection:
+            self.__idle.put(connection)
+        self.stats = stats
 
-    def _call(self, service_name, *args):
-        self.__id_count += 1
+    def _request(self, postdata, timeout=None, parse=None, method=None):
+        """POST postdata on a pooled connection, returning the decoded JSON
+        response
 
-        postdata = json.dumps({'version': '1.1',
-                               'method': service_name,
-                               'params': args,
-                               'id': self.__id_count})
+        timeout overrides the timeout of the proxy for this request.
+
+        parse, if given, decodes the response body instead of
+        _parse_response().
 
+        method names the request in the stats.
+        """
         headers = {
             'Host': self.__url.hostname,
             'User-Agent': DEFAULT_USER_AGENT,
@@ -260,60 +415,270 @@ class BaseProxy(object):
         if self.__auth_header is not None:
             headers['Authorization'] = self.__auth_header
 
-        self.__conn.request('POST', self.__url.path, postdata, headers)
-
-        response = self._get_response()
-        err = response.get('error')
-        if err is not None:
-            if isinstance(err, dict):
-                raise JSONRPCError(
-                    {'code': err.get('code', -345),
-                     'message': err.get('message', 'error message not specified')})
-            raise JSONRPCError({'code': -344, 'message': str(err)})
-        elif 'result' not in response:
-            raise JSONRPCError({
-                'code': -343, 'message': 'missing JSON-RPC result'})
-        else:
-            return response['result']
-
-    def _batch(self, rpc_call_list):
-        postdata = json.dumps(list(rpc_call_list))
-
-        headers = {
-            'Host': self.__url.hostname,
-            'User-Agent': DEFAULT_USER_AGENT,
-            'Content-type': 'application/json',
-        }
+        with self.__slots:
+            try:
+                conn = self.__idle.get_nowait()
+            except queue.Empty:
+                conn = httplib.HTTPConnection(self.__url.hostname, port=self.__port,
+                                              timeout=self.__timeout)
+            if timeout is not None:
+                _set_timeout(conn, timeout)
+            start = received = None
+            data = b''
+            errors = 1
+            try:
+                reused = conn.sock is not None
+                if reused and _is_dropped(conn.sock):
+                    # http.client reopens closed connections by itself
+                    conn.close()
+                    reused = False
+                start = time.perf_counter()
+                try:
+                    conn.request('POST', self.__url.path, postdata, headers)
+                except _STALE_CONNECTION_ERRORS:
+                    if not reused:
+                        raise
+                    # Closed before the whole request was sent
+                    conn.close()
+                    conn.request('POST', self.__url.path, postdata, headers)
+                data, status, reason = self._get_response(conn)
+                received = time.perf_counter()
+                r = (parse or _parse_response)(data, status, reason)
+                errors = 0
+                return r
+            except JSONRPCError:
+                raise
+            except BaseException:
+                # Don't leave a half read response for the next request
+                conn.close()
+                raise
+            finally:
+                if timeout is not None:
+                    _set_timeout(conn, self.__timeout)
+                self.__idle.put(conn)
+                if self.stats is not None and start is not None:
+                    self.stats.record(method, start, received, time.perf_counter(),
+                                      len(postdata), len(data), errors)
+
+    def _call(self, service_name, *args, timeout=None):
+        postdata = json.dumps({'version': '1.1',
+                               'method': service_name,
+                               'params': args,
+                               'id': next(self.__id_count)})
 
-        if self.__auth_header is not None:
-            headers['Authorization'] = self.__auth_header
+        return self._request(postdata, timeout, _parse_result, service_name)
 
-        self.__conn.request('POST', self.__url.path, postdata, headers)
-        return self._get_response()
+    def _call_hex(self, service_name, *args, timeout=None):
+        """Like _call(), for methods returning a hex string, which is
+        returned decoded
 
-    def _get_response(self):
-        http_response = self.__conn.getresponse()
+        The hex is decoded straight from the HTTP response body, without
+        parsing it as JSON or copying it to intermediate strings.
+        """
+        postdata = json.dumps({'version': '1.1',
+                               'method': service_name,
+                               'params': args,
+                               'id': next(self.__id_count)})
+
+        return self._request(postdata, timeout, _parse_hex_response, service_name)
+
+    def _batch(self, rpc_call_list, timeout=None):
+        rpc_call_list = list(rpc_call_list)
+        postdata = json.dumps(rpc_call_list)
+        name = _batch_name(rpc_call_list)
+        response = self._request(postdata, timeout, method=name)
+        if self.stats is not None and isinstance(response, list):
+            self.stats.record_errors(name, _count_errors(response))
+        return response
+
+    def _get_response(self, conn):
+        """Read the response to a request, as (body, status, reason)"""
+        http_response = conn.getresponse()
         if http_response is None:
             raise JSONRPCError({
                 'code': -342, 'message': 'missing HTTP response from server'})
 
-        rdata = http_response.read().decode('utf8')
-        try:
-            return json.loads(rdata, parse_float=decimal.Decimal)
-        except Exception:
-            raise JSONRPCError({
-                'code': -342,
-                'message': ('non-JSON HTTP response with \'%i %s\' from server: \'%.20s%s\''
-                            % (http_response.status, http_response.reason,
-                               rdata, '...' if len(rdata) > 20 else ''))})
+        return http_response.read(), http_response.status, http_response.reason
+
+    def batch(self, chunk_size=DEFAULT_BATCH_SIZE):
+        """Return an RPCBatch, to make many calls in a few round trips"""
+        return RPCBatch(self, chunk_size)
 
     def close(self):
-        if self.__conn is not None:
-            self.__conn.close()
+        """Close the idle connections of the pool"""
+        while self.__idle is not None:
+            try:
+                self.__idle.get_nowait().close()
+            except queue.Empty:
+                break
 
     def __del__(self):
-        if self.__conn is not None:
-            self.__conn.close()
+        self.close()
+
+
+def _is_dropped(sock):
+    """Whether the server closed the idle connection of sock
+
+    An idle connection has nothing to read, unless the server closed it.
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+def _parse_response(data, status, reason):
+    """Decode the JSON body of an HTTP response from the server"""
+    rdata = data.decode('utf8')
+    try:
+        return json.loads(rdata, parse_float=decimal.Decimal)
+    except Exception:
+        raise JSONRPCError({
+            'code': -342,
+            'message': ('non-JSON HTTP response with \'%i %s\' from server: \'%.20s%s\''
+                        % (status, reason, rdata, '...' if len(rdata) > 20 else ''))})
+
+
+# The response to a call returning a hex string, as sent by ravend, around
+# the hex
+_HEX_RESULT_PREFIX = re.compile(br'\s*\{\s*"result"\s*:\s*"')
+_HEX_RESULT_SUFFIX = re.compile(br'"\s*,\s*"error"\s*:\s*null\s*,\s*"id"\s*:\s*[^,{}\[\]"]*\}\s*\Z')
+
+
+def _parse_hex_response(data, status, reason):
+    """Decode the hex string result in the JSON body of an HTTP response
+
+    Any other response, like an error, is parsed as JSON.
+    """
+    m = _HEX_RESULT_PREFIX.match(data)
+    if m is not None:
+        end = data.find(b'"', m.end())
+        if end >= 0 and _HEX_RESULT_SUFFIX.match(data, end):
+            try:
+                return binascii.unhexlify(memoryview(data)[m.end():end])
+            except binascii.Error:
+                pass
+
+    r = _get_result(_parse_response(data, status, reason))
+    if not isinstance(r, str):
+        raise JSONRPCError({'code': -343, 'message': 'JSON-RPC result is not a hex string'})
+    return unhexlify(r)
+
+
+def _parse_result(data, status, reason):
+    """Decode the result of a single call, raising its error if any"""
+    return _get_result(_parse_response(data, status, reason))
+
+
+def _batch_name(rpc_call_list):
+    """Name of a batch request in the stats: batch:<method> if all calls are
+    to the same method, otherwise batch"""
+    methods = set(call.get('method') for call in rpc_call_list)
+    if len(methods) == 1:
+        return 'batch:%s' % methods.pop()
+    return 'batch'
+
+
+def _count_errors(response):
+    """Number of failed calls in the response to a batch"""
+    return sum(1 for r in response if isinstance(r, dict) and r.get('error') is not None)
+
+
+def _get_result(response):
+    """Return the result of a JSON-RPC response, raising its error if any"""
+    err = response.get('error')
+    if err is not None:
+        if isinstance(err, dict):
+            raise JSONRPCError(
+                {'code': err.get('code', -345),
+                 'message': err.get('message', 'error message not specified')})
+        raise JSONRPCError({'code': -344, 'message': str(err)})
+    elif 'result' not in response:
+        raise JSONRPCError({
+            'code': -343, 'message': 'missing JSON-RPC result'})
+    else:
+        return response['result']
+
+
+def _set_timeout(conn, timeout):
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+
+
+class _PendingCall(BaseException):
+    """Raised by a replaying _call() for a call that still has to be made
+
+    A BaseException, so the bodies of Proxy methods don't catch it.
+    """
+
+    def __init__(self, service_name, args):
+        super(_PendingCall, self).__init__(service_name)
+        self.service_name = service_name
+        self.args = args
+
+
+class _Replay(object):
+    """A call of a typed proxy method, made by replaying RPC results
+
+    The body of the method is run with the results of the RPC calls made so
+    far, until it returns rather than asking for another call. The conversion
+    of arguments and results is thus exactly that of Proxy, however the RPC
+    calls are actually made.
+    """
+
+    __slots__ = ['method', 'args', 'kwargs', 'results', 'value']
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.results = []
+        self.value = None
+
+    def step(self, proxy):
+        """Run the method body on proxy, a _ReplayingProxy
+
+        Returns the (service_name, args) of the next RPC call to make, whose
+        result or JSONRPCError is then to be appended to self.results, or
+        None with the return value in self.value.
+        """
+        proxy._replay = collections.deque(self.results)
+        try:
+            self.value = self.method(proxy, *self.args, **self.kwargs)
+        except _PendingCall as pending:
+            return pending.service_name, pending.args
+        finally:
+            proxy._replay = None
+        return None
+
+
+class _ReplayingProxy(object):
+    """Mixin for proxies running method bodies through _Replay"""
+
+    _replay = None
+
+    def _call(self, service_name, *args, timeout=None):
+        if self._replay is None:
+            raise TypeError('%s._call() is only usable from Proxy methods; use call()' %
+                            self.__class__.__name__)
+        if not self._replay:
+            raise _PendingCall(service_name, args)
+        r = self._replay.popleft()
+        if isinstance(r, JSONRPCError):
+            raise r
+        return r
+
+    def _call_hex(self, service_name, *args, timeout=None):
+        return unhexlify(self._call(service_name, *args))
+
+
+@functools.lru_cache()
+def _replaying_class(cls):
+    """Subclass of proxy class cls for stand-ins, which are never initialized"""
+    return type(cls.__name__, (_ReplayingProxy, cls),
+                {'__module__': cls.__module__, '__del__': lambda self: None})
 
 
 class RawProxy(BaseProxy):
@@ -345,7 +710,7 @@ class RawProxy(BaseProxy):
             raise AttributeError
 
         # Create a callable to do the actual call
-        f = lambda *args: self._call(name, *args)
+        f = lambda *args, **kwargs: self._call(name, *args, **kwargs)
 
         # Make debuggers show <function ravencoin.rpc.name> rather than <function
         # ravencoin.rpc.<lambda>>
@@ -353,6 +718,131 @@ class RawProxy(BaseProxy):
         return f
 
 
+class UnspentOutputs(object):
+    """Columnar listunspent() results
+
+    The outputs are held in parallel sequences rather than a dict each:
+
+    txids         - list of txids, as bytes
+    vouts         - array of output indexes
+    amounts       - array of amounts, in satoshis
+    confirmations - array of confirmation counts
+    scriptPubKeys - list of scriptPubKeys, as bytes
+    addresses     - list of addresses, as strings; None for outputs without
+    asset_names   - list of the names of the assets held; None for outputs
+                    holding RVN only
+    asset_amounts - array of the asset amounts, in satoshis; 0 for outputs
+                    holding RVN only
+
+    outpoint(), scriptPubKey(), address() and asset() build the usual objects
+    for a single output, and indexing gives its dict as returned by
+    Proxy.listunspent(), without the fields not kept here.
+    """
+
+    __slots__ = ['txids', 'vouts', 'amounts', 'confirmations', 'scriptPubKeys', 'addresses',
+                 'asset_names', 'asset_amounts']
+
+    def __init__(self, txids=(), vouts=(), amounts=(), confirmations=(), scriptPubKeys=(),
+                 addresses=(), asset_names=None, asset_amounts=None):
+        self.txids = list(txids)
+        self.vouts = array.array('I', vouts)
+        self.amounts = array.array('q', amounts)
+        self.confirmations = array.array('q', confirmations)
+        self.scriptPubKeys = list(scriptPubKeys)
+        self.addresses = list(addresses)
+        # Without the asset columns, every output holds RVN only
+        if asset_names is None:
+            asset_names = [None] * len(self.txids)
+        if asset_amounts is None:
+            asset_amounts = [0] * len(self.txids)
+        self.asset_names = list(asset_names)
+        self.asset_amounts = array.array('q', asset_amounts)
+
+    @classmethod
+    def from_json(cls, r):
+        """Build from the JSON result of listunspent
+
+        The assets are read from the scriptPubKeys.
+        """
+        scriptPubKeys = [bytes.fromhex(u['scriptPubKey']) for u in r]
+        assets = [get_script_asset(scriptPubKey) or (None, 0) for scriptPubKey in scriptPubKeys]
+        return cls([bytes.fromhex(u['txid'])[::-1] for u in r],
+                   [u['vout'] for u in r],
+                   [int(u['amount'] * COIN) for u in r],
+                   [u.get('confirmations', 0) for u in r],
+                   scriptPubKeys,
+                   [u.get('address') for u in r],
+                   [name for name, amount in assets],
+                   [amount for name, amount in assets])
+
+    def __len__(self):
+        return len(self.txids)
+
+    def outpoint(self, i):
+        return COutPoint(self.txids[i], self.vouts[i])
+
+    def scriptPubKey(self, i):
+        return CScript(self.scriptPubKeys[i])
+
+    def address(self, i):
+        """Return the CRavencoinAddress of output i, or None"""
+        address = self.addresses[i]
+        if address is None:
+            return None
+        return CRavencoinAddress(address)
+
+    def asset(self, i):
+        """Return (asset name, amount) of the asset held by output i, or None"""
+        name = self.asset_names[i]
+        if name is None:
+            return None
+        return name, self.asset_amounts[i]
+
+    def __getitem__(self, i):
+        unspent = {'outpoint': self.outpoint(i),
+                   'amount': self.amounts[i],
+                   'confirmations': self.confirmations[i],
+                   'scriptPubKey': self.scriptPubKey(i)}
+        if self.addresses[i] is not None:
+            unspent['address'] = self.address(i)
+        return unspent
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return '%s(%d outputs, %d total)' % (self.__class__.__name__, len(self), sum(self.amounts))
+
+
+class Balances(object):
+    """Columnar balances, of asset names or addresses
+
+    keys    - list of the asset names or addresses
+    amounts - array of the balances, in satoshis
+    """
+
+    __slots__ = ['keys', 'amounts']
+
+    def __init__(self, keys=(), amounts=()):
+        self.keys = list(keys)
+        self.amounts = array.array('q', amounts)
+
+    @classmethod
+    def from_json(cls, r):
+        """Build from a JSON result mapping the keys to the amounts"""
+        return cls(r.keys(), [int(amount * COIN) for amount in r.values()])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def items(self):
+        return zip(self.keys, self.amounts)
+
+    def __repr__(self):
+        return '%s(%d balances)' % (self.__class__.__name__, len(self))
+
+
 class Proxy(BaseProxy):
     """Proxy to a ravencoin RPC service
 
@@ -381,6 +871,14 @@ class Proxy(BaseProxy):
         be used.
 
         ``timeout`` - timeout in seconds before the HTTP interface times out
+
+        ``pool_size`` - number of keep-alive connections to the server. The
+        proxy can be shared between threads; with a pool_size above 1 up to
+        that many calls are in flight at once, otherwise they are queued.
+        Connections the server closed while idle are reopened transparently.
+
+        ``stats`` - an RPCStats recording the latency, sizes and errors of
+        the requests
         """
 
         super(Proxy, self).__init__(service_url=service_url,
@@ -389,9 +887,13 @@ class Proxy(BaseProxy):
                                     timeout=timeout,
                                     **kwargs)
 
-    def call(self, service_name, *args):
-        """Call an RPC method by name and raw (JSON encodable) arguments"""
-        return self._call(service_name, *args)
+    def call(self, service_name, *args, timeout=None):
+        """Call an RPC method by name and raw (JSON encodable) arguments
+
+        timeout - timeout in seconds for this call, instead of the one of
+                  the proxy
+        """
+        return self._call(service_name, *args, timeout=timeout)
 
     def dumpprivkey(self, addr):
         """Return the private key matching an address
@@ -488,7 +990,10 @@ class Proxy(BaseProxy):
             raise TypeError('%s.getblockheader(): block_hash must be bytes; got %r instance' %
                             (self.__class__.__name__, block_hash.__class__))
         try:
-            r = self._call('getblockheader', block_hash, verbose)
+            if verbose:
+                r = self._call('getblockheader', block_hash, verbose)
+            else:
+                r = self._call_hex('getblockheader', block_hash, verbose)
         except InvalidAddressOrKeyError as ex:
             raise IndexError('%s.getblockheader(): %s (%d)' %
                              (self.__class__.__name__, ex.error['message'], ex.error['code']))
@@ -503,7 +1008,7 @@ class Proxy(BaseProxy):
                     'nextblockhash': nextblockhash,
                     'chainwork': x(r['chainwork'])}
         else:
-            return CBlockHeader.deserialize(unhexlify(r))
+            return CBlockHeader.deserialize(r)
 
     def getblock(self, block_hash):
         """Get block <block_hash>
@@ -519,11 +1024,11 @@ class Proxy(BaseProxy):
             # With this change ( https://github.com/ravencoin/ravencoin/commit/96c850c20913b191cff9f66fedbb68812b1a41ea#diff-a0c8f511d90e83aa9b5857e819ced344 ),
             # ravencoin core's rpc takes 0/1/2 instead of true/false as the 2nd argument which specifies verbosity, since v0.15.0.
             # The change above is backward-compatible so far; the old "false" is taken as the new "0".
-            r = self._call('getblock', block_hash, False)
+            r = self._call_hex('getblock', block_hash, False)
         except InvalidAddressOrKeyError as ex:
             raise IndexError('%s.getblock(): %s (%d)' %
                              (self.__class__.__name__, ex.error['message'], ex.error['code']))
-        return CBlock.deserialize(unhexlify(r))
+        return CBlock.deserialize(r)
 
     def getblockcount(self):
         """Return the number of blocks in the longest block chain"""
@@ -597,7 +1102,10 @@ class Proxy(BaseProxy):
         enabled the transaction may not be available.
         """
         try:
-            r = self._call('getrawtransaction', b2lx(txid), 1 if verbose else 0)
+            if verbose:
+                r = self._call('getrawtransaction', b2lx(txid), 1)
+            else:
+                r = self._call_hex('getrawtransaction', b2lx(txid), 0)
         except InvalidAddressOrKeyError as ex:
             raise IndexError('%s.getrawtransaction(): %s (%d)' %
                              (self.__class__.__name__, ex.error['message'], ex.error['code']))
@@ -611,7 +1119,7 @@ class Proxy(BaseProxy):
             del r['vout']
             r['blockhash'] = lx(r['blockhash']) if 'blockhash' in r else None
         else:
-            r = CTransaction.deserialize(unhexlify(r))
+            r = CTransaction.deserialize(r)
 
         return r
 
@@ -672,12 +1180,15 @@ class Proxy(BaseProxy):
         r = self._call('importaddress', addr, label, rescan)
         return r
 
-    def listunspent(self, minconf=0, maxconf=9999999, addrs=None):
+    def listunspent(self, minconf=0, maxconf=9999999, addrs=None, columnar=False):
         """Return unspent transaction outputs in wallet
 
         Outputs will have between minconf and maxconf (inclusive)
         confirmations, optionally filtered to only include txouts paid to
         addresses in addrs.
+
+        columnar - Return an UnspentOutputs instead of a list of dicts, which
+                   is much faster and smaller for large wallets.
         """
         r = None
         if addrs is None:
@@ -686,6 +1197,9 @@ class Proxy(BaseProxy):
             addrs = [str(addr) for addr in addrs]
             r = self._call('listunspent', minconf, maxconf, addrs)
 
+        if columnar:
+            return UnspentOutputs.from_json(r)
+
         r2 = []
         for unspent in r:
             unspent['outpoint'] = COutPoint(lx(unspent['txid']), unspent['vout'])
@@ -827,7 +1341,8 @@ class RavenRawProxy(RawProxy):
         super(RavenRawProxy, self).__init__(service_url=service_url,
                                             service_port=service_port,
                                             btc_conf_file=rvn_conf_file,
-                                            timeout=timeout)
+                                            timeout=timeout,
+                                            **kwargs)
 
 
 class RavenProxy(Proxy):
@@ -846,7 +1361,8 @@ class RavenProxy(Proxy):
         super(RavenProxy, self).__init__(service_url=service_url,
                                          service_port=service_port,
                                          btc_conf_file=rvn_conf_file,
-                                         timeout=timeout)
+                                         timeout=timeout,
+                                         **kwargs)
 
     """ Raven asset support """
 
@@ -903,14 +1419,24 @@ class RavenProxy(Proxy):
         r = self._call('listmyassets', asset, verbose, count, start)
         return r
 
-    def listassetbalancesbyaddress(self, address):
-        """Lists asset balance by address"""
+    def listassetbalancesbyaddress(self, address, columnar=False):
+        """Lists asset balance by address
+
+        columnar - Return a Balances of the asset names instead of a dict
+        """
         r = self._call('listassetbalancesbyaddress', str(address))
+        if columnar:
+            return Balances.from_json(r)
         return r
 
-    def listaddressesbyasset(self, asset_name):
-        """Lists addresses by asset"""
+    def listaddressesbyasset(self, asset_name, columnar=False):
+        """Lists addresses by asset
+
+        columnar - Return a Balances of the addresses instead of a dict
+        """
         r = self._call('listaddressesbyasset', str(asset_name))
+        if columnar:
+            return Balances.from_json(r)
         return r
 
     def getassetdata(self, asset_name):
@@ -1133,6 +1659,219 @@ class RavenProxy(Proxy):
         return r
 
 
+def _raw_call(proxy, service_name, *args):
+    return proxy._call(service_name, *args)
+
+
+class RPCBatch(object):
+    """Calls queued to be sent as JSON-RPC batch requests
+
+    Calls are queued by calling the methods of the proxy on the batch, and
+    made by execute(), which returns their results in order:
+
+    >>> batch = proxy.batch()
+    >>> for height in range(1000):
+    ...     batch.getblockhash(height)
+    >>> block_hashes = batch.execute()
+
+    With a Proxy the results are converted as its methods do; with a RawProxy
+    any method can be queued, and its JSON result is returned.
+    """
+
+    def __init__(self, proxy, chunk_size=DEFAULT_BATCH_SIZE):
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1; got %r' % chunk_size)
+        self.proxy = proxy
+        self.chunk_size = chunk_size
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def call(self, service_name, *args):
+        """Queue a call by RPC method name and raw (JSON encodable) arguments,
+        whose result is not converted, whatever the proxy"""
+        self.calls.append(_Replay(_raw_call, (service_name,) + args, {}))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        method = getattr(self.proxy.__class__, name, None)
+        if hasattr(BaseProxy, name):
+            method = None
+        if method is None and isinstance(self.proxy, RawProxy):
+            f = lambda *args: self.call(name, *args)
+        elif callable(method):
+            f = lambda *args, **kwargs: self.calls.append(_Replay(method, args, kwargs))
+        else:
+            raise AttributeError('%r object has no method %r' %
+                                 (self.proxy.__class__.__name__, name))
+        f.__name__ = name
+        return f
+
+    def execute(self, return_exceptions=False, timeout=None):
+        """Make the queued calls, returning their results in order
+
+        The calls are sent chunk_size at a time, each chunk in one round trip.
+        Calls that fail raise the JSONRPCError subclass, or other exception,
+        the proxy method would have. The first such exception is raised after
+        all calls were made, unless return_exceptions is true, in which case
+        it's returned in place of the result.
+
+        timeout - timeout in seconds for each round trip, instead of the one
+                  of the proxy
+
+        The queue is emptied, so the batch can be reused.
+        """
+        calls, self.calls = self.calls, []
+        results = [None] * len(calls)
+        stand_in = object.__new__(_replaying_class(self.proxy.__class__))
+
+        # Most methods make one RPC call; those making more take a round of
+        # requests for each.
+        todo = range(len(calls))
+        while todo:
+            pending = []
+            for i in todo:
+                try:
+                    request = calls[i].step(stand_in)
+                except Exception as err:
+                    results[i] = err
+                    continue
+                if request is None:
+                    results[i] = calls[i].value
+                else:
+                    pending.append((i, request))
+
+            for chunk_start in range(0, len(pending), self.chunk_size):
+                self._send(calls, pending[chunk_start:chunk_start + self.chunk_size], timeout)
+            todo = [i for i, request in pending]
+
+        if not return_exceptions:
+            for r in results:
+                if isinstance(r, Exception):
+                    raise r
+        return results
+
+    def _send(self, calls, pending, timeout):
+        response = self.proxy._batch([{'version': '1.1',
+                                       'method': service_name,
+                                       'params': args,
+                                       'id': n}
+                                      for n, (i, (service_name, args)) in enumerate(pending)],
+                                     timeout=timeout)
+        if not isinstance(response, list):
+            # The batch as a whole was rejected
+            _get_result(response)
+            raise JSONRPCError({'code': -343, 'message': 'missing JSON-RPC result'})
+
+        by_id = {}
+        for r in response:
+            if isinstance(r, dict):
+                by_id[r.get('id')] = r
+        for n, (i, request) in enumerate(pending):
+            try:
+                result = _get_result(by_id.get(n, {}))
+            except JSONRPCError as err:
+                result = err
+            calls[i].results.append(result)
+
+
+def _fetch_blocks(proxy, heights, chunk_size, executor):
+    """Fetch the hashes and serializations of the blocks at heights
+
+    The blocks are fetched with _call_hex(), which decodes the hex straight
+    from the response body; a batch response would be parsed as JSON first.
+    The calls are made concurrently in executor, the results kept in height
+    order.
+    """
+    batch = proxy.batch(chunk_size)
+    for height in heights:
+        batch.call('getblockhash', height)
+    block_hashes = batch.execute()
+    return block_hashes, list(executor.map(functools.partial(proxy._call_hex, 'getblock'),
+                                           block_hashes, itertools.repeat(0)))
+
+
+def _decode_block(args):
+    """Deserializes a block fetched by iter_blocks(), optionally passing it
+    through map_func
+    """
+    block_hash, raw_block, map_func, lazy = args
+    if lazy:
+        block = CLazyBlock.deserialize(raw_block)
+    else:
+        block = CBlock.buf_deserialize(raw_block)[0]
+    # Spare hashing the header, which for KAWPOW is slow
+    object.__setattr__(block, '_cached_GetHash', lx(block_hash))
+    if map_func is not None:
+        block = map_func(block)
+    return block
+
+
+def iter_blocks(proxy, start=0, end=None, window=DEFAULT_BATCH_SIZE, prefetch=2,
+                processes=1, map_func=None, lazy=False):
+    """Yields (height, block) for the blocks of the best chain from height
+    start up to end (exclusive; None is the tip included), in height order.
+
+    Blocks are fetched window heights at a time: one batch of getblockhash
+    calls, then a getblock call per block, made concurrently over the
+    proxy's pool_size connections. Up to prefetch windows are fetched ahead
+    in background threads while the blocks are consumed.
+
+    processes - Number of worker processes the deserialization is spread
+                across. 1 (the default) deserializes in the calling thread,
+                None uses os.cpu_count() workers.
+
+    map_func  - Optional function applied to every CBlock; its result is
+                yielded instead of the block. With processes != 1 it runs
+                in the workers, so it must be picklable (e.g. a module
+                level function) and should return something smaller than
+                the block to keep inter-process traffic down.
+
+    lazy      - Yield CLazyBlock instead of CBlock; transactions are only
+                decoded when accessed.
+    """
+    if end is None:
+        end = proxy._call('getblockcount') + 1
+    windows = (range(height, min(height + window, end))
+               for height in range(start, end, window))
+
+    pool = None if processes == 1 else multiprocessing.Pool(processes)
+    try:
+        # One thread per connection for the getblock calls, shared by the
+        # windows being fetched
+        with ThreadPoolExecutor(prefetch + 1) as executor, \
+                ThreadPoolExecutor(proxy.pool_size) as getblock_executor:
+            fetches = collections.deque()
+            for heights in windows:
+                fetches.append((heights, executor.submit(_fetch_blocks, proxy, heights,
+                                                          DEFAULT_BATCH_SIZE,
+                                                          getblock_executor)))
+                if len(fetches) > prefetch:
+                    for r in _decode_window(fetches.popleft(), pool, map_func, lazy):
+                        yield r
+            while fetches:
+                for r in _decode_window(fetches.popleft(), pool, map_func, lazy):
+                    yield r
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _decode_window(fetch, pool, map_func, lazy):
+    heights, future = fetch
+    block_hashes, raw_blocks = future.result()
+    jobs = [(block_hash, raw_block, map_func, lazy)
+            for block_hash, raw_block in zip(block_hashes, raw_blocks)]
+    if pool is None:
+        blocks = map(_decode_block, jobs)
+    else:
+        blocks = pool.imap(_decode_block, jobs, chunksize=8)
+    return zip(heights, blocks)
+
+
 __all__ = (
     'JSONRPCError',
     'ForbiddenBySafeModeError',
@@ -1146,4 +1885,10 @@ __all__ = (
     'Proxy',
     'RavenRawProxy',
     'RavenProxy',
+    'RPCMethodStats',
+    'RPCStats',
+    'UnspentOutputs',
+    'Balances',
+    'RPCBatch',
+    'iter_blocks',
 )
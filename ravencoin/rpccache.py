@@ -0,0 +1,196 @@
+# Copyright (C) 2018-2020 The python-ravencoinlib developers
+#
+# This file is part of python-ravencoinlib.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-ravencoinlib, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""Caching of RPC lookups of immutable data
+
+>>> proxy = CachingProxy(RavenProxy(), path='rpccache.db')
+>>> block = proxy.getblock(proxy.getblockhash(1000))
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import dbm
+import threading
+import time
+
+from ravencoin.core import CBlock, CBlockHeader, CTransaction
+
+DEFAULT_CACHE_SIZE = 4096
+
+DEFAULT_MIN_CONFIRMATIONS = 6
+
+DEFAULT_TIP_INTERVAL = 10
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class CachingProxy(object):
+    """Wrapper of a Proxy caching the results of lookups of immutable data
+
+    Cached are getblockhash(), and getblock(), getblockheader() and
+    getrawtransaction() without verbose. Other methods are passed through to
+    the proxy.
+
+    Blocks, headers and transactions are looked up by hash, so they can't
+    change; reorgs only change which height a block is at, and whether a
+    transaction is confirmed at all. Hence block hashes are only cached for
+    heights at least min_confirmations deep, and transactions once they have
+    that many confirmations. Blocks and headers are always cached.
+
+    maxsize - Number of results kept in memory, least recently used ones
+              being dropped first.
+
+    path    - Optional file name of a dbm database the results are also
+              stored in, serialized, so they survive restarts.
+
+    tip_interval - Minimum number of seconds between looking up the block
+                   count, to tell whether a height is deep enough.
+
+    hits and misses count the lookups per method name; cache_info() gives
+    the totals. Like the proxy, the wrapper can be shared between threads.
+    """
+
+    def __init__(self, proxy, maxsize=DEFAULT_CACHE_SIZE, path=None,
+                 min_confirmations=DEFAULT_MIN_CONFIRMATIONS, tip_interval=DEFAULT_TIP_INTERVAL):
+        self.proxy = proxy
+        self.maxsize = maxsize
+        self.min_confirmations = min_confirmations
+        self.tip_interval = tip_interval
+        self.db = None if path is None else dbm.open(path, 'c')
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Highest block count seen; tips only ever go back a few blocks in
+        # reorgs, which min_confirmations allows for
+        self._tip = -1
+        self._tip_time = None
+
+    def __getattr__(self, name):
+        return getattr(self.proxy, name)
+
+    def _get(self, method, key, deserialize):
+        with self._lock:
+            try:
+                value = self._cache[key]
+            except KeyError:
+                data = None
+                if self.db is not None:
+                    data = self.db.get(key)
+                if data is None:
+                    self.misses[method] += 1
+                    return None
+                value = deserialize(data)
+                self._remember(key, value)
+            else:
+                self._cache.move_to_end(key)
+            self.hits[method] += 1
+            return value
+
+    def _put(self, key, value, data):
+        with self._lock:
+            self._remember(key, value)
+            if self.db is not None:
+                self.db[key] = data
+
+    def _remember(self, key, value):
+        self._cache[key] = value
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def getblockhash(self, height):
+        """Return hash of block in best-block-chain at height, as Proxy"""
+        key = b'height:%d' % height
+        block_hash = self._get('getblockhash', key, bytes)
+        if block_hash is None:
+            now = time.time()
+            # The lock isn't held during the calls, which would serialize them
+            with self._lock:
+                refresh = (height > self._tip - self.min_confirmations and
+                           (self._tip_time is None or now - self._tip_time >= self.tip_interval))
+            if refresh:
+                block_count = self.proxy.getblockcount()
+                with self._lock:
+                    self._tip = max(self._tip, block_count)
+                    self._tip_time = now
+            block_hash = self.proxy.getblockhash(height)
+            with self._lock:
+                confirmed = height <= self._tip - self.min_confirmations
+            if confirmed:
+                self._put(key, block_hash, block_hash)
+        return block_hash
+
+    def getblock(self, block_hash):
+        """Get block <block_hash>, as Proxy"""
+        if not isinstance(block_hash, bytes):
+            return self.proxy.getblock(block_hash)
+        key = b'block:' + block_hash
+        block = self._get('getblock', key, CBlock.deserialize)
+        if block is None:
+            block = self.proxy.getblock(block_hash)
+            self._put(key, block, block.serialize())
+        return block
+
+    def getblockheader(self, block_hash, verbose=False):
+        """Get block header <block_hash>, as Proxy
+
+        Verbose results depend on the tip and are not cached.
+        """
+        if verbose or not isinstance(block_hash, bytes):
+            return self.proxy.getblockheader(block_hash, verbose)
+        key = b'header:' + block_hash
+        header = self._get('getblockheader', key, CBlockHeader.deserialize)
+        if header is None:
+            header = self.proxy.getblockheader(block_hash)
+            self._put(key, header, header.serialize())
+        return header
+
+    def getrawtransaction(self, txid, verbose=False):
+        """Return transaction with hash txid, as Proxy
+
+        Verbose results depend on the tip and are not cached, but do cache
+        the transaction.
+        """
+        if not isinstance(txid, bytes):
+            return self.proxy.getrawtransaction(txid, verbose)
+        key = b'tx:' + txid
+        if not verbose:
+            tx = self._get('getrawtransaction', key, CTransaction.deserialize)
+            if tx is not None:
+                return tx
+
+        # The confirmations are needed to tell if it can be cached
+        r = self.proxy.getrawtransaction(txid, True)
+        if r.get('confirmations', 0) >= self.min_confirmations:
+            self._put(key, r['tx'], r['tx'].serialize())
+        return r if verbose else r['tx']
+
+    def cache_info(self):
+        """Return the total hits and misses, and the size of the cache"""
+        with self._lock:
+            return CacheInfo(sum(self.hits.values()), sum(self.misses.values()),
+                             self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        """Empty the in-memory cache and the statistics"""
+        with self._lock:
+            self._cache.clear()
+            self.hits.clear()
+            self.misses.clear()
+
+    def close(self):
+        """Close the database and the proxy"""
+        with self._lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+        self.proxy.close()
@@ -0,0 +1,128 @@
+# Copyright (C) 2020 The python-ravencoinlib developers
+#
+# This file is part of python-ravencoinlib.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-ravencoinlib, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ravencoin.blockchain import Blockchain
+from ravencoin.blockchain.addressindex import (ADDRESS_P2PKH, ADDRESS_P2SH, AddressIndex,
+                                               AddressIndexEntry, script_address_key)
+from ravencoin.core import COIN, CBlock, COutPoint, CTransaction, CTxIn, CTxOut
+from ravencoin.core.script import CScript, OP_CHECKSIG, OP_DROP, OP_RVN_ASSET
+from ravencoin.tests.test_blockchain import fake_block_hash, write_chain_with_undo
+from ravencoin.utxo import Coin
+from ravencoin.wallet import P2PKHRavencoinAddress
+
+P2PKH_A = CScript(b'\x76\xa9\x14' + b'\xaa' * 20 + b'\x88\xac')
+P2PKH_B = CScript(b'\x76\xa9\x14' + b'\xbb' * 20 + b'\x88\xac')
+P2SH_C = CScript(b'\xa9\x14' + b'\xcc' * 20 + b'\x87')
+NUKA_B = CScript(bytes(P2PKH_B) + CScript([OP_RVN_ASSET, b'rvnt\x04NUKA' +
+                                           (50 * COIN).to_bytes(8, 'little'), OP_DROP]))
+
+
+def make_block(prev_block, height, scriptPubKey, txs=(), salt=0):
+    coinbase = CTransaction([CTxIn(COutPoint(), CScript([height, salt]))],
+                            [CTxOut(5000 * COIN, scriptPubKey)])
+    prev_hash = b'\x00' * 32 if prev_block is None else fake_block_hash(prev_block)
+    return CBlock(nVersion=4, hashPrevBlock=prev_hash, nTime=height, vtx=[coinbase] + list(txs))
+
+
+class Test_AddressIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = os.path.join(self.path, 'index')
+
+        b0 = make_block(None, 0, P2PKH_A)
+        self.tx1 = CTransaction([CTxIn(COutPoint(b0.vtx[0].GetTxid(), 0))],
+                                [CTxOut(1000 * COIN, P2SH_C), CTxOut(3999 * COIN, P2PKH_A),
+                                 CTxOut(0, NUKA_B)])
+        b1 = make_block(b0, 1, P2PKH_B, [self.tx1])
+        b2 = make_block(b1, 2, P2PKH_A)
+        b3 = make_block(b2, 3, P2PKH_A)
+        self.blocks = [b0, b1, b2, b3]
+        self.undos = [[], [[Coin(5000 * COIN, P2PKH_A, 0, True)]], [], []]
+        write_chain_with_undo(self.path, self.blocks, self.undos)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_script_address_key(self):
+        self.assertEqual(script_address_key(P2PKH_A), (ADDRESS_P2PKH, b'\xaa' * 20))
+        self.assertEqual(script_address_key(NUKA_B), (ADDRESS_P2PKH, b'\xbb' * 20))
+        self.assertEqual(script_address_key(P2SH_C), (ADDRESS_P2SH, b'\xcc' * 20))
+        # Bare checksig counts as P2PKH of the pubkey
+        pubkey = b'\x02' + b'\x11' * 32
+        self.assertEqual(script_address_key(CScript([pubkey, OP_CHECKSIG])),
+                         script_address_key(P2PKHRavencoinAddress.from_pubkey(
+                             pubkey, accept_invalid=True).to_scriptPubKey()))
+        self.assertIsNone(script_address_key(CScript(b'\x51')))
+        self.assertIsNone(script_address_key(CScript(bytes(P2PKH_A) + b'\x51')))
+
+    def test_update(self):
+        b0, b1, b2, b3 = self.blocks
+        txid0 = b0.vtx[0].GetTxid()
+        txid1 = self.tx1.GetTxid()
+        with Blockchain(self.path) as blockchain, \
+                AddressIndex(os.path.join(self.path, 'addresses')) as addresses:
+            self.assertEqual(addresses.tip, (-1, None))
+            self.assertEqual(addresses.update(blockchain, self.index), 4)
+            self.assertEqual(addresses.tip, (3, fake_block_hash(b3)))
+            self.assertEqual(addresses.update(blockchain, self.index), 0)
+
+            a = addresses.get(P2PKH_A)
+            self.assertEqual(a[:3],
+                             [AddressIndexEntry(0, 0, 0, False, txid0, 5000 * COIN, None),
+                              AddressIndexEntry(1, 1, 0, True, txid1, -5000 * COIN, None),
+                              AddressIndexEntry(1, 1, 1, False, txid1, 3999 * COIN, None)])
+            self.assertEqual([entry.height for entry in a], [0, 1, 1, 2, 3])
+            self.assertEqual(addresses.get(str(P2PKHRavencoinAddress.from_bytes(b'\xaa' * 20))), a)
+            self.assertEqual(addresses.get(P2PKH_A, start=1, end=3), a[1:4])
+            self.assertEqual(addresses.balance(P2PKH_A), 13999 * COIN)
+
+            self.assertEqual(addresses.get(NUKA_B)[1],
+                             AddressIndexEntry(1, 1, 2, False, txid1, 0, ('NUKA', 50 * COIN)))
+            self.assertEqual(addresses.asset_balances(P2PKH_B), {'NUKA': 50 * COIN})
+            self.assertEqual(addresses.balance(P2SH_C), 1000 * COIN)
+
+            # Reorg from height 2
+            b2r = make_block(b1, 2, P2PKH_B, [CTransaction([CTxIn(COutPoint(txid1, 0))],
+                                                           [CTxOut(999 * COIN, P2PKH_B)])], 1)
+            b3r = make_block(b2r, 3, P2PKH_B, salt=1)
+            b4r = make_block(b3r, 4, P2PKH_B, salt=1)
+            blockchain.close()
+            shutil.rmtree(self.index)
+            write_chain_with_undo(self.path, [b0, b1, b2r, b3r, b4r],
+                                  self.undos[:2] + [[[Coin(1000 * COIN, P2SH_C, 1, False)]], [], []],
+                                  file_no=1)
+            self.assertEqual(addresses.update(blockchain, self.index), 3)
+            self.assertEqual(addresses.tip, (4, fake_block_hash(b4r)))
+            self.assertEqual(addresses.get(P2PKH_A), a[:3])
+            self.assertEqual([entry.value for entry in addresses.get(P2SH_C)],
+                             [1000 * COIN, -1000 * COIN])
+            self.assertEqual(addresses.balance(P2PKH_B), (5000 * 4 + 999) * COIN)
+
+            addresses.rollback(1)
+            self.assertEqual(addresses.tip, (0, fake_block_hash(b0)))
+            self.assertEqual(addresses.get(P2PKH_B), [])
+            self.assertEqual(addresses.get(P2PKH_A), a[:1])
+            with self.assertRaises(ValueError):
+                addresses.connect_block(b2r, [])
+
+    def test_no_spends(self):
+        with Blockchain(self.path) as blockchain, \
+                AddressIndex(os.path.join(self.path, 'addresses'), spends=False) as addresses:
+            self.assertEqual(addresses.update(blockchain, self.index), 4)
+            self.assertEqual([entry.spending for entry in addresses.get(P2PKH_A)],
+                             [False] * 4)
@@ -0,0 +1,557 @@
+# Copyright (C) 2020 The python-ravencoinlib developers
+#
+# This file is part of python-ravencoinlib.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-ravencoinlib, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from collections import namedtuple
+
+import plyvel
+
+from ravencoin.blockchain import (Blockchain, RAVENCOIN_CONSTANT, get_blocks,
+                                  get_block, get_block_frames, get_files,
+                                  _frame_batches, _scan_frames)
+from ravencoin.blockchain.index import (BLOCK_HAVE_DATA, BLOCK_HAVE_UNDO, BLOCK_FAILED_VALID,
+                                        DBBlockIndex, block_proof, resolve_best_chain)
+from ravencoin.blockchain.locations import BlockLocationIndex
+from ravencoin.blockchain.undo import (decompress_amount, deserialize_block_undo,
+                                       get_block_undo, iter_prevouts, read_coin)
+from ravencoin.core import (COIN, CBlock, CBlockHeader, COutPoint, CTransaction, CTxIn,
+                            CTxOut, CoreMainParams, CoreTestNetParams, CoreRegTestParams,
+                            Hash, b2lx, x)
+from ravencoin.core.script import CScript
+from ravencoin.core.serialize import VarIntSerializer
+from ravencoin.utxo import Coin
+
+GENESIS_BLOCKS = (CoreMainParams.GENESIS_BLOCK,
+                  CoreTestNetParams.GENESIS_BLOCK,
+                  CoreRegTestParams.GENESIS_BLOCK)
+
+
+def write_blk_file(path, blocks, padding=0):
+    """Write blocks framed the way ravend does, followed by zero padding"""
+    with open(path, 'wb') as f:
+        for block in blocks:
+            raw = block.serialize()
+            f.write(RAVENCOIN_CONSTANT + struct.pack(b'<I', len(raw)) + raw)
+        f.write(b'\x00' * padding)
+
+
+def ser_index_varint(n):
+    """Serialize n in the varint format used by the leveldb block index"""
+    r = [n & 0x7f]
+    while n > 0x7f:
+        n = (n >> 7) - 1
+        r.append((n & 0x7f) | 0x80)
+    return bytes(reversed(r))
+
+
+def ser_block_index(height, block, file_no, data_pos, status=BLOCK_HAVE_DATA | 3,
+                    undo_pos=None):
+    r = ser_index_varint(1) + ser_index_varint(height) + \
+        ser_index_varint(status) + ser_index_varint(len(block.vtx))
+    if status & (BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO):
+        r += ser_index_varint(file_no)
+    if status & BLOCK_HAVE_DATA:
+        r += ser_index_varint(data_pos)
+    if status & BLOCK_HAVE_UNDO:
+        r += ser_index_varint(undo_pos)
+    header = block.get_header().serialize()
+    if len(header) == 120:
+        # KAWPOW headers are stored without nHeight
+        header = header[:76] + header[80:]
+    return r + header
+
+
+def fake_block_hash(block):
+    # Tests don't need PoW hashes, which are expensive to compute
+    return Hash(block.serialize()[:80])
+
+
+def make_chain(path, length, forks=(), file_no=0, time=0, block_hash=fake_block_hash):
+    """Write a chain of length blocks to a blk file and leveldb index
+
+    forks is a list of (height, length) of stale branches to add. time is
+    the nTime of the genesis block, block_hash the function giving the
+    hashes used in the index.
+
+    Returns the list of blocks of the best chain.
+    """
+    coinbase = CoreMainParams.GENESIS_BLOCK.vtx
+
+    def branch(prev_hash, start, n, salt):
+        blocks = []
+        for i in range(n):
+            block = CBlock(nVersion=4, hashPrevBlock=prev_hash, nTime=time + start + i,
+                           nNonce=salt, nHeight=start + i, nonce64=salt,
+                           mix_hash=b'\x01' * 32 if time else b'', vtx=coinbase)
+            blocks.append((start + i, block))
+            prev_hash = block_hash(block)
+        return blocks
+
+    best = branch(b'\x00' * 32, 0, length, 0)
+    entries = list(best)
+    for salt, (height, n) in enumerate(forks, 1):
+        entries += branch(block_hash(best[height - 1][1]), height, n, salt)
+
+    blk_file = os.path.join(path, 'blk%05d.dat' % file_no)
+    write_blk_file(blk_file, [block for height, block in entries])
+    db = plyvel.DB(os.path.join(path, 'index'), create_if_missing=True)
+    for (height, block), frame in zip(entries, get_block_frames(blk_file)):
+        db.put(b'b' + block_hash(block), ser_block_index(height, block, file_no, frame.offset))
+    db.close()
+    return [block for height, block in best]
+
+
+def block_nTime(block):
+    return block.nTime
+
+
+class Test_Blockchain(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for i in range(4):
+            blocks = [GENESIS_BLOCKS[(i + j) % 3] for j in range(i + 1)]
+            write_blk_file(os.path.join(self.path, 'blk%05d.dat' % i),
+                           blocks, padding=1000)
+        self.expected = [GENESIS_BLOCKS[(i + j) % 3]
+                         for i in range(4) for j in range(i + 1)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_blocks(self):
+        blk_file = os.path.join(self.path, 'blk00002.dat')
+        raw_blocks = list(get_blocks(blk_file))
+        self.assertEqual(raw_blocks, [b.serialize() for b in self.expected[3:6]])
+
+    def test_get_block_frames(self):
+        blk_file = os.path.join(self.path, 'blk00004.dat')
+        raw = [b.serialize() for b in GENESIS_BLOCKS]
+        with open(blk_file, 'wb') as f:
+            f.write(b'\x00' * 10)
+            f.write(RAVENCOIN_CONSTANT + struct.pack(b'<I', len(raw[0])) + raw[0])
+            # preallocated but unused space, and a stray magic with no size
+            f.write(b'\x00' * 100 + RAVENCOIN_CONSTANT + b'\x00' * 4)
+            f.write(RAVENCOIN_CONSTANT + struct.pack(b'<I', len(raw[1])) + raw[1])
+            # truncated block at the end of the file
+            f.write(RAVENCOIN_CONSTANT + struct.pack(b'<I', len(raw[2])) + raw[2][:10])
+
+        frames = list(get_block_frames(blk_file))
+        self.assertEqual([bytes(frame.data) for frame in frames], raw[:2])
+        for frame, r in zip(frames, raw):
+            self.assertEqual(frame.file, blk_file)
+            self.assertEqual(frame.size, len(r))
+            self.assertEqual(get_block(blk_file, frame.offset), r)
+        del frame, frames
+
+        open(blk_file, 'wb').close()
+        self.assertEqual(list(get_block_frames(blk_file)), [])
+
+    def test_get_unordered_blocks(self):
+        blockchain = Blockchain(self.path)
+        self.assertEqual(list(blockchain.get_unordered_blocks()), self.expected)
+
+    def test_get_unordered_blocks_lazy(self):
+        blockchain = Blockchain(self.path)
+        blocks = list(blockchain.get_unordered_blocks(lazy=True))
+        self.assertEqual([block.get_block() for block in blocks], self.expected)
+        blocks = list(blockchain.get_unordered_blocks(processes=2, lazy=True))
+        self.assertEqual([block.get_block() for block in blocks], self.expected)
+
+    def test_get_unordered_blocks_parallel(self):
+        blockchain = Blockchain(self.path)
+        self.assertEqual(list(blockchain.get_unordered_blocks(processes=2)),
+                         self.expected)
+
+        nTimes = list(blockchain.get_unordered_blocks(processes=2, map_func=block_nTime))
+        self.assertEqual(nTimes, [b.nTime for b in self.expected])
+
+        nTimes = list(blockchain.get_unordered_blocks(processes=2, map_func=block_nTime,
+                                                      ordered=False))
+        self.assertEqual(sorted(nTimes), sorted(b.nTime for b in self.expected))
+
+    def test_get_unordered_blocks_batches(self):
+        batches = list(_frame_batches(get_files(self.path), 2))
+        self.assertEqual([(os.path.basename(blk_file), count)
+                          for blk_file, offset, count in batches],
+                         [('blk00000.dat', 1), ('blk00001.dat', 2),
+                          ('blk00002.dat', 2), ('blk00002.dat', 1),
+                          ('blk00003.dat', 2), ('blk00003.dat', 2)])
+        # each batch is a separate result message
+        self.assertEqual(_scan_frames(batches[3] + (None, False)), self.expected[5:6])
+        self.assertEqual(_scan_frames(batches[4] + (block_nTime, False)),
+                         [b.nTime for b in self.expected[6:8]])
+
+        blockchain = Blockchain(self.path)
+        self.assertEqual(list(blockchain.get_unordered_blocks(processes=2, batch_size=1)),
+                         self.expected)
+        nTimes = list(blockchain.get_unordered_blocks(processes=3, map_func=block_nTime,
+                                                      ordered=False, batch_size=3))
+        self.assertEqual(sorted(nTimes), sorted(b.nTime for b in self.expected))
+
+
+class Test_OrderedBlocks(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = os.path.join(self.path, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_ordered_blocks_with_forks(self):
+        # No fork reaches the tip height, where equal work would be a tie
+        blocks = make_chain(self.path, 20, forks=[(5, 1), (10, 3), (17, 2), (18, 1)])
+        blockchain = Blockchain(self.path)
+        self.assertEqual(list(blockchain.get_ordered_blocks(self.index)), blocks)
+        self.assertEqual([block.get_block() for block in
+                          blockchain.get_ordered_blocks(self.index, lazy=True)], blocks)
+
+        stale = blockchain.get_stale_blocks(self.index)
+        self.assertEqual([blkIdx.height for blkIdx in stale], [5, 10, 11, 12, 17, 18, 18])
+        best_hashes = set(b2lx(fake_block_hash(block)) for block in blocks)
+        for blkIdx in stale:
+            self.assertNotIn(blkIdx.hash, best_hashes)
+
+    def test_get_ordered_blocks_range(self):
+        blocks = make_chain(self.path, 20, forks=[(15, 2)])
+        with Blockchain(self.path) as blockchain:
+            self.assertEqual(list(blockchain.get_ordered_blocks(self.index, start=12)),
+                             blocks[12:])
+            self.assertEqual(list(blockchain.get_ordered_blocks(self.index, start=16, end=18)),
+                             blocks[16:18])
+            self.assertEqual(list(blockchain.get_ordered_blocks(self.index, start=18, end=16)),
+                             blocks[17:15:-1])
+            self.assertEqual(list(blockchain.get_ordered_blocks(self.index, start=25)), [])
+
+            heights = sorted(blkIdx.height for blkIdx in
+                             blockchain.iter_block_indexes(self.index, min_height=14))
+            self.assertEqual(heights, [14, 15, 15, 16, 16, 17, 18, 19])
+        self.assertIsNone(blockchain.db)
+
+    def test_get_ordered_headers(self):
+        blocks = make_chain(self.path, 10, forks=[(5, 1)])
+        blockchain = Blockchain(self.path)
+        headers = list(blockchain.get_ordered_headers(self.index, start=2))
+        self.assertEqual(headers, [(block.get_header(), 1) for block in blocks[2:]])
+
+        unordered = list(blockchain.get_unordered_headers())
+        self.assertEqual(len(unordered), 11)
+        self.assertEqual(unordered[:10], [(block.get_header(), 1) for block in blocks])
+
+    def test_get_ordered_blocks_index_hash(self):
+        blocks = make_chain(self.path, 5, forks=[(3, 1)])
+        with Blockchain(self.path) as blockchain:
+            for lazy in (False, True):
+                pairs = list(blockchain.get_ordered_blocks(self.index, lazy=lazy,
+                                                           with_index=True))
+                self.assertEqual([block.GetHash() for blkIdx, block in pairs],
+                                 [fake_block_hash(block) for block in blocks])
+                self.assertEqual([(blkIdx.height, blkIdx.n_tx) for blkIdx, block in pairs],
+                                 [(height, 1) for height in range(5)])
+            for header, n_tx in blockchain.get_ordered_headers(self.index):
+                self.assertEqual(header.GetHash(), fake_block_hash(header))
+
+    def test_get_ordered_blocks_verify(self):
+        blocks = make_chain(self.path, 3, time=1600000000,
+                            block_hash=lambda block: block.GetHash())
+        with Blockchain(self.path) as blockchain:
+            self.assertEqual(list(blockchain.get_ordered_blocks(self.index, verify=True)),
+                             blocks)
+        shutil.rmtree(self.index)
+
+        make_chain(self.path, 3, time=1600000000)
+        with Blockchain(self.path) as blockchain:
+            with self.assertRaises(ValueError):
+                list(blockchain.get_ordered_blocks(self.index, verify=True))
+
+    def test_DBBlockIndex_kawpow(self):
+        header = CBlockHeader(nVersion=0x30000000, hashPrevBlock=b'\x01' * 32,
+                              hashMerkleRoot=b'\x02' * 32, nTime=1600000000,
+                              nBits=0x1b00ffff, nHeight=1500000,
+                              nonce64=0x0123456789abcdef, mix_hash=b'\x03' * 32)
+        raw = header.serialize()
+        self.assertEqual(len(raw), 120)
+        raw_index = ser_index_varint(1) + ser_index_varint(1500000) + \
+                    ser_index_varint(BLOCK_HAVE_DATA | 3) + ser_index_varint(42) + \
+                    ser_index_varint(7) + ser_index_varint(1234) + \
+                    raw[:76] + raw[80:]
+        blkIdx = DBBlockIndex('00' * 32, raw_index)
+        self.assertEqual((blkIdx.height, blkIdx.n_tx, blkIdx.file, blkIdx.data_pos),
+                         (1500000, 42, 7, 1234))
+        self.assertEqual(blkIdx.prev_hash, '01' * 32)
+        self.assertEqual(blkIdx.get_header(), header)
+
+    def test_resolve_best_chain_ignores_failed(self):
+        make_chain(self.path, 5, forks=[(3, 3)])
+        db = plyvel.DB(self.index)
+        entries = [(k, DBBlockIndex(b2lx(k[1:]), v)) for k, v in db.iterator()]
+        # mark the top of the longer fork as invalid; stale branch blocks
+        # have a non-zero nonce. Every varint before the status is a single
+        # byte here.
+        for k, blkIdx in entries:
+            if blkIdx.nonce and blkIdx.height >= 4:
+                db.put(k, ser_index_varint(1) + ser_index_varint(blkIdx.height) +
+                       ser_index_varint(BLOCK_HAVE_DATA | BLOCK_FAILED_VALID) +
+                       db.get(k)[3:])
+        db.close()
+        blockchain = Blockchain(self.path)
+        chain = list(blockchain.get_ordered_blocks(self.index))
+        self.assertEqual(len(chain), 5)
+        self.assertEqual(len(blockchain.get_stale_blocks(self.index)), 3)
+
+
+FakeBlockIndex = namedtuple('FakeBlockIndex', ['hash', 'prev_hash', 'height', 'status', 'bits'])
+
+
+class Test_resolve_best_chain(unittest.TestCase):
+    def branch(self, prev, start, bits_list, salt):
+        blocks = []
+        for i, bits in enumerate(bits_list):
+            blkIdx = FakeBlockIndex('%02x%062x' % (salt, start + i), prev, start + i,
+                                    BLOCK_HAVE_DATA | 3, bits)
+            blocks.append(blkIdx)
+            prev = blkIdx.hash
+        return blocks
+
+    def test_most_work(self):
+        main = self.branch('00' * 32, 0, [0x1d00ffff] * 5, 1)
+        # Shorter, but its blocks are twice as hard
+        fork = self.branch(main[1].hash, 2, [0x1c7fff80] * 2, 2)
+        self.assertEqual(block_proof(0x1c7fff80), 2 * block_proof(0x1d00ffff))
+        chain, stale = resolve_best_chain(main + fork)
+        self.assertEqual(chain, main[:2] + fork)
+        self.assertEqual(stale, main[2:])
+
+    def test_ties(self):
+        main = self.branch('00' * 32, 0, [0x1d00ffff] * 3, 5)
+        fork_a = self.branch(main[1].hash, 2, [0x1d00ffff], 3)
+        fork_b = self.branch(main[1].hash, 2, [0x1d00ffff], 4)
+        for indexes in (main + fork_a + fork_b, fork_b + fork_a + main[::-1]):
+            chain, stale = resolve_best_chain(indexes)
+            self.assertEqual(chain, main[:2] + fork_a)
+            self.assertEqual(sorted(stale), sorted(main[2:] + fork_b))
+
+        # Work of invalid targets is 0; height decides then
+        main = self.branch('00' * 32, 0, [0] * 3, 5)
+        fork = self.branch(main[0].hash, 1, [0] * 3, 3)
+        self.assertEqual(resolve_best_chain(main + fork)[0], main[:1] + fork)
+
+
+class Test_BlockLocationIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = os.path.join(self.path, 'locations.dat')
+        self.index = os.path.join(self.path, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_ordered_blocks_cache(self):
+        blocks = make_chain(self.path, 10)
+        blockchain = Blockchain(self.path)
+
+        self.assertEqual(list(blockchain.get_ordered_blocks(self.index, cache=self.cache)),
+                         blocks)
+        locations = BlockLocationIndex(self.cache)
+        self.assertEqual(len(locations), 10)
+        for height, block in enumerate(blocks):
+            blk_hash = fake_block_hash(block)
+            self.assertEqual(locations[height].height, height)
+            self.assertEqual(locations[height].hash, b2lx(blk_hash))
+            self.assertEqual(locations[height].n_tx, 1)
+            self.assertEqual(locations.hash_at(height), blk_hash)
+            self.assertEqual(locations.height_of(blk_hash), height)
+            self.assertEqual(locations.get_by_hash(b2lx(blk_hash)), locations[height])
+        self.assertNotIn(b'\x00' * 32, locations)
+
+        self.assertEqual(list(blockchain.get_ordered_blocks(self.index, start=3, end=5,
+                                                            cache=self.cache)),
+                         blocks[3:5])
+        self.assertEqual(list(blockchain.get_ordered_blocks(self.index, start=5, end=3,
+                                                            cache=self.cache)),
+                         blocks[4:2:-1])
+
+    def test_update(self):
+        blocks = make_chain(self.path, 10)
+        blockchain = Blockchain(self.path)
+        locations = BlockLocationIndex(self.cache)
+        chain = list(blockchain.get_block_locations(self.index, self.cache))
+
+        # appending to the tip
+        self.assertEqual(locations.update(chain[:5]), 0)
+        self.assertEqual(len(locations), 5)
+        self.assertEqual(locations.update(chain[3:]), 5)
+        self.assertEqual(list(locations), chain)
+
+        self.assertEqual(locations.height_of(chain[8].hash), 8)
+
+        # reorg
+        stale = [loc._replace(hash='%064x' % loc.height) for loc in chain[7:]]
+        self.assertEqual(locations.update(chain[6:7] + stale), 7)
+        self.assertEqual(list(locations), chain[:7] + stale)
+        self.assertNotIn(chain[8].hash, locations)
+        self.assertEqual(locations.height_of(stale[1].hash), 8)
+        self.assertEqual(locations.update(chain[6:]), 7)
+        self.assertEqual(list(locations), chain)
+        self.assertNotIn(stale[1].hash, locations)
+        self.assertEqual(locations.height_of(chain[8].hash), 8)
+        with self.assertRaises(ValueError):
+            locations.update(stale[1:])
+
+        # an unrecognized cache file is rebuilt
+        with open(self.cache, 'wb') as f:
+            f.write(b'\x80' * 100)
+        locations = BlockLocationIndex(self.cache)
+        self.assertEqual(len(locations), 0)
+        self.assertEqual(list(blockchain.get_ordered_blocks(self.index, cache=self.cache)),
+                         blocks)
+
+
+def compress_amount(n):
+    """Compress an amount the way ravend's CTxOutCompressor does"""
+    if n == 0:
+        return 0
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n * 9 + d - 1) * 10 + e
+    return 1 + (n - 1) * 10 + 9
+
+
+def ser_coin(coin, compressed_script=None):
+    """Serialize a spent output the way ravend's undo data does
+
+    compressed_script is the special script encoding, if any.
+    """
+    r = ser_index_varint(coin.height * 2 + coin.coinbase)
+    if coin.height:
+        r += b'\x00'
+    r += ser_index_varint(compress_amount(coin.nValue))
+    if compressed_script is None:
+        compressed_script = ser_index_varint(len(coin.scriptPubKey) + 6) + coin.scriptPubKey
+    return r + compressed_script
+
+
+def ser_block_undo(undo):
+    r = VarIntSerializer.serialize(len(undo))
+    for coins in undo:
+        r += VarIntSerializer.serialize(len(coins))
+        r += b''.join(ser_coin(coin) for coin in coins)
+    return r
+
+
+def write_chain_with_undo(path, blocks, undos, file_no=0):
+    """Write the chain of blocks starting at the genesis block to blk and rev
+    files, and add it to the leveldb index
+
+    undos is the undo data of every block. Returns the undo_pos of the
+    blocks after the genesis block.
+    """
+    blk_file = os.path.join(path, 'blk%05d.dat' % file_no)
+    write_blk_file(blk_file, blocks)
+    undo_pos = []
+    with open(os.path.join(path, 'rev%05d.dat' % file_no), 'wb') as f:
+        for block, undo in zip(blocks[1:], undos[1:]):
+            data = ser_block_undo(undo)
+            f.write(RAVENCOIN_CONSTANT + struct.pack(b'<I', len(data)))
+            undo_pos.append(f.tell())
+            f.write(data + Hash(block.hashPrevBlock + data))
+    db = plyvel.DB(os.path.join(path, 'index'), create_if_missing=True)
+    for height, (block, frame) in enumerate(zip(blocks, get_block_frames(blk_file))):
+        # ravend writes no undo data for the genesis block
+        status = BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO | 5 if height else BLOCK_HAVE_DATA | 3
+        db.put(b'b' + fake_block_hash(block),
+               ser_block_index(height, block, file_no, frame.offset, status,
+                               undo_pos[height - 1] if height else None))
+    db.close()
+    return undo_pos
+
+
+class Test_Undo(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = os.path.join(self.path, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_decompress_amount(self):
+        for n in (0, 1, 9, 10, 1234, 50 * COIN, 21000000000 * COIN, 10**9, 10**12 + 7):
+            self.assertEqual(decompress_amount(compress_amount(n)), n)
+
+    def test_read_coin(self):
+        h160 = b'\x11' * 20
+        # G, whose y is even
+        x_G = x('79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
+        y_G = x('483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8')
+        cases = [(b'\x00' + h160, CScript(b'\x76\xa9\x14' + h160 + b'\x88\xac')),
+                 (b'\x01' + h160, CScript(b'\xa9\x14' + h160 + b'\x87')),
+                 (b'\x03' + x_G, CScript(b'\x21\x03' + x_G + b'\xac')),
+                 (b'\x04' + x_G, CScript(b'\x41\x04' + x_G + y_G + b'\xac')),
+                 (b'\x05' + x_G, CScript(b'\x41\x04' + x_G +
+                                         (2**256 - 2**32 - 977 - int.from_bytes(y_G, 'big'))
+                                         .to_bytes(32, 'big') + b'\xac'))]
+        for compressed, script in cases:
+            coin = Coin(50 * COIN, script, 1000, False)
+            data = ser_coin(coin, compressed) + b'\xff'
+            self.assertEqual(read_coin(data), (coin, len(data) - 1))
+
+        coin = Coin(0, CScript(b'\x76\xa9\x14' + h160 + b'\x88\xac\xc0\x01\x02\x75'), 0, True)
+        self.assertEqual(read_coin(ser_coin(coin)), (coin, len(ser_coin(coin))))
+
+    def test_get_ordered_blocks_undo(self):
+        script = CScript(b'\x51')
+        coinbase = lambda height: CTransaction([CTxIn(COutPoint(), CScript([height, b'cb']))],
+                                               [CTxOut(5000 * COIN, script)])
+        blocks = []
+        prev_hash = b'\x00' * 32
+        for height in range(3):
+            vtx = [coinbase(height)]
+            if height == 2:
+                vtx.append(CTransaction([CTxIn(COutPoint(blocks[0].vtx[0].GetTxid(), 0)),
+                                         CTxIn(COutPoint(blocks[1].vtx[0].GetTxid(), 0))],
+                                        [CTxOut(9999 * COIN, script)]))
+            blocks.append(CBlock(nVersion=4, hashPrevBlock=prev_hash, nTime=height, vtx=vtx))
+            prev_hash = fake_block_hash(blocks[-1])
+        undos = [[], [], [[Coin(5000 * COIN, script, 0, True), Coin(5000 * COIN, script, 1, True)]]]
+        undo_pos = write_chain_with_undo(self.path, blocks, undos)
+        rev_file = os.path.join(self.path, 'rev00000.dat')
+
+        with Blockchain(self.path) as blockchain:
+            self.assertEqual(list(blockchain.get_ordered_blocks_undo(self.index)),
+                             list(zip(blocks, undos)))
+            self.assertEqual(list(blockchain.get_ordered_blocks_undo(self.index, start=2,
+                                                                    lazy=True))[0][1],
+                             undos[2])
+
+        self.assertEqual(get_block_undo(rev_file, undo_pos[1], blocks[2].hashPrevBlock), undos[2])
+        with self.assertRaises(ValueError):
+            get_block_undo(rev_file, undo_pos[1], blocks[1].hashPrevBlock)
+
+        prevouts = list(iter_prevouts(blocks[2], undos[2]))
+        self.assertEqual([(tx, txin.prevout.n, coin.height) for tx, txin, coin in prevouts],
+                         [(blocks[2].vtx[1], 0, 0), (blocks[2].vtx[1], 0, 1)])
+        self.assertEqual(sum(coin.nValue for tx, txin, coin in prevouts) -
+                         blocks[2].vtx[1].vout[0].nValue, COIN)
+        with self.assertRaises(ValueError):
+            list(iter_prevouts(blocks[2], []))
+
+        # Asset undo data ravend appends is ignored
+        self.assertEqual(deserialize_block_undo(ser_block_undo(undos[2]) + b'\x01\x00'), undos[2])
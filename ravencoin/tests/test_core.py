@@ -11,10 +11,25 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import pickle
+from io import BytesIO
 import unittest
 
 from ravencoin.core import *
-from ravencoin.core.serialize import X16RHash,X16RV2Hash
+from ravencoin.core.script import CScript, CScriptWitness
+from ravencoin.core.serialize import X16RHash,X16RV2Hash,KawpowHash
+from ravencoin.core.serialize import SerializationTruncationError, DeserializationExtraDataError
+
+def make_block():
+    """A block with the genesis coinbase, a transaction and a witness one"""
+    coinbase = CoreMainParams.GENESIS_BLOCK.vtx[0]
+    txin = CTxIn(COutPoint(b'\x11' * 32, 1), CScript(b'\x51'))
+    txout = CTxOut(5 * COIN, CScript(b'\x76\xa9' + b'\x14' + b'\x22' * 20 + b'\x88\xac'))
+    tx = CTransaction([txin], [txout, txout])
+    witness = CTxWitness([CTxInWitness(CScriptWitness([b'\x01' * 3, b''])),
+                          CTxInWitness(CScriptWitness([b'\x02']))])
+    wtx = CTransaction([txin, txin], [txout], 1234, 2, witness)
+    return CBlock(nVersion=4, nTime=12345, vtx=[coinbase, tx, wtx])
 
 class Test_str_value(unittest.TestCase):
     def test(self):
@@ -72,6 +87,31 @@ class Test_CBlockHeader(unittest.TestCase):
                 nNonce=25023712)
         self.assertEqual(genesis.GetHash(), lx('0000006b444bc2f2ffe627be9d9e7e7a0730000870ef6eb6da46c8eae389df90'))
 
+    def test_GetHash_kawpow(self):
+        def header(nonce64):
+            return CBlockHeader(nTime=1588788001, nHeight=1219736, nonce64=nonce64,
+                                mix_hash=b'\x01' * 32)
+        h = header(12345)
+        self.assertEqual(h.GetHash(), KawpowHash(h.serialize()))
+        self.assertIs(h.GetHash(), h.GetHash())
+        # equal headers share the cached hash
+        self.assertIs(header(12345).GetHash(), h.GetHash())
+        self.assertNotEqual(header(1).GetHash(), h.GetHash())
+
+        block = CBlock(nTime=1588788001, nHeight=1219736, nonce64=12345,
+                       mix_hash=b'\x01' * 32, vtx=[CoreMainParams.GENESIS_BLOCK.vtx[0]])
+        self.assertEqual(block.GetHash(), KawpowHash(block.get_header().serialize()))
+        self.assertEqual(CLazyBlock.deserialize(block.serialize()).GetHash(), block.GetHash())
+
+    def test_hash_headers(self):
+        headers = [CBlockHeader(nTime=1588788001 + i, nHeight=1219736, nonce64=i,
+                                mix_hash=b'\x01' * 32) for i in range(8)]
+        expected = [KawpowHash(h.serialize()) for h in headers]
+        headers[3].GetHash()
+        self.assertEqual(hash_headers(headers, workers=2, chunksize=2), expected)
+        self.assertEqual([h.GetHash() for h in headers], expected)
+        self.assertEqual(hash_headers(headers), expected)
+
     def test_calc_difficulty(self):
         def T(nbits, expected):
             actual = CBlockHeader.calc_difficulty(nbits)
@@ -98,6 +138,14 @@ class Test_CBlock(unittest.TestCase):
         genesis = CBlock.deserialize(x('04000000000000000000000000000000000000000000000000000000000000000000000016355fae8b6a26f2fa708d39997654c44b501f308d802325359a7367a800ff28c60e4d5affff001ee0d47d010101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff570004ffff001d01044c4d5468652054696d65732030332f4a616e2f3230313820426974636f696e206973206e616d65206f66207468652067616d6520666f72206e65772067656e65726174696f6e206f66206669726d73ffffffff010088526a74000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000'))
         self.assertEqual(genesis.GetHash(), lx('0000006b444bc2f2ffe627be9d9e7e7a0730000870ef6eb6da46c8eae389df90'))
 
+    def test_pickle(self):
+        genesis = CoreMainParams.GENESIS_BLOCK
+        genesis2 = pickle.loads(pickle.dumps(genesis))
+        self.assertEqual(genesis2, genesis)
+        self.assertEqual(genesis2.vMerkleTree, genesis.vMerkleTree)
+        with self.assertRaises(AttributeError):
+            genesis2.nTime = 0
+
     def test_calc_merkle_root_of_empty_block(self):
         """CBlock.calc_merkle_root() fails if vtx empty"""
         block = CBlock()
@@ -121,3 +169,197 @@ class Test_CBlock(unittest.TestCase):
         # 99993 four transactions
         block = CBlock.deserialize(x('01000000acda3db591d5c2c63e8c09e7523a5b0581707ef3e3520d6ca180000000000000701179cb9a9e0fe709cc96261b6b943b31362b61dacba94b03f9b71a06cc2eff7d1c1b4d4c86041b75962f880401000000010000000000000000000000000000000000000000000000000000000000000000ffffffff07044c86041b0152ffffffff014034152a01000000434104216220ab283b5e2871c332de670d163fb1b7e509fd67db77997c5568e7c25afd988f19cd5cc5aec6430866ec64b5214826b28e0f7a86458073ff933994b47a5cac0000000001000000042a40ae58b06c3a61ae55dbee05cab546e80c508f71f24ef0cdc9749dac91ea5f000000004a49304602210089c685b37903c4aa62d984929afeaca554d1641f9a668398cd228fb54588f06b0221008a5cfbc5b0a38ba78c4f4341e53272b9cd0e377b2fb740106009b8d7fa693f0b01ffffffff7b999491e30af112b11105cb053bc3633a8a87f44740eb158849a76891ff228b00000000494830450221009a4aa8663ff4017063d2020519f2eade5b4e3e30be69bf9a62b4e6472d1747b2022021ee3b3090b8ce439dbf08a5df31e2dc23d68073ebda45dc573e8a4f74f5cdfc01ffffffffdea82ec2f9e88e0241faa676c13d093030b17c479770c6cc83239436a4327d49000000004a493046022100c29d9de71a34707c52578e355fa0fdc2bb69ce0a957e6b591658a02b1e039d69022100f82c8af79c166a822d305f0832fb800786d831aea419069b3aed97a6edf8f02101fffffffff3e7987da9981c2ae099f97a551783e1b21669ba0bf3aca8fe12896add91a11a0000000049483045022100e332c81781b281a3b35cf75a5a204a2be451746dad8147831255291ebac2604d02205f889a2935270d1bf1ef47db773d68c4d5c6a51bb51f082d3e1c491de63c345601ffffffff0100c817a8040000001976a91420420e56079150b50fb0617dce4c374bd61eccea88ac00000000010000000265a7293b2d69ba51d554cd32ac7586f7fbeaeea06835f26e03a2feab6aec375f000000004a493046022100922361eaafe316003087d355dd3c0ef3d9f44edae661c212a28a91e020408008022100c9b9c84d53d82c0ba9208f695c79eb42a453faea4d19706a8440e1d05e6cff7501fffffffff6971f00725d17c1c531088144b45ed795a307a22d51ca377c6f7f93675bb03a000000008b483045022100d060f2b2f4122edac61a25ea06396fe9135affdabc66d350b5ae1813bc6bf3f302205d8363deef2101fc9f3d528a8b3907e9d29c40772e587dcea12838c574cb80f801410449fce4a25c972a43a6bc67456407a0d4ced782d4cf8c0a35a130d5f65f0561e9f35198349a7c0b4ec79a15fead66bd7642f17cc8c40c5df95f15ac7190c76442ffffffff0200f2052a010000001976a914c3f537bc307c7eda43d86b55695e46047b770ea388ac00cf7b05000000001976a91407bef290008c089a60321b21b1df2d7f2202f40388ac0000000001000000014ab7418ecda2b2531eef0145d4644a4c82a7da1edd285d1aab1ec0595ac06b69000000008c493046022100a796490f89e0ef0326e8460edebff9161da19c36e00c7408608135f72ef0e03e0221009e01ef7bc17cddce8dfda1f1a6d3805c51f9ab2f8f2145793d8e85e0dd6e55300141043e6d26812f24a5a9485c9d40b8712215f0c3a37b0334d76b2c24fcafa587ae5258853b6f49ceeb29cd13ebb76aa79099fad84f516bbba47bd170576b121052f1ffffffff0200a24a04000000001976a9143542e17b6229a25d5b76909f9d28dd6ed9295b2088ac003fab01000000001976a9149cea2b6e3e64ad982c99ebba56a882b9e8a816fe88ac00000000'))
         self.assertEqual(block.calc_merkle_root(), lx('ff2ecc061ab7f9034ba9cbda612b36313b946b1b2696cc09e70f9e9acb791170'))
+
+
+class Test_buf_deserialize(unittest.TestCase):
+    def test_block(self):
+        block = make_block()
+        raw = block.serialize()
+        buf = memoryview(b'\xff' * 3 + raw + b'\xff')
+        block2, pos = CBlock.buf_deserialize(buf, 3)
+        self.assertEqual(pos, 3 + len(raw))
+        self.assertEqual(block2, block)
+        self.assertEqual(block2.vtx[2].GetHash(), block.vtx[2].GetHash())
+        self.assertEqual(block2.vtx[2].GetTxid(), block.vtx[2].GetTxid())
+        self.assertIsInstance(block2.vtx[1].vin[0].prevout.hash, bytes)
+        self.assertIsInstance(block2.vtx[1].vout[0].scriptPubKey, CScript)
+        for i in range(len(raw)):
+            with self.assertRaises(SerializationTruncationError):
+                CBlock.deserialize(raw[:i])
+
+    def test_kawpow_header(self):
+        header = CBlockHeader(nTime=1588788001, nHeight=1219736, nonce64=12345,
+                              mix_hash=b'\x01' * 32)
+        raw = header.serialize()
+        self.assertEqual(len(raw), 120)
+        self.assertEqual(CBlockHeader.buf_deserialize(raw), (header, 120))
+        self.assertEqual(CBlockHeader.deserialize(raw).nonce64, 12345)
+
+class Test_compact_objects(unittest.TestCase):
+    def test_no_instance_dicts(self):
+        block = CBlock.deserialize(make_block().serialize())
+        tx = block.vtx[2]
+        objs = [block, block.get_header(), CLazyBlock.deserialize(block.serialize()), tx,
+                tx.vin[0], tx.vin[0].prevout, tx.vout[0], tx.vout[0].scriptPubKey, tx.wit,
+                tx.wit.vtxinwit[0], tx.wit.vtxinwit[0].scriptWitness,
+                CMutableTransaction.from_tx(tx), CMutableTxIn(), CMutableTxOut(),
+                CMutableOutPoint()]
+        for obj in objs:
+            self.assertFalse(hasattr(obj, '__dict__'), obj.__class__.__name__)
+
+    def test_deserialized_children(self):
+        block = make_block()
+        tx = CTransaction.deserialize(block.vtx[2].serialize())
+        self.assertIs(tx.vin.__class__, tuple)
+        self.assertIs(tx.vin[0].__class__, CTxIn)
+        self.assertIs(tx.vin[0].prevout.__class__, COutPoint)
+        self.assertIs(tx.vout[0].__class__, CTxOut)
+        # immutable children are shared, not copied
+        tx2 = CTransaction(tx.vin, tx.vout, witness=tx.wit)
+        self.assertIs(tx2.vin[0], tx.vin[0])
+        self.assertIs(tx2.vout[0], tx.vout[0])
+
+        mtx = CMutableTransaction.deserialize(tx.serialize())
+        self.assertIs(mtx.vin.__class__, list)
+        mtx.vin.append(CMutableTxIn())
+        self.assertEqual(len(mtx.vin), 3)
+
+    def test_lazy_merkle_trees(self):
+        block = make_block()
+        block2 = CBlock.deserialize(block.serialize())
+        self.assertEqual(block2.vMerkleTree, block.vMerkleTree)
+        self.assertEqual(block2.vMerkleTree[-1], block.hashMerkleRoot)
+        self.assertEqual(block2.vWitnessMerkleTree, block.vWitnessMerkleTree)
+        self.assertEqual(len(block2.vWitnessMerkleTree), 6)
+        self.assertEqual(CBlock().vMerkleTree, ())
+        self.assertEqual(CoreMainParams.GENESIS_BLOCK.vWitnessMerkleTree, ())
+
+class Test_cached_serialization(unittest.TestCase):
+    def test_serialize_cached(self):
+        block = make_block()
+        tx = CTransaction.deserialize(block.vtx[2].serialize())
+        for obj in (block.get_header(), tx.vin[0].prevout, tx.vin[0], tx.vout[0]):
+            self.assertIs(obj.serialize(), obj.serialize())
+        # Other params aren't cached
+        self.assertNotEqual(tx.serialize(dict(include_witness=False)), tx.serialize())
+
+        # Transactions and blocks only cache their hashes
+        for obj in (block, tx):
+            self.assertEqual(hash(obj), hash(obj))
+            self.assertEqual(obj.serialize(), obj.serialize())
+            self.assertFalse(hasattr(obj, '_cached_serialize'))
+        self.assertEqual(CTransaction.deserialize(tx.serialize()), tx)
+
+        mtx = CMutableTransaction.from_tx(tx)
+        data = mtx.serialize()
+        mtx.nLockTime = 1
+        self.assertNotEqual(mtx.serialize(), data)
+        self.assertNotEqual(mtx, tx)
+        self.assertNotEqual(hash(mtx), hash(tx))
+
+    def test_not_pickled(self):
+        txout = CTxOut(1, CScript(b'\x51'))
+        hash(txout)
+        txout2 = pickle.loads(pickle.dumps(txout))
+        self.assertFalse(hasattr(txout2, '_cached_serialize'))
+        self.assertEqual(txout2, txout)
+        self.assertEqual(txout2._cached__hash__, hash(txout))
+
+    def test_outpoint_eq_hash(self):
+        outpoint = COutPoint(b'\x11' * 32, 1)
+        moutpoint = CMutableOutPoint(b'\x11' * 32, 1)
+        self.assertEqual(outpoint, moutpoint)
+        self.assertEqual(moutpoint, outpoint)
+        self.assertEqual(hash(outpoint), hash(moutpoint))
+        self.assertNotEqual(outpoint, COutPoint(b'\x11' * 32, 2))
+        self.assertNotEqual(outpoint, COutPoint(b'\x12' * 32, 1))
+        self.assertNotEqual(outpoint, outpoint.serialize())
+
+        d = {outpoint: 1}
+        self.assertEqual(d[COutPoint.deserialize(outpoint.serialize())], 1)
+        moutpoint.n = 2
+        self.assertNotIn(moutpoint, d)
+
+class Test_buf_serialize(unittest.TestCase):
+    def stream_serialize(self, obj, **kwargs):
+        f = BytesIO()
+        obj.stream_serialize(f, **kwargs)
+        return f.getvalue()
+
+    def test_matches_stream_serialize(self):
+        block = make_block()
+        big = CScript(b'\x51' * 0x1234)
+        mtx = CMutableTransaction([CMutableTxIn(CMutableOutPoint(b'\x01' * 32, 3), big)],
+                                  [CMutableTxOut(-1, big), CMutableTxOut(2, CScript())])
+        header = CBlockHeader(nTime=1588788001, nHeight=1219736, nonce64=12345,
+                              mix_hash=b'\x01' * 32)
+        for obj in [block, header, mtx, CTransaction.from_tx(mtx)] + list(block.vtx):
+            self.assertEqual(obj.serialize(), self.stream_serialize(obj))
+        for tx in block.vtx:
+            self.assertEqual(tx.serialize(dict(include_witness=False)),
+                             self.stream_serialize(tx, include_witness=False))
+        self.assertEqual(CTransaction.deserialize(mtx.serialize()), mtx)
+
+    def test_buf_serialize_appends(self):
+        tx = make_block().vtx[1]
+        buf = bytearray(b'\xff')
+        tx.buf_serialize(buf)
+        self.assertEqual(bytes(buf), b'\xff' + tx.serialize())
+
+class Test_CLazyBlock(unittest.TestCase):
+    def test_lazy_block(self):
+        block = make_block()
+        raw = block.serialize()
+        lazy = CLazyBlock.deserialize(raw)
+
+        self.assertEqual(lazy.get_header(), block.get_header())
+        self.assertEqual(lazy.serialize(), raw)
+        self.assertEqual(lazy.get_block(), block)
+        self.assertEqual(len(lazy.vtx), 3)
+        self.assertEqual(lazy.get_txids(), [tx.GetTxid() for tx in block.vtx])
+        self.assertEqual(lazy.calc_merkle_root(), block.hashMerkleRoot)
+        self.assertEqual(bytes(lazy.get_raw_tx(2)), block.vtx[2].serialize())
+        self.assertEqual(lazy.vtx[2], block.vtx[2])
+        self.assertIs(lazy.vtx[2], lazy.vtx[2])
+        self.assertEqual(lazy.vtx[1:], list(block.vtx[1:]))
+        self.assertEqual(list(lazy.vtx), list(block.vtx))
+        self.assertEqual(pickle.loads(pickle.dumps(lazy)).serialize(), raw)
+
+    def test_stream_deserialize(self):
+        class Stream(object):
+            # Not seekable, and counting the bytes read
+            def __init__(self, data):
+                self.f = BytesIO(data)
+                self.n_read = 0
+
+            def read(self, n):
+                r = self.f.read(n)
+                self.n_read += len(r)
+                return r
+
+        block = make_block()
+        txout = block.vtx[1].vout[0]
+        # without inputs, the marker byte can't be taken for a witness flag
+        block2 = CBlock(nVersion=4, nTime=12346,
+                        vtx=[block.vtx[0], CTransaction([], [txout, txout])])
+        raw = block.serialize() + block2.serialize()
+        f = Stream(raw + b'\xff')
+        lazy = CLazyBlock.stream_deserialize(f)
+        self.assertEqual(f.n_read, len(block.serialize()))
+        self.assertEqual(lazy.get_block(), block)
+        lazy2 = CLazyBlock.stream_deserialize(f)
+        self.assertEqual(f.n_read, len(raw))
+        self.assertEqual(lazy2.get_block(), block2)
+        self.assertEqual(f.read(10), b'\xff')
+        for i in range(len(block.serialize())):
+            with self.assertRaises(SerializationTruncationError):
+                CLazyBlock.stream_deserialize(Stream(raw[:i]))
+
+    def test_lazy_block_truncated(self):
+        raw = make_block().serialize()
+        with self.assertRaises(SerializationTruncationError):
+            CLazyBlock.deserialize(raw[:-10])
+        with self.assertRaises(DeserializationExtraDataError):
+            CLazyBlock.deserialize(raw + b'\x00')
+        lazy = CLazyBlock.deserialize(raw + b'\x00', allow_padding=True)
+        self.assertEqual(lazy.serialize(), raw)
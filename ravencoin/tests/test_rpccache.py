@@ -0,0 +1,117 @@
+# Copyright (C) 2018-2020 The python-ravencoinlib developers
+#
+# This file is part of python-ravencoinlib.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-ravencoinlib, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ravencoin.core import b2x, b2lx, lx, CoreMainParams
+from ravencoin.rpc import RavenProxy
+from ravencoin.rpccache import CachingProxy
+from ravencoin.tests.test_rpc import FakeRPCServer, ThreadingHTTPServer
+
+GENESIS = CoreMainParams.GENESIS_BLOCK
+GENESIS_TX = GENESIS.vtx[0]
+
+
+@unittest.skipIf(ThreadingHTTPServer is None, 'needs http.server.ThreadingHTTPServer')
+class Test_CachingProxy(unittest.TestCase):
+    def setUp(self):
+        self.tip = 100
+        self.confirmations = 1
+
+        def getrawtransaction(txid, verbose):
+            hex_tx = b2x(GENESIS_TX.serialize())
+            if not verbose:
+                return hex_tx
+            return {'hex': hex_tx, 'txid': txid, 'version': 1, 'locktime': 0, 'vin': [],
+                    'vout': [], 'confirmations': self.confirmations}
+
+        self.server = FakeRPCServer({
+            'getblockcount': lambda: self.tip,
+            'getblockhash': lambda height: '%064x' % height,
+            'getblock': lambda h, verbose: b2x(GENESIS.serialize()),
+            'getblockheader': lambda h, verbose: b2x(GENESIS.get_header().serialize()),
+            'getrawtransaction': getrawtransaction})
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.path)
+
+    def methods_called(self):
+        return [r['method'] for port, r in self.server.requests]
+
+    def test_getblockhash(self):
+        proxy = CachingProxy(RavenProxy(self.server.url), min_confirmations=6)
+        for i in range(2):
+            self.assertEqual(proxy.getblockhash(10), lx('%064x' % 10))
+            self.assertEqual(proxy.getblockhash(98), lx('%064x' % 98))
+        # the tip is only looked up every tip_interval seconds
+        self.assertEqual(self.methods_called(),
+                         ['getblockcount', 'getblockhash', 'getblockhash', 'getblockhash'])
+        self.assertEqual(proxy.hits['getblockhash'], 1)
+        self.assertEqual(proxy.misses['getblockhash'], 3)
+
+        self.tip = 110
+        proxy.tip_interval = 0
+        proxy.getblockhash(98)
+        proxy.getblockhash(98)
+        self.assertEqual(proxy.hits['getblockhash'], 2)
+
+    def test_by_hash(self):
+        proxy = CachingProxy(RavenProxy(self.server.url), maxsize=2)
+        block_hash = lx('%064x' % 1)
+        for i in range(3):
+            self.assertEqual(proxy.getblock(block_hash).serialize(), GENESIS.serialize())
+            self.assertEqual(proxy.getblockheader(block_hash), GENESIS.get_header())
+        self.assertEqual(proxy.cache_info(), (4, 2, 2, 2))
+        proxy.getblockheader(block_hash, verbose=False)
+        proxy.getblock(lx('%064x' % 2))
+        # least recently used first out
+        self.assertEqual(proxy.cache_info().currsize, 2)
+        proxy.getblockheader(block_hash)
+        self.assertEqual(proxy.misses['getblock'], 2)
+        self.assertEqual(proxy.misses['getblockheader'], 1)
+        proxy.getblock(block_hash)
+        self.assertEqual(proxy.misses['getblock'], 3)
+
+    def test_getrawtransaction(self):
+        proxy = CachingProxy(RavenProxy(self.server.url), min_confirmations=6)
+        txid = GENESIS_TX.GetTxid()
+        self.assertEqual(proxy.getrawtransaction(txid), GENESIS_TX)
+        self.assertEqual(proxy.getrawtransaction(txid), GENESIS_TX)
+        self.assertEqual(proxy.hits['getrawtransaction'], 0)
+
+        self.confirmations = 6
+        self.assertEqual(proxy.getrawtransaction(txid, True)['confirmations'], 6)
+        self.assertEqual(proxy.getrawtransaction(txid), GENESIS_TX)
+        self.assertEqual(proxy.hits['getrawtransaction'], 1)
+        self.assertEqual(self.methods_called(), ['getrawtransaction'] * 3)
+
+    def test_disk(self):
+        path = os.path.join(self.path, 'cache')
+        block_hash = lx('%064x' % 1)
+        proxy = CachingProxy(RavenProxy(self.server.url), path=path)
+        proxy.getblock(block_hash)
+        proxy.getblockhash(1)
+        proxy.close()
+
+        proxy = CachingProxy(RavenProxy(self.server.url), path=path)
+        self.assertEqual(proxy.getblock(block_hash).serialize(), GENESIS.serialize())
+        self.assertEqual(proxy.getblockhash(1), lx('%064x' % 1))
+        self.assertEqual(proxy.cache_info().hits, 2)
+        # passed through
+        self.assertEqual(proxy.getblockcount(), 100)
+        proxy.close()
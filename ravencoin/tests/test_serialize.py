@@ -84,6 +84,28 @@ class Test_VarIntSerializer(unittest.TestCase):
         T(b'ff')
         T(b'ff00000000000000')
 
+    def test_buf_serialize(self):
+        buf = bytearray(b'\xaa')
+        for value in (0xfc, 0xfd, 0x10000, 0x100000000):
+            VarIntSerializer.buf_serialize(value, buf)
+        self.assertEqual(bytes(buf), unhexlify(b'aafcfdfd00fe00000100ff0000000001000000'))
+        with self.assertRaises(ValueError):
+            VarIntSerializer.buf_serialize(-1, buf)
+
+    def test_buf_deserialize(self):
+        buf = memoryview(unhexlify(b'aafd3412fe67452301ff0000000000000000'))
+        pos = 1
+        values = []
+        while pos < len(buf):
+            value, pos = VarIntSerializer.buf_deserialize(buf, pos)
+            values.append(value)
+        self.assertEqual(values, [0x1234, 0x1234567, 0])
+        self.assertEqual(pos, len(buf))
+        with self.assertRaises(SerializationTruncationError):
+            VarIntSerializer.buf_deserialize(buf, len(buf))
+        with self.assertRaises(SerializationTruncationError):
+            VarIntSerializer.buf_deserialize(buf[:-1], 9)
+
 class Test_BytesSerializer(unittest.TestCase):
     def test(self):
         def T(value, expected):
@@ -107,6 +129,45 @@ class Test_BytesSerializer(unittest.TestCase):
         T(b'0200')
         T(b'ff00000000000000ff11223344', SerializationError) # > max_size
 
+    def test_buf_deserialize(self):
+        buf = bytearray(unhexlify(b'ff02aabb01cc00'))
+        value, pos = BytesSerializer.buf_deserialize(buf, 1)
+        self.assertEqual((value, pos), (b'\xaa\xbb', 4))
+        self.assertIsInstance(value, bytes)
+        self.assertEqual(BytesSerializer.buf_deserialize(memoryview(buf), pos), (b'\xcc', 6))
+        self.assertEqual(BytesSerializer.buf_deserialize(buf, 6), (b'', 7))
+        with self.assertRaises(SerializationTruncationError):
+            BytesSerializer.buf_deserialize(buf[:5], 4)
+
+class Test_VectorSerializer(unittest.TestCase):
+    def test_buf_deserialize(self):
+        ints = [0, -1, 0x7fffffff]
+        buf = b'\x00' + intVectorSerializer.serialize(ints)
+        self.assertEqual(intVectorSerializer.buf_deserialize(buf, 1), (ints, len(buf)))
+        with self.assertRaises(SerializationTruncationError):
+            intVectorSerializer.buf_deserialize(buf[:-1], 1)
+
+        uints = [b'\x01' * 32, b'\x02' * 32]
+        buf = uint256VectorSerializer.serialize(uints)
+        self.assertEqual(uint256VectorSerializer.buf_deserialize(memoryview(buf)), (uints, len(buf)))
+
+    def test_stream_fallback(self):
+        """buf_deserialize() falls back on stream_deserialize()"""
+
+        class FooSerializable(Serializable):
+            def __init__(self, value):
+                self.value = value
+
+            @classmethod
+            def stream_deserialize(cls, f):
+                return cls(ser_read(f, 2))
+
+        buf = b'\x02abcd'
+        for b in (buf, memoryview(buf)):
+            objs, pos = VectorSerializer.buf_deserialize(FooSerializable, b)
+            self.assertEqual([obj.value for obj in objs], [b'ab', b'cd'])
+            self.assertEqual(pos, 5)
+
 class Test_Compact(unittest.TestCase):
     def test_from_compact_zero(self):
         self.assertEqual(uint256_from_compact(0x00123456), 0)
@@ -16,6 +16,7 @@ import unittest
 import os
 
 from ravencoin.core import *
+from ravencoin.core.script import CScript, CScriptWitness
 from ravencoin.core.scripteval import VerifyScript, SCRIPT_VERIFY_P2SH
 
 from ravencoin.tests.test_scripteval import parse_script
@@ -120,6 +121,45 @@ class Test_CTransaction(unittest.TestCase):
         tx.vin.append(CTxIn())
         self.assertFalse(tx.is_coinbase())
 
+    def test_GetTxid_from_raw(self):
+        for prevouts, tx, enforceP2SH in load_test_vectors('tx_valid.json'):
+            mtx = CMutableTransaction.from_tx(tx)
+            self.assertEqual(tx.GetTxid(), mtx.GetTxid())
+            self.assertEqual(tx.GetHash(), mtx.GetHash())
+
+        txin = CTxIn(COutPoint(b'\x11' * 32, 0))
+        txout = CTxOut(1, CScript(b'\x51'))
+        wit = CTxWitness([CTxInWitness(CScriptWitness([b'\x01', b'\x02\x03']))])
+        wtx = CTransaction([txin], [txout], 7, 2, wit)
+        raw = wtx.serialize()
+        tx = CTransaction.deserialize(raw)
+        self.assertEqual(tx.GetTxid(), Hash(CTransaction([txin], [txout], 7, 2).serialize()))
+        self.assertEqual(tx.GetHash(), Hash(raw))
+        self.assertNotEqual(tx.GetTxid(), tx.GetHash())
+
+        # marker and flag present but the witness is empty: dropped when
+        # re-serializing, so GetHash() must not hash the raw bytes
+        raw = x('02000000') + b'\x00\x01' + CTransaction([txin], [txout]).serialize()[4:-4] + \
+              b'\x00' + x('07000000')
+        tx = CTransaction.deserialize(raw)
+        self.assertEqual(tx.GetHash(), Hash(tx.serialize()))
+        self.assertEqual(tx.GetTxid(), CMutableTransaction.from_tx(tx).GetTxid())
+
+    def test_mutable_GetTxid(self):
+        tx = CMutableTransaction.deserialize(CTransaction([CTxIn()], [CTxOut(1)]).serialize())
+        txid = tx.GetTxid()
+        tx.nLockTime = 5
+        self.assertNotEqual(tx.GetTxid(), txid)
+
+    def test_txids_from_raw_block(self):
+        txin = CTxIn(COutPoint(b'\x11' * 32, 0))
+        wit = CTxWitness([CTxInWitness(CScriptWitness([b'\x01']))])
+        vtx = [CTransaction([CTxIn()], [CTxOut(1)]),
+               CTransaction([txin], [CTxOut(2)], 0, 2, wit)]
+        block = CBlock(vtx=vtx)
+        self.assertEqual(txids_from_raw_block(block.serialize()),
+                         [tx.GetTxid() for tx in vtx])
+
     def test_tx_valid(self):
         for prevouts, tx, enforceP2SH in load_test_vectors('tx_valid.json'):
             try:
@@ -0,0 +1,163 @@
+# Copyright (C) 2020 The python-ravencoinlib developers
+#
+# This file is part of python-ravencoinlib.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-ravencoinlib, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from ravencoin.core import *
+from ravencoin.core.script import *
+from ravencoin.core.script import OP_RVN_ASSET
+from ravencoin.utxo import Coin, UtxoSet
+
+P2PKH_A = CScript([OP_DUP, OP_HASH160, b'\xaa' * 20, OP_EQUALVERIFY, OP_CHECKSIG])
+P2PKH_B = CScript([OP_DUP, OP_HASH160, b'\xbb' * 20, OP_EQUALVERIFY, OP_CHECKSIG])
+
+
+def asset_script(script, name, amount):
+    data = b'rvnt' + bytes([len(name)]) + name.encode('ascii') + amount.to_bytes(8, 'little')
+    return CScript(bytes(script) + CScript([OP_RVN_ASSET, data, OP_DROP]))
+
+
+def make_block(prev_hash, block_hash, txs, height):
+    coinbase = CTransaction([CTxIn(COutPoint(), CScript([height, b'cb']))],
+                            [CTxOut(5000 * COIN, P2PKH_A), CTxOut(0, CScript([OP_RETURN]))])
+    block = CBlock(hashPrevBlock=prev_hash, vtx=[coinbase] + txs)
+    # X16R hashes are slow; the tests don't need real ones
+    object.__setattr__(block, '_cached_GetHash', block_hash)
+    return block
+
+
+def spend(outpoints, vout):
+    return CTransaction([CTxIn(outpoint) for outpoint in outpoints], vout)
+
+
+class Test_UtxoSet(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_chain(self):
+        b0 = make_block(b'\x00' * 32, b'\x01' * 32, [], 0)
+        cb0 = b0.vtx[0].GetTxid()
+        tx1 = spend([COutPoint(cb0, 0)],
+                    [CTxOut(1000 * COIN, P2PKH_B),
+                     CTxOut(3999 * COIN, P2PKH_A),
+                     CTxOut(0, asset_script(P2PKH_B, 'NUKA', 50 * COIN))])
+        # Spends an output created in the same block
+        tx2 = spend([COutPoint(tx1.GetTxid(), 1)],
+                    [CTxOut(3998 * COIN, P2PKH_A),
+                     CTxOut(0, CScript([OP_RVN_ASSET, b'\x14' * 30, OP_DROP]))])
+        b1 = make_block(b0.GetHash(), b'\x02' * 32, [tx1, tx2], 1)
+        return b0, b1, tx1, tx2
+
+    def test_connect_disconnect(self):
+        b0, b1, tx1, tx2 = self.make_chain()
+        utxos = UtxoSet()
+        self.assertEqual(utxos.connect_block(b0), [])
+        self.assertEqual(len(utxos), 1)
+        self.assertEqual((utxos.height, utxos.best_block), (0, b'\x01' * 32))
+        cb0 = COutPoint(b0.vtx[0].GetTxid(), 0)
+        self.assertEqual(utxos[cb0], Coin(5000 * COIN, P2PKH_A, 0, True))
+        self.assertNotIn(COutPoint(b0.vtx[0].GetTxid(), 1), utxos)
+
+        undo = utxos.connect_block(b1)
+        self.assertEqual(undo, [[Coin(5000 * COIN, P2PKH_A, 0, True)],
+                                [Coin(3999 * COIN, P2PKH_A, 1, False)]])
+        self.assertEqual(utxos.height, 1)
+        self.assertNotIn(cb0, utxos)
+        self.assertNotIn(COutPoint(tx1.GetTxid(), 1), utxos)
+        self.assertEqual(utxos[COutPoint(tx1.GetTxid(), 0)], Coin(1000 * COIN, P2PKH_B, 1, False))
+        self.assertEqual(utxos.get(COutPoint(tx2.GetTxid(), 1)), None)
+        self.assertEqual(len(utxos), 4)
+
+        self.assertEqual(utxos.balance(P2PKH_A), 8998 * COIN)
+        self.assertEqual(utxos.balance(P2PKH_B), 1000 * COIN)
+        self.assertEqual(utxos.balances(), {P2PKH_A: 8998 * COIN, P2PKH_B: 1000 * COIN})
+        self.assertEqual(utxos.asset_balance('NUKA'), 50 * COIN)
+        self.assertEqual(utxos.asset_balance('NUKA', P2PKH_B), 50 * COIN)
+        self.assertEqual(utxos.asset_balance('NUKA', P2PKH_A), 0)
+        self.assertEqual(utxos.asset_balances(), {'NUKA': 50 * COIN})
+        self.assertEqual(utxos.asset_balances(by_script=True), {('NUKA', P2PKH_B): 50 * COIN})
+        self.assertEqual(utxos[COutPoint(tx1.GetTxid(), 2)].asset, ('NUKA', 50 * COIN))
+
+        # From the kept undo data, then from the one given
+        state = sorted(utxos.items())
+        utxos.disconnect_block(b1)
+        self.assertEqual(sorted(utxos.items()),
+                         [(b0.vtx[0].GetTxid(), 0, Coin(5000 * COIN, P2PKH_A, 0, True))])
+        self.assertEqual((utxos.height, utxos.best_block), (0, b'\x01' * 32))
+        with self.assertRaises(ValueError):
+            utxos.disconnect_block(b1)
+        utxos.connect_block(b1)
+        utxos.disconnect_block(b1, undo)
+        utxos.connect_block(b1)
+        self.assertEqual(sorted(utxos.items()), state)
+
+        utxos.disconnect_block(b1)
+        utxos.disconnect_block(b0)
+        self.assertEqual((len(utxos), utxos.height, utxos.best_block), (0, -1, None))
+
+    def test_invalid_blocks(self):
+        b0, b1, tx1, tx2 = self.make_chain()
+        utxos = UtxoSet(undo_depth=0)
+        utxos.connect_block(b0)
+        with self.assertRaises(ValueError):
+            utxos.connect_block(make_block(b'\x07' * 32, b'\x08' * 32, [], 1))
+        with self.assertRaises(ValueError):
+            utxos.disconnect_block(b0)
+
+        # A double spend in the block leaves the set as it was
+        state = sorted(utxos.items())
+        bad = make_block(b0.GetHash(), b'\x03' * 32,
+                         [tx1, tx2, spend([COutPoint(tx1.GetTxid(), 1)], [CTxOut(1, P2PKH_B)])], 1)
+        with self.assertRaises(KeyError):
+            utxos.connect_block(bad)
+        self.assertEqual(sorted(utxos.items()), state)
+        self.assertEqual(utxos.height, 0)
+
+    def test_save_load(self):
+        b0, b1, tx1, tx2 = self.make_chain()
+        path = os.path.join(self.tmpdir, 'utxos.dat')
+        utxos = UtxoSet()
+        utxos.save(path)
+        utxos2 = UtxoSet.load(path)
+        self.assertEqual((len(utxos2), utxos2.height, utxos2.best_block), (0, -1, None))
+
+        utxos.connect_block(b0)
+        utxos.connect_block(b1)
+        utxos.save(path)
+        utxos2 = UtxoSet.load(path)
+        self.assertEqual(sorted(utxos2.items()), sorted(utxos.items()))
+        self.assertEqual((utxos2.height, utxos2.best_block), (1, b'\x02' * 32))
+        self.assertEqual(utxos2.asset_balances(), {'NUKA': 50 * COIN})
+
+        # Undo data isn't saved
+        with self.assertRaises(ValueError):
+            utxos2.disconnect_block(b1)
+        utxos2.disconnect_block(b1, [[Coin(5000 * COIN, P2PKH_A, 0, True)],
+                                     [Coin(3999 * COIN, P2PKH_A, 1, False)]])
+        utxos.disconnect_block(b1)
+        self.assertEqual(sorted(utxos2.items()), sorted(utxos.items()))
+
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)
+        with self.assertRaises(ValueError):
+            UtxoSet.load(path)
+        with open(path, 'wb') as f:
+            f.write(b'not a snapshot' * 10)
+        with self.assertRaises(ValueError):
+            UtxoSet.load(path)
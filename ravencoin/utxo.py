@@ -0,0 +1,372 @@
+# Copyright (C) 2018-2020 The python-ravencoinlib developers
+#
+# This file is part of python-ravencoinlib.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-ravencoinlib, including this file, may be copied, modified,
+# propagated, or distributed except according to the terms contained in the
+# LICENSE file.
+
+"""In-memory set of unspent transaction outputs
+
+>>> utxos = UtxoSet()
+>>> for block in blockchain.get_ordered_blocks(index):
+...     utxos.connect_block(block)
+>>> utxos.save('utxos.dat')
+
+and later, to resume where it left off:
+
+>>> utxos = UtxoSet.load('utxos.dat')
+>>> for block in blockchain.get_ordered_blocks(index, start=utxos.height + 1):
+...     utxos.connect_block(block)
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import os
+import struct
+
+from ravencoin.core import CTxOut, b2lx
+from ravencoin.core.assets import get_script_asset
+from ravencoin.core.script import CScript, MAX_SCRIPT_SIZE, OP_RETURN, OP_RVN_ASSET
+
+# Number of blocks whose undo data is kept for disconnect_block()
+DEFAULT_UNDO_DEPTH = 100
+
+# Outpoints are keyed by their serialization, txid then index
+_OUTPOINT = struct.Struct('<32sI')
+# Coins are stored packed: height * 2 + coinbase flag like ravend, amount and
+# asset name length, followed by the asset name and amount if any, then the
+# script
+_COIN = struct.Struct('<IqB')
+_ASSET_AMOUNT = struct.Struct('<q')
+
+# Snapshot layout: a header followed by (outpoint, coin length, coin) records
+_MAGIC = b'RVNUTXOS'
+_VERSION = 1
+# magic, version, height, best block hash, number of coins
+_HEADER = struct.Struct('<8sIi32sQ')
+_RECORD = struct.Struct('<36sI')
+
+_NULL_HASH = b'\x00' * 32
+
+
+class Coin(collections.namedtuple('Coin', ['nValue', 'scriptPubKey', 'height', 'coinbase'])):
+    """An unspent output, with the height and kind of the transaction that
+    created it, like ravend's Coin"""
+    __slots__ = ()
+
+    @property
+    def txout(self):
+        return CTxOut(self.nValue, self.scriptPubKey)
+
+    @property
+    def asset(self):
+        """(asset name, amount) held by the output, or None"""
+        return get_script_asset(self.scriptPubKey)
+
+
+def _is_unspendable(script):
+    # As ravend, which never adds these to its UTXO set; null asset data
+    # scripts start with OP_RVN_ASSET.
+    return ((len(script) > 0 and script[0] in (OP_RETURN, OP_RVN_ASSET)) or
+            len(script) > MAX_SCRIPT_SIZE)
+
+
+def _asset_holder(script):
+    # The script an asset is held by, without the asset data; ravend only
+    # accepts assets held by P2PKH and P2SH scripts
+    if script[25:26] == b'\xc0':
+        return script[:25]
+    elif script[23:24] == b'\xc0':
+        return script[:23]
+    return script
+
+
+def _pack_coin(nValue, script, height, coinbase):
+    asset = get_script_asset(script)
+    if asset is None:
+        return _COIN.pack(height * 2 + coinbase, nValue, 0) + script
+    name = asset[0].encode('ascii')
+    return (_COIN.pack(height * 2 + coinbase, nValue, len(name)) + name +
+            _ASSET_AMOUNT.pack(asset[1]) + script)
+
+
+def _script_offset(name_length):
+    if name_length:
+        return _COIN.size + name_length + _ASSET_AMOUNT.size
+    return _COIN.size
+
+
+def _unpack_coin(data):
+    code, nValue, name_length = _COIN.unpack_from(data)
+    return Coin(nValue, CScript(data[_script_offset(name_length):]), code >> 1, bool(code & 1))
+
+
+def _unpack_asset(data):
+    """Return (script offset, asset name, amount) of a packed coin"""
+    name_length = data[_COIN.size - 1]
+    if not name_length:
+        return _COIN.size, None, 0
+    end = _COIN.size + name_length
+    return (end + _ASSET_AMOUNT.size, data[_COIN.size:end].decode('ascii'),
+            _ASSET_AMOUNT.unpack_from(data, end)[0])
+
+
+class UtxoSet(object):
+    """Set of the unspent outputs of a chain of blocks
+
+    Blocks are applied with connect_block(), in chain order from the genesis
+    block or from a snapshot made with save(), e.g. as yielded by
+    Blockchain.get_ordered_blocks() or ravencoin.rpc.iter_blocks(). Coins are
+    kept packed in a dict keyed by serialized outpoint; they are unpacked to
+    Coin when looked up.
+
+    undo_depth - Number of most recent blocks whose spent coins are kept, so
+                 they can be disconnected in a reorg without giving the undo
+                 data to disconnect_block().
+
+    height is that of the last connected block, -1 when empty, and
+    best_block its hash.
+    """
+
+    def __init__(self, undo_depth=DEFAULT_UNDO_DEPTH):
+        self.height = -1
+        self.best_block = None
+        self.undo_depth = undo_depth
+        self._coins = {}
+        # (block hash, undo data) of the most recent blocks
+        self._undo = collections.deque()
+
+    def __len__(self):
+        return len(self._coins)
+
+    def __contains__(self, outpoint):
+        return _OUTPOINT.pack(outpoint.hash, outpoint.n) in self._coins
+
+    def __getitem__(self, outpoint):
+        return _unpack_coin(self._coins[_OUTPOINT.pack(outpoint.hash, outpoint.n)])
+
+    def get(self, outpoint, default=None):
+        """Return the Coin of outpoint, or default if it isn't unspent"""
+        data = self._coins.get(_OUTPOINT.pack(outpoint.hash, outpoint.n))
+        if data is None:
+            return default
+        return _unpack_coin(data)
+
+    def items(self):
+        """Yield (txid, n, Coin) for every unspent output, in no particular
+        order"""
+        for key, data in self._coins.items():
+            txid, n = _OUTPOINT.unpack(key)
+            yield txid, n, _unpack_coin(data)
+
+    def connect_block(self, block, height=None):
+        """Spend the outputs the block's transactions spend, and add those
+        they create
+
+        height defaults to the one after the current height. Returns the undo
+        data of the block: for every transaction but the coinbase, the list of
+        Coin spent by its inputs, as in the node's rev*.dat files.
+
+        Raises ValueError if the block doesn't build on best_block, and
+        KeyError if it spends an output that isn't unspent; the set is left
+        unchanged in both cases.
+        """
+        if self.best_block is not None and block.hashPrevBlock != self.best_block:
+            raise ValueError('block %s does not build on best block %s' %
+                             (b2lx(block.GetHash()), b2lx(self.best_block)))
+        if height is None:
+            height = self.height + 1
+
+        coins = self._coins
+        spent = []
+        added = []
+        try:
+            for i, tx in enumerate(block.vtx):
+                if i:
+                    for txin in tx.vin:
+                        key = _OUTPOINT.pack(txin.prevout.hash, txin.prevout.n)
+                        spent.append((key, coins.pop(key)))
+
+                txid = tx.GetTxid()
+                for n, txout in enumerate(tx.vout):
+                    script = txout.scriptPubKey
+                    if _is_unspendable(script):
+                        continue
+                    key = _OUTPOINT.pack(txid, n)
+                    coins[key] = _pack_coin(txout.nValue, script, height, not i)
+                    added.append(key)
+        except KeyError as err:
+            # Restore the spent coins first, then remove the added ones, of
+            # which some may have been spent again by later transactions.
+            for key, data in spent:
+                coins[key] = data
+            for key in added:
+                coins.pop(key, None)
+            txid, n = _OUTPOINT.unpack(err.args[0])
+            raise KeyError('block at height %d spends missing output %s:%d' %
+                           (height, b2lx(txid), n))
+
+        undo = []
+        spent = iter(spent)
+        for tx in block.vtx[1:]:
+            undo.append([_unpack_coin(data) for key, data in
+                         (next(spent) for txin in tx.vin)])
+
+        self.height = height
+        self.best_block = block.GetHash()
+        if self.undo_depth:
+            self._undo.append((self.best_block, undo))
+            if len(self._undo) > self.undo_depth:
+                self._undo.popleft()
+        return undo
+
+    def disconnect_block(self, block, undo=None):
+        """Undo connect_block() for the tip block, e.g. in a reorg
+
+        undo is the undo data connect_block() returned for the block, or the
+        block's undo data read from the node's rev*.dat files. It may be
+        omitted for the last undo_depth blocks.
+
+        Raises ValueError if block isn't the tip, or if there is no undo data
+        for it.
+        """
+        block_hash = block.GetHash()
+        if block_hash != self.best_block:
+            raise ValueError('block %s is not the best block' % b2lx(block_hash))
+        if undo is None:
+            if not self._undo or self._undo[-1][0] != block_hash:
+                raise ValueError('no undo data for block %s' % b2lx(block_hash))
+            undo = self._undo[-1][1]
+        if len(undo) != len(block.vtx) - 1:
+            raise ValueError('undo data has %d transactions, block %d non-coinbase' %
+                             (len(undo), len(block.vtx) - 1))
+
+        coins = self._coins
+        for i in range(len(block.vtx) - 1, -1, -1):
+            tx = block.vtx[i]
+            txid = tx.GetTxid()
+            for n in range(len(tx.vout)):
+                coins.pop(_OUTPOINT.pack(txid, n), None)
+            if i:
+                for txin, coin in zip(tx.vin, undo[i - 1]):
+                    coins[_OUTPOINT.pack(txin.prevout.hash, txin.prevout.n)] = \
+                        _pack_coin(coin.nValue, coin.scriptPubKey, coin.height, coin.coinbase)
+
+        if self._undo and self._undo[-1][0] == block_hash:
+            self._undo.pop()
+        self.height -= 1
+        self.best_block = None if self.height < 0 else block.hashPrevBlock
+
+    def balance(self, scriptPubKey):
+        """Return the RVN amount of the unspent outputs paying to
+        scriptPubKey
+
+        This scans the whole set; use balances() to look up many scripts.
+        """
+        scriptPubKey = bytes(scriptPubKey)
+        total = 0
+        for data in self._coins.values():
+            if data.endswith(scriptPubKey):
+                offset, name, amount = _unpack_asset(data)
+                if data[offset:] == scriptPubKey:
+                    total += _COIN.unpack_from(data)[1]
+        return total
+
+    def balances(self):
+        """Return a Counter of the RVN amount held by every script"""
+        totals = collections.Counter()
+        for data in self._coins.values():
+            nValue = _COIN.unpack_from(data)[1]
+            if nValue:
+                offset = _script_offset(data[_COIN.size - 1])
+                totals[CScript(data[offset:])] += nValue
+        return totals
+
+    def asset_balance(self, asset_name, scriptPubKey=None):
+        """Return the amount of asset_name held in the unspent outputs,
+        optionally only by scriptPubKey
+
+        Asset outputs are held by the P2PKH or P2SH script their asset data
+        is appended to, which is what scriptPubKey is compared with.
+
+        This scans the whole set; use asset_balances() to look up many.
+        """
+        if scriptPubKey is not None:
+            scriptPubKey = bytes(scriptPubKey)
+        total = 0
+        for data in self._coins.values():
+            offset, name, amount = _unpack_asset(data)
+            if name == asset_name and (scriptPubKey is None or
+                                       _asset_holder(data[offset:]) == scriptPubKey):
+                total += amount
+        return total
+
+    def asset_balances(self, by_script=False):
+        """Return a Counter of the amount of every asset in the unspent
+        outputs
+
+        If by_script is True, the Counter is keyed by (asset name, script)
+        instead, giving the holdings of every script as in asset_balance().
+        """
+        totals = collections.Counter()
+        for data in self._coins.values():
+            offset, name, amount = _unpack_asset(data)
+            if name is not None:
+                if by_script:
+                    totals[name, CScript(_asset_holder(data[offset:]))] += amount
+                else:
+                    totals[name] += amount
+        return totals
+
+    def save(self, path):
+        """Write a snapshot of the set to path
+
+        The file is written next to path and renamed over it, so an
+        interrupted save leaves the previous snapshot intact. The undo data
+        of recent blocks isn't saved.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, self.height,
+                                 self.best_block or _NULL_HASH, len(self._coins)))
+            for key, data in self._coins.items():
+                f.write(_RECORD.pack(key, len(data)))
+                f.write(data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, undo_depth=DEFAULT_UNDO_DEPTH):
+        """Read a snapshot written by save()
+
+        Raises ValueError if path isn't a snapshot of this version.
+        """
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+        if len(data) < _HEADER.size:
+            raise ValueError('%s is not a UTXO set snapshot' % path)
+        magic, version, height, best_block, count = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('%s is not a UTXO set snapshot of version %d' % (path, _VERSION))
+
+        self = cls(undo_depth)
+        self.height = height
+        self.best_block = None if height < 0 else best_block
+        coins = self._coins
+        pos = _HEADER.size
+        unpack_from = _RECORD.unpack_from
+        try:
+            for i in range(count):
+                key, length = unpack_from(data, pos)
+                pos += _RECORD.size
+                coins[key] = bytes(data[pos:pos + length])
+                pos += length
+        except struct.error:
+            raise ValueError('%s is truncated' % path)
+        if pos != len(data):
+            raise ValueError('%s is truncated' % path)
+        return self